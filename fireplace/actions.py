@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from copy import copy, deepcopy
 
 from hearthstone.enums import (
 	BlockType, CardClass, CardType, Mulligan, PlayState, Step, Zone
@@ -53,6 +54,95 @@ class EventListener:
 	def __repr__(self):
 		return "<EventListener %r>" % (self.trigger)
 
+	def __deepcopy__(self, memo):
+		# Event listeners come from the card scripts, and are shared
+		# between copies of a game
+		return self
+
+
+class EventRegistry:
+	"""
+	Index of the entities which may have an EventListener for a given
+	Action class, so that broadcasts only visit those entities.
+	Cards are indexed while they are in one of LISTENING_ZONES, with every
+	listener they may have there (see BaseEntity.potential_events), whether
+	or not the listener is currently active; Action._broadcast() does the
+	exact matching. The entries of an entity are updated when it changes
+	zones and when it loses a one-time listener (see update()).
+	"""
+	LISTENING_ZONES = (Zone.HAND, Zone.PLAY, Zone.SECRET)
+
+	def __init__(self, game):
+		self.game = game
+		self.listeners = {}
+		# The keys of `listeners` each entity id is indexed under
+		self.keys = {}
+		# Incremented whenever a listener is added to an existing entity
+		self.version = 0
+
+	def __deepcopy__(self, memo):
+		ret = self.__class__.__new__(self.__class__)
+		memo[id(self)] = ret
+		ret.game = deepcopy(self.game, memo)
+		ret.listeners = {
+			key: {entity_id: deepcopy(entity, memo) for entity_id, entity in entities.items()}
+			for key, entities in self.listeners.items()
+		}
+		ret.keys = self.keys.copy()
+		ret.version = self.version
+		return ret
+
+	def register(self, entity, events):
+		keys = set(self.keys.get(entity.entity_id, ()))
+		for event in events:
+			for cls in type(event.trigger).__mro__:
+				key = (cls, event.at)
+				if key not in self.listeners:
+					self.listeners[key] = {}
+				self.listeners[key][entity.entity_id] = entity
+				keys.add(key)
+		if keys:
+			self.keys[entity.entity_id] = tuple(keys)
+
+	def unregister(self, entity):
+		for key in self.keys.pop(entity.entity_id, ()):
+			del self.listeners[key][entity.entity_id]
+
+	def update(self, entity):
+		"""
+		Index \a entity according to its current zone and listeners.
+		Entities are indexed when they are created (see GameManager.new_entity()).
+		"""
+		entity_id = getattr(entity, "entity_id", None)
+		if entity_id is None:
+			return
+		self.unregister(entity)
+		if not entity.is_card or entity.zone in self.LISTENING_ZONES:
+			self.register(entity, entity.potential_events)
+
+	def add_listener(self, entity, event):
+		"""
+		Register an EventListener added to an existing entity
+		"""
+		self.register(entity, [event])
+		self.version += 1
+
+	def get_listeners(self, action, at):
+		"""
+		Return a sorted list of (position, entity) of the entities which
+		may listen to \a action. See BaseGame.broadcast_position().
+		"""
+		listeners = self.listeners.get((action.__class__, at))
+		if not listeners:
+			return []
+		ret = []
+		for entity in listeners.values():
+			position = self.game.broadcast_position(entity)
+			if position is not None:
+				ret.append((position, entity))
+		ret.sort(key=lambda e: e[0])
+		return ret
+
 
 class ActionMeta(type):
 	def __new__(metacls, name, bases, namespace):
@@ -133,15 +223,36 @@ class Action(metaclass=ActionMeta):
 			if event.at != at:
 				continue
 			if isinstance(event.trigger, self.__class__) and event.trigger.matches(entity, args):
-				log.info("%r triggers off %r from %r", entity, self, source)
+				if not log.disabled:
+					log.info("%r triggers off %r from %r", entity, self, source)
 				entity.trigger_event(source, event, args)
 
 	def broadcast(self, source, at, *args):
-		for entity in source.game.entities:
-			self._broadcast(entity, source, at, *args)
-
-		for entity in source.game.hands:
+		registry = source.game.event_registry
+		version = registry.version
+		last_entity_id = source.game.manager.counter
+		listeners = registry.get_listeners(self, at)
+		visited = set()
+		i = 0
+		while i < len(listeners):
+			position, entity = listeners[i]
+			i += 1
+			visited.add(entity.entity_id)
 			self._broadcast(entity, source, at, *args)
+			if registry.version != version:
+				# Listeners were added by the event. Like broadcasting over a
+				# snapshot of the game entities, visit them if their entity came
+				# after the current one and existed when broadcasting started.
+				version = registry.version
+				pending = listeners[i:]
+				skip = visited | {e.entity_id for p, e in pending}
+				added = [
+					(p, e) for p, e in registry.get_listeners(self, at)
+					if p > position and e.entity_id <= last_entity_id and e.entity_id not in skip
+				]
+				if added:
+					listeners = sorted(pending + added, key=lambda e: e[0])
+					i = 0
 
 	def queue_broadcast(self, obj, args):
 		self.event_queue.append((obj, args))
@@ -192,7 +303,8 @@ class Attack(GameAction):
 		return ret
 
 	def do(self, source, attacker, defender):
-		log.info("%r attacks %r", attacker, defender)
+		if not log.disabled:
+			log.info("%r attacks %r", attacker, defender)
 		attacker.attack_target = defender
 		defender.defending = True
 		source.game.proposed_attacker = attacker
@@ -279,7 +391,8 @@ class Death(GameAction):
 	ENTITY = ActionArg()
 
 	def do(self, source, target):
-		log.info("Processing Death for %r", target)
+		if not log.disabled:
+			log.info("Processing Death for %r", target)
 		self.broadcast(source, EventListener.ON, target)
 		if target.deathrattles:
 			source.game.queue_actions(source, [Deathrattle(target)])
@@ -341,12 +454,14 @@ class GenericChoice(GameAction):
 		return player, cards
 
 	def do(self, source, player, cards):
-		player.choice = self
-		self.source = source
-		self.player = player
-		self.cards = cards
-		self.min_count = 1
-		self.max_count = 1
+		# The action may belong to a card script, shared by every game
+		choice = copy(self)
+		player.choice = choice
+		choice.source = source
+		choice.player = player
+		choice.cards = cards
+		choice.min_count = 1
+		choice.max_count = 1
 
 	def choose(self, card):
 		if card not in self.cards:
@@ -415,7 +530,8 @@ class Play(GameAction):
 
 	def do(self, source, card, target, index, choose):
 		player = source
-		log.info("%s plays %r (target=%r, index=%r)", player, card, target, index)
+		if not log.disabled:
+			log.info("%s plays %r (target=%r, index=%r)", player, card, target, index)
 
 		player.pay_cost(card, card.cost)
 
@@ -570,13 +686,15 @@ class TargetedAction(Action):
 			args = self.get_args(source)
 			targets = self.get_targets(source, args[0])
 			args = args[1:]
-			log.info("%r triggering %r targeting %r", source, self, targets)
+			if not log.disabled:
+				log.info("%r triggering %r targeting %r", source, self, targets)
 			for target in targets:
 				target_args = self.get_target_args(source, target)
 				ret.append(self.do(source, target, *target_args))
 
 				for action in self.callback:
-					log.info("%r queues up callback %r", self, action)
+					if not log.disabled:
+						log.info("%r queues up callback %r", self, action)
 					ret += source.game.queue_actions(source, [action], event_args=[target] + target_args)
 
 		self.resolve_broadcasts()
@@ -716,10 +834,12 @@ class Battlecry(TargetedAction):
 		player = card.controller
 
 		if card.has_combo and player.combo:
-			log.info("Activating %r combo targeting %r", card, target)
+			if not log.disabled:
+				log.info("Activating %r combo targeting %r", card, target)
 			actions = card.get_actions("combo")
 		else:
-			log.info("Activating %r action targeting %r", card, target)
+			if not log.disabled:
+				log.info("Activating %r action targeting %r", card, target)
 			actions = card.get_actions("play")
 
 		source.target = target
@@ -775,7 +895,7 @@ class Discover(TargetedAction):
 			discover_class = source.data.card_class
 		else:
 			# use random class for neutral hero classes with neutral cards
-			discover_class = random_class()
+			discover_class = random_class(source.game.random)
 
 		picker = self._args[1] * 3
 		picker = picker.copy_with_weighting(1, card_class=CardClass.NEUTRAL)
@@ -1092,6 +1212,7 @@ class Silence(TargetedAction):
 		# Wipe the event listeners
 		target._events = []
 		target.silenced = True
+		source.game.aura_tracker.invalidate()
 
 
 class Summon(TargetedAction):
@@ -1109,7 +1230,8 @@ class Summon(TargetedAction):
 		return super()._broadcast(entity, source, at, *args)
 
 	def do(self, source, target, cards):
-		log.info("%s summons %r", target, cards)
+		if not log.disabled:
+			log.info("%s summons %r", target, cards)
 		if not isinstance(cards, list):
 			cards = [cards]
 
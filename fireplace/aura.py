@@ -1,3 +1,5 @@
+from hearthstone.enums import CardType
+
 from .logging import log
 from .managers import CardManager
 
@@ -18,8 +20,12 @@ class AuraBuff:
 	def remove(self):
 		log.info("Destroying %r", self)
 		self.entity.slots.remove(self)
+		self.entity.clear_attr_cache()
 		self.source.game.active_aura_buffs.remove(self)
 
+	def clear_attr_cache(self):
+		self.entity.clear_attr_cache()
+
 	def _getattr(self, attr, i):
 		value = getattr(self, attr, 0)
 		if callable(value):
@@ -37,11 +43,29 @@ class Refresh:
 		self.buff = buff
 		self.priority = priority
 
+	@property
+	def volatile(self):
+		"""
+		True if the refresh may give different results without any change
+		to the zones, board positions and controllers of the entities.
+		"""
+		if getattr(self.selector, "volatile", True):
+			return True
+		if self.tags:
+			for value in self.tags.values():
+				if not isinstance(value, int) and not callable(value):
+					return True
+		return False
+
 	def trigger(self, source):
+		"""
+		Refresh the aura and return the buffs it gives
+		"""
+		ret = []
 		entities = self.selector.eval(source.game, source)
 		for entity in entities:
 			if self.buff:
-				entity.refresh_buff(source, self.buff)
+				ret.append(entity.refresh_buff(source, self.buff))
 			else:
 				tags = {}
 				for tag, value in self.tags.items():
@@ -49,7 +73,8 @@ class Refresh:
 						value = value.evaluate(source)
 					tags[tag] = value
 
-				entity.refresh_tags(source, tags)
+				ret.append(entity.refresh_tags(source, tags))
+		return ret
 
 	def __repr__(self):
 		return "Refresh(%r, %r, %r)" % (self.selector, self.tags or {}, self.buff or "")
@@ -66,15 +91,108 @@ class TargetableByAuras:
 			buff = source.buff(self, id)
 			buff.tick = source.game.tick
 			source.game.active_aura_buffs.append(buff)
+		return buff
 
 	def refresh_tags(self, source, tags):
-		for slot in self.slots:
-			if slot.source is source:
-				slot.update_tags(tags)
+		for buff in self.slots:
+			if buff.source is source:
+				buff.update_tags(tags)
 				break
 		else:
 			buff = AuraBuff(source, self)
 			log.info("Creating %r", buff)
 			buff.update_tags(tags)
 			self.slots.append(buff)
+			self.clear_attr_cache()
 			source.game.active_aura_buffs.append(buff)
+		return buff
+
+
+class AuraTracker:
+	"""
+	Refreshes the auras of a game.
+	The buffs given by non-volatile auras (see Refresh.volatile) are kept
+	alive as they are until the zone or the controller of an entity changes,
+	an entity is silenced or a minion becomes (or stops being) enraged.
+	Other auras are refreshed every time.
+	In debug mode, non-volatile auras are refreshed anyway and checked
+	against the buffs they were expected to give.
+	"""
+	def __init__(self, game, debug=False):
+		self.game = game
+		self.debug = debug
+		# Incremented whenever the zone or controller of an entity changes
+		self.version = 0
+		self._queue = []
+		self._queue_version = None
+		self._enraged = []
+
+	def invalidate(self):
+		self.version += 1
+
+	def get_refresh_queue(self):
+		"""
+		Returns a list of [entity, script, buffs] for all the auras in the game,
+		sorted by refresh priority (used by eg. Lightspawn).
+		"""
+		ret = []
+		self._enraged = []
+		for entity in self.game.entities:
+			for script in entity.update_scripts:
+				ret.append([entity, script, None])
+			if entity.type == CardType.MINION and entity.data.scripts.enrage:
+				self._enraged.append((entity, bool(entity.enraged)))
+
+		for entity in self.game.hands:
+			for script in entity.data.scripts.Hand.update:
+				ret.append([entity, script, None])
+
+		ret.sort(key=lambda e: getattr(e[1], "priority", 50))
+		return ret
+
+	def refresh(self):
+		game = self.game
+		version = self.version
+		if self._queue_version != version or any(
+			bool(entity.enraged) != enraged for entity, enraged in self._enraged
+		):
+			self._queue = self.get_refresh_queue()
+			for item in self._queue:
+				entity, script, buffs = item
+				ret = script.trigger(entity)
+				if not getattr(script, "volatile", True):
+					item[2] = ret
+		else:
+			for entity, script, buffs in self._queue:
+				if buffs is None:
+					script.trigger(entity)
+				elif self.debug:
+					self.check(entity, script, buffs)
+				else:
+					for buff in buffs:
+						buff.tick = game.tick
+
+		buffs_to_destroy = []
+		for buff in game.active_aura_buffs:
+			if buff.tick < game.tick:
+				buffs_to_destroy.append(buff)
+		for buff in buffs_to_destroy:
+			buff.remove()
+
+		# Results are only kept if nothing moved during the refresh itself
+		self._queue_version = version if self.version == version else None
+		game.tick += 1
+
+	def check(self, entity, script, buffs):
+		active_aura_buffs = list(self.game.active_aura_buffs)
+		states = [buff.__dict__.copy() for buff in buffs]
+		ret = script.trigger(entity)
+		assert len(ret) == len(buffs) and all(a is b for a, b in zip(ret, buffs)), (
+			"%r from %r gives %r, expected %r" % (script, entity, ret, buffs)
+		)
+		assert len(active_aura_buffs) == len(self.game.active_aura_buffs), (
+			"%r from %r gives new buffs" % (script, entity)
+		)
+		for buff, state in zip(buffs, states):
+			state["tick"] = buff.tick
+			assert buff.__dict__ == state, "%r from %r changes %r" % (script, entity, buff)
@@ -4,10 +4,11 @@ from hearthstone.enums import CardType, PlayReq, PlayState, Race, Rarity, Step,
 
 from . import actions, cards, enums, rules
 from .aura import TargetableByAuras
-from .entity import BaseEntity, Entity, boolean_property, int_property, slot_property
+from .entity import (
+	BaseEntity, Entity, boolean_property, depends_on, int_property, slot_property
+)
 from .exceptions import InvalidAction
 from .managers import CardManager
-from .targeting import TARGETING_PREREQUISITES, is_valid_target
 from .utils import CardList
 
 
@@ -38,7 +39,7 @@ class BaseCard(BaseEntity):
 		super().__init__()
 		self.requirements = data.requirements.copy()
 		self.id = data.id
-		self.controller = None
+		self._controller = None
 		self.choose = None
 		self.parent_card = None
 		self.aura = False
@@ -67,12 +68,29 @@ class BaseCard(BaseEntity):
 		return self.controller.game
 
 	@property
+	@depends_on("_controller")
+	def controller(self):
+		return self._controller
+
+	@controller.setter
+	def controller(self, value):
+		self._controller = value
+		if value is not None:
+			value.game.entities_changed()
+
+	@property
+	@depends_on("_zone")
 	def zone(self):
 		return self._zone
 
 	@zone.setter
 	def zone(self, value):
+		game = self.game
+		# Zone changes can trigger actions before the entity actually moves
+		game.entities_changed()
 		self._set_zone(value)
+		game.event_registry.update(self)
+		game.entities_changed()
 
 	def _set_zone(self, value):
 		old = self.zone
@@ -81,7 +99,7 @@ class BaseCard(BaseEntity):
 			self.logger.warning("%r attempted a same-zone move in %r", self, old)
 			return
 
-		if old:
+		if old and not self.logger.disabled:
 			self.logger.debug("%r moves from %r to %r", self, old, value)
 
 		caches = {
@@ -114,6 +132,7 @@ class BaseCard(BaseEntity):
 		ret.apply(target)
 		for k, v in kwargs.items():
 			setattr(ret, k, v)
+		target.clear_attr_cache()
 		return ret
 
 	def is_playable(self) -> bool:
@@ -150,6 +169,11 @@ class PlayableCard(BaseCard, Entity, TargetableByAuras):
 		return self.base_events + self._events
 
 	@property
+	def potential_events(self):
+		return super().potential_events + self.data.scripts.Hand.events
+
+	@property
+	@depends_on("_zone", "_cost", "buffs", "script.cost", "script.cost_mod")
 	def cost(self):
 		ret = 0
 		if self.zone == Zone.HAND:
@@ -174,6 +198,7 @@ class PlayableCard(BaseCard, Entity, TargetableByAuras):
 		return bool(self.choose_cards)
 
 	@property
+	@depends_on("script.powered_up")
 	def powered_up(self):
 		"""
 		Returns True whether the card is "powered up".
@@ -190,6 +215,7 @@ class PlayableCard(BaseCard, Entity, TargetableByAuras):
 		return chain([self], self.buffs)
 
 	@property
+	@depends_on("_zone", "_controller", "game.entities_version", zones=(Zone.HAND, ))
 	def zone_position(self):
 		"""
 		Returns the card's position (1-indexed) in its zone, or 0 if not available.
@@ -299,8 +325,8 @@ class PlayableCard(BaseCard, Entity, TargetableByAuras):
 		if card.requires_target():
 			if not target:
 				raise InvalidAction("%r requires a target to play." % (self))
-			elif target not in self.play_targets:
-				raise InvalidAction("%r is not a valid target for %r." % (target, self))
+			elif target not in card.play_targets:
+				raise InvalidAction("%r is not a valid target for %r." % (target, card))
 		elif target:
 			self.logger.warning("%r does not require a target, ignoring target %r", self, target)
 		self.game.play_card(self, target, index, choose)
@@ -333,10 +359,7 @@ class PlayableCard(BaseCard, Entity, TargetableByAuras):
 			if PlayReq.REQ_TARGET_FOR_COMBO in self.requirements:
 				return True
 
-		for req in TARGETING_PREREQUISITES:
-			if req in self.requirements:
-				return True
-		return False
+		return self.data.target_validator is not None
 
 	def requires_target(self):
 		"""
@@ -362,7 +385,19 @@ class PlayableCard(BaseCard, Entity, TargetableByAuras):
 
 	@property
 	def play_targets(self):
-		return [card for card in self.game.characters if is_valid_target(self, card)]
+		validate = self.data.target_validator
+		if validate is None:
+			return []
+		game = self.game
+		# Targets depend on most of the state of the game, so they are only
+		# memoized while it cannot change (see BaseGame.cache_targets())
+		cache = game._targets_cache
+		if cache is not None:
+			ret = cache.get(id(self))
+			if ret is None:
+				ret = cache[id(self)] = [card for card in game.characters if validate(self, card)]
+			return ret
+		return [card for card in game.characters if validate(self, card)]
 
 	@property
 	def targets(self):
@@ -433,6 +468,7 @@ class LiveEntity(PlayableCard, Entity):
 		self._to_be_destroyed = value
 
 	@property
+	@depends_on("turn_killed", "game.turn")
 	def killed_this_turn(self):
 		return self.turn_killed == self.game.turn
 
@@ -469,11 +505,16 @@ class Character(LiveEntity):
 			ret += rules.HEAVILY_ARMORED
 		return ret
 
+	@property
+	def potential_events(self):
+		return super().potential_events + rules.HEAVILY_ARMORED
+
 	@property
 	def attackable(self):
 		return not self.immune
 
 	@property
+	@depends_on("attack_target")
 	def attacking(self):
 		return self.attack_target is not None
 
@@ -487,7 +528,10 @@ class Character(LiveEntity):
 		taunts = targets.filter(taunt=True).filter(attackable=True)
 		return (taunts or targets).filter(attackable=True)
 
-	def can_attack(self, target=None):
+	def _ready_to_attack(self):
+		"""
+		Whether the character could attack, if it had something to attack
+		"""
 		if self.controller.choice:
 			return False
 		if not self.zone == Zone.PLAY:
@@ -502,6 +546,11 @@ class Character(LiveEntity):
 			return False
 		if self.frozen:
 			return False
+		return True
+
+	def can_attack(self, target=None):
+		if not self._ready_to_attack():
+			return False
 		if not self.attack_targets:
 			return False
 		if target is not None and target not in self.attack_targets:
@@ -520,6 +569,10 @@ class Character(LiveEntity):
 		return False
 
 	@property
+	@depends_on(
+		"attack_target", "_zone", "_to_be_destroyed", "damage", "_max_health", "buffs",
+		"script.max_health"
+	)
 	def should_exit_combat(self):
 		if self.attacking:
 			if self.dead or self.zone != Zone.PLAY:
@@ -546,6 +599,9 @@ class Character(LiveEntity):
 
 
 class Hero(Character):
+	# Attributes which _getattr() derives from the weapon (see TrackedTags)
+	derived_attributes = ("atk", )
+
 	def __init__(self, data):
 		self.armor = 0
 		self.power = None
@@ -647,6 +703,10 @@ class Minion(Character):
 		return self.zone == Zone.PLAY and not self.turns_in_play and not self.charge
 
 	@property
+	@depends_on(
+		"_zone", "turns_in_play", "num_attacks", "_charge", "_windfury", "buffs",
+		"script.charge", "script.windfury"
+	)
 	def exhausted(self):
 		if self.asleep:
 			return True
@@ -663,6 +723,9 @@ class Minion(Character):
 			yield from self.data.scripts.enrage
 
 	@property
+	@depends_on(
+		"_zone", "_controller", "game.entities_version", zones=(Zone.HAND, Zone.PLAY)
+	)
 	def zone_position(self):
 		if self.zone == Zone.PLAY:
 			return self.controller.field.index(self) + 1
@@ -736,10 +799,18 @@ class Secret(Spell):
 		return ret
 
 	@property
+	def potential_events(self):
+		return super().potential_events + self.data.scripts.secret
+
+	@property
+	@depends_on("_zone", "_controller", "game.current_player", zones=(Zone.SECRET, ))
 	def exhausted(self):
 		return self.zone == Zone.SECRET and self.controller.current_player
 
 	@property
+	@depends_on(
+		"_zone", "_controller", "game.entities_version", zones=(Zone.HAND, Zone.SECRET)
+	)
 	def zone_position(self):
 		if self.zone == Zone.SECRET:
 			return self.controller.secrets.index(self) + 1
@@ -794,15 +865,22 @@ class Enchantment(BaseCard):
 		i += getattr(self, "_" + attr, 0)
 		return getattr(self.data.scripts, attr, lambda s, x: x)(self, i)
 
+	def clear_attr_cache(self):
+		owner = getattr(self, "owner", None)
+		if owner is not None:
+			owner.clear_attr_cache()
+
 	def _set_zone(self, zone):
 		if zone == Zone.PLAY:
 			self.owner.buffs.append(self)
+			self.owner.clear_attr_cache()
 		elif zone == Zone.REMOVEDFROMGAME:
 			if self.zone == zone:
 				# Can happen if a Destroy is queued after a bounce, for example
 				self.logger.warning("Trying to remove %r which is already gone", self)
 				return
 			self.owner.buffs.remove(self)
+			self.owner.clear_attr_cache()
 			if self in self.game.active_aura_buffs:
 				self.game.active_aura_buffs.remove(self)
 		super()._set_zone(zone)
@@ -833,6 +911,7 @@ class Weapon(rules.WeaponRules, LiveEntity):
 		return max(0, self.max_durability - self.damage)
 
 	@property
+	@depends_on("_max_durability", "_max_health", "buffs", "script.max_health")
 	def max_durability(self):
 		ret = self._max_durability
 		ret += self._getattr("max_health", 0)
@@ -843,6 +922,7 @@ class Weapon(rules.WeaponRules, LiveEntity):
 		self._max_durability = value
 
 	@property
+	@depends_on("_zone", "_controller", "game.current_player", zones=(Zone.PLAY, ))
 	def exhausted(self):
 		return self.zone == Zone.PLAY and not self.controller.current_player
 
@@ -866,6 +946,10 @@ class HeroPower(PlayableCard):
 		self.activations_this_turn = 0
 
 	@property
+	@depends_on(
+		"activations_this_turn", "_additional_activations", "buffs",
+		"script.additional_activations"
+	)
 	def exhausted(self):
 		if self.additional_activations == -1:
 			return False
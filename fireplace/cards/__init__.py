@@ -1,15 +1,65 @@
 import os
+from importlib import import_module
 from pkg_resources import resource_filename
 from hearthstone import cardxml
 from hearthstone.enums import CardType
 from ..logging import log
 from ..rules import POISONOUS
-from ..utils import get_script_definition
+from ..targeting import compile_requirements
+from ..utils import CARD_SETS, get_script_definition
 
 
 class CardDB(dict):
+	# Card attributes filter() keeps an inverted index of
+	INDEXED_ATTRIBUTES = (
+		"type", "collectible", "card_class", "race", "rarity", "cost", "spare_part"
+	)
+
 	def __init__(self):
 		self.initialized = False
+		# IDs of the cards which have not been merged yet (lazy mode)
+		self._unmerged = set()
+		self._indexes = None
+		self._filter_cache = {}
+		# Incremented whenever cards are added, to invalidate what is derived
+		# from the filtered cards (see RandomCardPicker.get_pools())
+		self.generation = 0
+
+	def __getitem__(self, id):
+		if id in self._unmerged:
+			self._unmerged.discard(id)
+			self.merge(id, super().__getitem__(id))
+		return super().__getitem__(id)
+
+	def __setitem__(self, id, card):
+		self._unmerged.discard(id)
+		self._invalidate_indexes()
+		super().__setitem__(id, card)
+
+	def __delitem__(self, id):
+		self._unmerged.discard(id)
+		self._invalidate_indexes()
+		super().__delitem__(id)
+
+	def get(self, id, default=None):
+		if id in self:
+			return self[id]
+		return default
+
+	def items(self):
+		self.merge_all()
+		return super().items()
+
+	def values(self):
+		self.merge_all()
+		return super().values()
+
+	def merge_all(self):
+		"""
+		Merge every card which has not been merged yet.
+		"""
+		for id in list(self._unmerged):
+			self[id]
 
 	@staticmethod
 	def merge(id, card, cardscript=None):
@@ -80,18 +130,62 @@ class CardDB(dict):
 
 		# Set some additional events based on the base tags...
 		if card.poisonous:
-			card.scripts.events.append(POISONOUS)
+			# Don't append, the list may belong to the card script
+			card.scripts.events = card.scripts.events + [POISONOUS]
+
+		card.target_validator = compile_requirements(card.requirements)
 
 		return card
 
-	def initialize(self):
+	def initialize(self, cache=None, cache_dir=None, lazy=None):
+		"""
+		Load and merge the card database.
+		If \a cache is True, the merged cards are restored from (or written to)
+		the on-disk cache in \a cache_dir (see fireplace.cards.cache).
+		If \a lazy is True, cards are only merged with their scripts the first
+		time they are looked up in the database.
+		If \a cache or \a lazy are None, they are enabled by setting the
+		FIREPLACE_CARD_CACHE or FIREPLACE_LAZY_CARDDB environment variables.
+		"""
+		from . import cache as card_cache
+
 		log.info("Initializing card database")
 		self.initialized = True
+		if cache is None:
+			cache = bool(os.environ.get("FIREPLACE_CARD_CACHE"))
+		if lazy is None:
+			lazy = bool(os.environ.get("FIREPLACE_LAZY_CARDDB"))
+
+		db = card_cache.load(cache_dir) if cache else None
+		if db is not None:
+			self._load(db, lazy)
+			log.info("Restored %i cards from cache", len(self))
+			return
+
 		db, xml = cardxml.load()
-		for id, card in db.items():
-			self[id] = self.merge(id, card)
+		self._load(db, lazy)
+
+		log.info("Merged %i cards", len(self) - len(self._unmerged))
 
-		log.info("Merged %i cards", len(self))
+		if cache:
+			try:
+				card_cache.save(self, cache_dir)
+			except OSError as e:
+				log.warning("Could not write card database cache: %s", e)
+
+	def _load(self, db, lazy):
+		if not lazy:
+			for id, card in db.items():
+				self[id] = self.merge(id, card)
+			return
+
+		self._invalidate_indexes()
+		for id, card in db.items():
+			super().__setitem__(id, card)
+			self._unmerged.add(id)
+		# Custom cards are registered when their card set is imported
+		for cardset in CARD_SETS:
+			import_module("fireplace.cards.%s" % (cardset))
 
 	def filter(self, **kwargs):
 		"""
@@ -105,24 +199,91 @@ class CardDB(dict):
 		\a rarity: The rarity of the card (hearthstone.enums.Rarity)
 		\a cost: The mana cost of the card
 		"""
+		return list(self.pool(**kwargs))
+
+	def pool(self, **kwargs):
+		"""
+		Same as filter(), but returns the memoized tuple of matching card IDs.
+		"""
 		if not self.initialized:
 			self.initialize()
 
-		cards = self.values()
-
 		if "type" not in kwargs:
 			kwargs["type"] = [CardType.SPELL, CardType.WEAPON, CardType.MINION]
 
+		try:
+			key = frozenset(
+				(attr, tuple(value) if isinstance(value, list) else value)
+				for attr, value in kwargs.items() if value is not None
+			)
+			ret = self._filter_cache.get(key)
+		except TypeError:
+			# Unhashable filter value, can't memoize it
+			key = ret = None
+
+		if ret is None:
+			ret = self._find(kwargs)
+			if key is not None:
+				self._filter_cache[key] = ret
+
+		return ret
+
+	def _invalidate_indexes(self):
+		self._indexes = None
+		self._filter_cache.clear()
+		self.generation += 1
+
+	def _build_indexes(self):
+		# Filter on the raw card data, it doesn't need the card scripts
+		self._positions = {}
+		self._indexes = {attr: {} for attr in self.INDEXED_ATTRIBUTES}
+		for position, card in enumerate(super().values()):
+			self._positions[card.id] = position
+			for attr, index in self._indexes.items():
+				index.setdefault(getattr(card, attr), set()).add(card.id)
+
+	def _find(self, kwargs):
+		"""
+		Evaluate the filters in \a kwargs by intersecting the matching index
+		entries, then scanning what is left for the non-indexed attributes.
+		Returns a tuple of card IDs in database order.
+		"""
+		if self._indexes is None:
+			self._build_indexes()
+
+		candidates = []
+		scans = []
 		for attr, value in kwargs.items():
-			if value is not None:
-				# What? this doesn't work?
-				# cards = __builtins__["filter"](lambda c: getattr(c, attr) == value, cards)
-				cards = [
-					card for card in cards if (isinstance(value, list) and getattr(card, attr) in value) or
-					getattr(card, attr) == value
-				]
+			if value is None:
+				continue
+			index = self._indexes.get(attr)
+			if index is None:
+				scans.append((attr, value))
+			elif isinstance(value, list):
+				match = set()
+				for v in value:
+					match |= index.get(v, set())
+				candidates.append(match)
+			else:
+				candidates.append(index.get(value, set()))
+
+		if candidates:
+			candidates.sort(key=len)
+			ids = candidates[0].intersection(*candidates[1:])
+		else:
+			ids = self._positions.keys()
+
+		cards = [super(CardDB, self).__getitem__(id) for id in ids]
+		for attr, value in scans:
+			cards = [
+				card for card in cards if (
+					isinstance(value, list) and getattr(card, attr) in value
+				) or getattr(card, attr) == value
+			]
 
-		return [card.id for card in cards]
+		ids = [card.id for card in cards]
+		ids.sort(key=self._positions.__getitem__)
+		return tuple(ids)
 
 
 # Here we import every card from every set and load the cardxml database.
@@ -131,3 +292,4 @@ class CardDB(dict):
 if "db" not in globals():
 	db = CardDB()
 	filter = db.filter
+	pool = db.pool
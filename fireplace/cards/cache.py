@@ -0,0 +1,166 @@
+"""
+On-disk cache of the merged card database
+
+Parsing CardDefs.xml is the bulk of CardDB.initialize(). The cache stores the
+card data as it is after merging (tags overridden by the card scripts included),
+keyed by the hearthstone package version and a hash of the card scripts, so that
+it is invalidated automatically whenever either of them changes.
+
+Script classes are not stored; they are attached again when the cache is loaded.
+
+To prebuild the cache:
+
+	python -m fireplace.cards.cache
+"""
+import glob
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+import pkg_resources
+from hearthstone.cardxml import CardXML
+
+from ..logging import log
+
+
+# Bump this whenever the format of the cached data changes
+CACHE_VERSION = 1
+CACHE_PREFIX = "carddb-"
+CACHE_SUFFIX = ".pickle"
+
+_cards_module = os.path.dirname(__file__)
+
+
+def get_cache_dir():
+	"""
+	Return the directory the card database cache lives in.
+	Can be overridden with the FIREPLACE_CACHE_DIR environment variable.
+	"""
+	ret = os.environ.get("FIREPLACE_CACHE_DIR")
+	if not ret:
+		base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+		ret = os.path.join(base, "fireplace")
+	return ret
+
+
+def get_cache_key():
+	"""
+	Return a key identifying the current card data and card scripts.
+	"""
+	key = hashlib.sha1()
+	key.update(str(CACHE_VERSION).encode("utf-8"))
+	key.update(pkg_resources.require("hearthstone")[0].version.encode("utf-8"))
+	scripts = glob.glob(os.path.join(_cards_module, "**", "*.py"), recursive=True)
+	for path in sorted(scripts):
+		key.update(os.path.relpath(path, _cards_module).encode("utf-8"))
+		with open(path, "rb") as f:
+			key.update(f.read())
+	return key.hexdigest()
+
+
+def get_cache_path(cache_dir=None):
+	if cache_dir is None:
+		cache_dir = get_cache_dir()
+	return os.path.join(cache_dir, CACHE_PREFIX + get_cache_key() + CACHE_SUFFIX)
+
+
+def load(cache_dir=None):
+	"""
+	Load the cached card data from \a cache_dir.
+	Returns a dict of card id -> CardXML, or None if there is no valid cache.
+	"""
+	path = get_cache_path(cache_dir)
+	if not os.path.exists(path):
+		log.info("No card database cache at %r", path)
+		return None
+
+	try:
+		with open(path, "rb") as f:
+			data = pickle.load(f)
+	except Exception as e:
+		log.warning("Could not load card database cache %r: %s", path, e)
+		return None
+
+	ret = {}
+	for id, state in data.items():
+		card = CardXML.__new__(CardXML)
+		card.__dict__.update(state)
+		ret[id] = card
+
+	log.info("Loaded %i cards from %r", len(ret), path)
+	return ret
+
+
+def save(db, cache_dir=None):
+	"""
+	Write the merged cards in \a db to the cache in \a cache_dir.
+	Stale caches in the same directory are removed.
+	Returns the path of the cache file.
+	"""
+	path = get_cache_path(cache_dir)
+	cache_dir = os.path.dirname(path)
+	os.makedirs(cache_dir, exist_ok=True)
+
+	data = {}
+	for id, card in db.items():
+		state = card.__dict__.copy()
+		# Script classes and target validators are generated on merge and
+		# cannot be pickled
+		state.pop("scripts", None)
+		state.pop("target_validator", None)
+		data[id] = state
+
+	# Write to a temporary file first so that concurrent workers never
+	# see a partially written cache.
+	fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=CACHE_SUFFIX + ".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.chmod(tmp_path, 0o644)
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.unlink(tmp_path)
+		raise
+
+	clear(cache_dir, keep=path)
+	log.info("Wrote %i cards to %r", len(data), path)
+	return path
+
+
+def clear(cache_dir=None, keep=None):
+	"""
+	Remove all card database caches from \a cache_dir, except \a keep.
+	"""
+	if cache_dir is None:
+		cache_dir = get_cache_dir()
+	for path in glob.glob(os.path.join(cache_dir, CACHE_PREFIX + "*" + CACHE_SUFFIX)):
+		if path != keep:
+			log.info("Removing stale card database cache %r", path)
+			os.unlink(path)
+
+
+def main():
+	arguments = ArgumentParser(prog="fireplace.cards.cache")
+	arguments.add_argument(
+		"--cache-dir", default=None, help="defaults to %s" % (get_cache_dir())
+	)
+	arguments.add_argument("--clear", action="store_true", help="remove the cache and exit")
+	args = arguments.parse_args(sys.argv[1:])
+
+	if args.clear:
+		clear(args.cache_dir)
+		return 0
+
+	from . import db
+	db.initialize(cache=False)
+	path = save(db, args.cache_dir)
+	print("Card database cache written to %s" % (path))
+
+	return 0
+
+
+if __name__ == "__main__":
+	exit(main())
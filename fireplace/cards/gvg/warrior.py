@@ -55,7 +55,7 @@ class GVG_050:
 			live_targets = [t for t in targets if t.health > t.min_health]
 			if live_targets != targets:
 				break
-			yield Hit(random.choice(targets), 1)
+			yield Hit(self.game.random.choice(targets), 1)
 
 
 class GVG_052:
@@ -1,5 +1,3 @@
-import random
-
 from hearthstone.enums import CardClass, CardType, GameTag, Race, Rarity
 
 from ..actions import *
@@ -17,6 +17,10 @@ class Evaluator:
 		self._else = None
 		self._neg = False
 
+	def __deepcopy__(self, memo):
+		# Evaluators are immutable, and shared between copies of a game
+		return self
+
 	def __repr__(self):
 		return "%s(%r)" % (self.__class__.__name__, self.selector)
 
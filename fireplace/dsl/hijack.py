@@ -1,12 +1,16 @@
 from contextlib import contextmanager
 
-from .selector import Selector
+from .selector import Selector, SetOpSelector
 
 
 class HijackedSelector(Selector):
 	def __init__(self, *a, **kw):
 		raise NotImplementedError
 
+	@property
+	def zones(self):
+		return self._hijack_.zones
+
 	def eval(self, entities, source):
 		return self._hijack_.eval(entities, source)
 
@@ -16,6 +20,7 @@ def hijack(victim, replace):
 		victim._truth_ = victim.__class__
 	victim.__class__ = HijackedSelector
 	victim._hijack_ = replace
+	SetOpSelector.generation += 1
 
 
 def unhijack(victim):
@@ -23,6 +28,7 @@ def unhijack(victim):
 		victim.__class__ = victim._truth_
 	except AttributeError as e:
 		raise ValueError("not a hijacked selector") from e
+	SetOpSelector.generation += 1
 
 
 @contextmanager
@@ -35,3 +41,4 @@ def hijacked(victim, replace):
 		yield
 	finally:
 		victim.__class__ = prev
+		SetOpSelector.generation += 1
@@ -1,12 +1,15 @@
 import copy
 import operator
-import random
 from abc import ABCMeta, abstractmethod
 
 from .evaluator import Evaluator
 
 
 class LazyValue(metaclass=ABCMeta):
+	def __deepcopy__(self, memo):
+		# Lazy values are immutable, and shared between copies of a game
+		return self
+
 	@abstractmethod
 	def evaluate(self, source):
 		pass
@@ -144,4 +147,4 @@ class RandomNumber(LazyNum):
 		return "%s(%r)" % (self.__class__.__name__, self.choices)
 
 	def evaluate(self, source):
-		return self.num(random.choice(self.choices))
+		return self.num(source.game.random.choice(self.choices))
@@ -1,4 +1,3 @@
-import random
 from copy import copy, deepcopy
 
 from hearthstone.enums import CardType, Race, Rarity
@@ -18,6 +17,9 @@ class RandomCardPicker(LazyValue):
 		self.weightedfilters = []
 		self.filters = filters
 		self.count = 1
+		# (card database generation, card pools of the filter sets), cached if
+		# none of the filters are lazy
+		self._pools = None
 
 	def __repr__(self):
 		return "%s(%r)" % (self.__class__.__name__, self.filters)
@@ -30,6 +32,7 @@ class RandomCardPicker(LazyValue):
 		ret.filters = deepcopy(self.filters, memo)
 		ret.weightedfilters = deepcopy(self.weightedfilters, memo)
 		ret.count = self.count
+		ret._pools = None
 
 		return ret
 
@@ -40,6 +43,8 @@ class RandomCardPicker(LazyValue):
 	def __mul__(self, other):
 		ret = deepcopy(self)
 		ret.count = other
+		# The filters are the same, so are the pools
+		ret._pools = self._pools
 		return ret
 
 	# add a filter set
@@ -53,17 +58,43 @@ class RandomCardPicker(LazyValue):
 		"""
 		Generate a card pool with all cards matching specified filters
 		"""
-		if not filters:
-			new_filters = self.filters.copy()
-		else:
-			new_filters = filters.copy()
+		return list(self._find_pool(source, filters or self.filters))
 
+	def _find_pool(self, source, filters):
+		new_filters = filters.copy()
 		for k, v in new_filters.items():
 			if isinstance(v, LazyValue):
 				new_filters[k] = v.evaluate(source)
 
 		from .. import cards
-		return cards.filter(**new_filters)
+		return cards.pool(**new_filters)
+
+	def get_pools(self, source):
+		"""
+		Return the card pools for each set of filters.
+		Filters which don't contain any LazyValue are only resolved again
+		when the card database changes.
+		"""
+		from .. import cards
+		if self._pools is not None and self._pools[0] == cards.db.generation:
+			return self._pools[1]
+
+		if not self.weightedfilters:
+			# Use global filters if no weighted filter sets given
+			filter_sets = [self.filters]
+		else:
+			# Otherwise find cards for each set of filters
+			# add the global filters to each set of filters
+			filter_sets = [{**x, **self.filters} for x in self.weightedfilters]
+
+		pools = [self._find_pool(source, filters) for filters in filter_sets]
+		for filters in filter_sets:
+			if any(isinstance(v, LazyValue) for v in filters.values()):
+				break
+		else:
+			# The database may have been initialized while finding the pools
+			self._pools = (cards.db.generation, pools)
+		return pools
 
 	def evaluate(self, source, cards=None) -> str:
 		"""
@@ -74,20 +105,14 @@ class RandomCardPicker(LazyValue):
 
 		if cards:
 			# Use specific card list if given
-			self.weights = [1]
-			card_sets = [list(cards)]
-		elif not self.weightedfilters:
-			# Use global filters if no weighted filter sets given
-			self.weights = [1]
-			card_sets = [self.find_cards(source)]
+			weights = [1]
+			card_sets = [cards]
 		else:
-			# Otherwise find cards for each set of filters
-			# add the global filters to each set of filters
-			wf = [{**x, **self.filters} for x in self.weightedfilters]
-			card_sets = [self.find_cards(source, **x) for x in wf]
+			weights = self.weights if self.weightedfilters else [1]
+			card_sets = self.get_pools(source)
 
 		# get weighted sample of card pools
-		return weighted_card_choice(source, self.weights, card_sets, self.count)
+		return weighted_card_choice(source, weights, card_sets, self.count)
 
 
 RandomCard = lambda **kw: RandomCardPicker(**kw)
@@ -1,8 +1,7 @@
 import operator
-import random
 from abc import ABCMeta, abstractmethod
 from enum import IntEnum
-from typing import Any, Callable, Iterable, List, Optional, Set, Union
+from typing import Any, Callable, Iterable, List, Optional, Union
 
 from hearthstone.enums import CardClass, CardType, GameTag, Race, Rarity, Zone
 
@@ -14,6 +13,10 @@ from .lazynum import Attr, LazyValue, OpAttr
 # Type aliases
 SelectorLike = Union["Selector", LazyValue]
 BinaryOp = Callable[[Any, Any], bool]
+Predicate = Callable[[BaseEntity], bool]
+
+# The zones of a selector which can select entities in any zone
+ANY_ZONE = frozenset(Zone)
 
 
 class Selector:
@@ -26,10 +29,38 @@ class Selector:
 
 	Set operations preserve ordering (necessary for cards like Echo of
 	Medivh, where ordering matters)
+
+	Selectors are volatile if their result may depend on more than the
+	zones, board positions and controllers of the entities and their
+	card data (see AuraTracker).
+
+	The zones of a selector are the zones the entities it selects can be
+	in, or None if its result may depend on which other entities it is
+	evaluated against. When evaluated against the whole game, selectors
+	with known zones only go through the entities of these zones.
 	"""
+	volatile = True
+	zones = None
+
+	def __deepcopy__(self, memo):
+		# Selectors are immutable, and shared between copies of a game
+		return self
+
 	def eval(self, entities: List[BaseEntity], source: BaseEntity) -> List[BaseEntity]:
 		return entities
 
+	def compile(self) -> Callable[[List[BaseEntity], BaseEntity], Predicate]:
+		"""
+		Returns a function of (entities, source) returning a predicate which
+		is true for the entities in `eval(entities, source)`.
+		Selectors which test entities one by one override this so that
+		SetOpSelector can evaluate them in a single pass.
+		"""
+		def prepare(entities, source):
+			entity_ids = set(e.entity_id for e in self.eval(entities, source) if e)
+			return lambda e: e.entity_id in entity_ids
+		return prepare
+
 	def __add__(self, other: SelectorLike) -> "Selector":
 		return SetOpSelector(operator.and_, self, other)
 
@@ -65,12 +96,23 @@ class Selector:
 class EnumSelector(Selector):
 	def __init__(self, tag_enum=None):
 		self.tag_enum = tag_enum
+		# Tags can be changed by buffs, everything else comes from the card data
+		self.volatile = not isinstance(tag_enum, (CardClass, CardType, Race, Rarity, Zone))
+		self.zones = frozenset((tag_enum, )) if isinstance(tag_enum, Zone) else ANY_ZONE
 
 	def eval(self, entities, source):
 		if not self.tag_enum or not hasattr(self.tag_enum, "test"):
 			raise RuntimeError("Unsupported enum type {}".format(str(self.tag_enum)))
+		if entities is source.game and isinstance(self.tag_enum, Zone):
+			entities = source.game.zone_entities(self.zones)
 		return [e for e in entities if self.tag_enum.test(e, source)]
 
+	def compile(self):
+		if not self.tag_enum or not hasattr(self.tag_enum, "test"):
+			return super().compile()
+		test = self.tag_enum.test
+		return lambda entities, source: lambda e: test(e, source)
+
 	def __repr__(self):
 		return "<%s>" % (self.tag_enum.name)
 
@@ -135,11 +177,20 @@ NUM_ATTACKS_THIS_TURN = AttrValue(GameTag.NUM_ATTACKS_THIS_TURN)
 class ComparisonSelector(Selector):
 	"""A ComparisonSelector compares values of entities to
 	other values. Lazy values are evaluated at selector runtime."""
+	zones = ANY_ZONE
+
 	def __init__(self, op: BinaryOp, left: SelectorEntityValue, right):
 		self.op = op
 		self.left = left
 		self.right = right
 
+	@property
+	def volatile(self):
+		if isinstance(self.right, Controller) and isinstance(self.left, AttrValue):
+			if self.left.tag == GameTag.CONTROLLER:
+				return self.right.child is not None and self.right.child.volatile
+		return True
+
 	def eval(self, entities, source):
 		right_value = (
 			self.right.evaluate(source) if isinstance(self.right, LazyValue)
@@ -150,6 +201,14 @@ class ComparisonSelector(Selector):
 			if self.op(self.left.value(e, source), right_value)
 		]
 
+	def compile(self):
+		op, value, right = self.op, self.left.value, self.right
+
+		def prepare(entities, source):
+			right_value = right.evaluate(source) if isinstance(right, LazyValue) else right
+			return lambda e: op(value(e, source), right_value)
+		return prepare
+
 	def __repr__(self):
 		if self.op.__name__ == "eq":
 			infix = "=="
@@ -169,6 +228,8 @@ class ComparisonSelector(Selector):
 
 
 class FilterSelector(Selector):
+	zones = ANY_ZONE
+
 	def __init__(self, func: Callable[[BaseEntity, BaseEntity], bool]):
 		"""
 		func(entity, source) returns true iff the entity
@@ -179,6 +240,10 @@ class FilterSelector(Selector):
 	def eval(self, entities, source):
 		return [e for e in entities if self.func(e, source)]
 
+	def compile(self):
+		func = self.func
+		return lambda entities, source: lambda e: func(e, source)
+
 
 class FuncSelector(Selector):
 	def __init__(self, func: Callable[[List[BaseEntity], BaseEntity], List[BaseEntity]]):
@@ -205,26 +270,103 @@ class SliceSelector(Selector):
 
 
 class SetOpSelector(Selector):
+	"""
+	Set operations are compiled (see Selector.compile()) on first use:
+	chains of the same operation are flattened and the selectors testing
+	entities one by one are combined into a single predicate, so that
+	the entities are only filtered once.
+	"""
+	# Bumped whenever a selector changes class (see dsl.hijack), which
+	# drops all the compiled set operations.
+	generation = 0
+
 	def __init__(self, op: Callable, left: Selector, right: SelectorLike):
 		if isinstance(right, LazyValue):
 			right = LazyValueSelector(right)
 		self.op = op
 		self.left = left
 		self.right = right
-
-	@staticmethod
-	def _entity_id_set(entities: Iterable[BaseEntity]) -> Set[BaseEntity]:
-		return set(e.entity_id for e in entities if e)
+		self._compiled = None
+
+	@property
+	def volatile(self):
+		return self.left.volatile or self.right.volatile
+
+	@property
+	def zones(self):
+		left, right = self.left.zones, self.right.zones
+		if left is None or right is None:
+			return None
+		if self.op is operator.and_:
+			return left & right
+		elif self.op is operator.or_:
+			return left | right
+		elif self.op is operator.sub:
+			return left
+		return None
+
+	def _operands(self) -> Iterable[Selector]:
+		"""
+		Yields the operands of the chain of set operations the selector
+		is part of, in order. Eg. (a + b) + c yields a, b and c.
+		"""
+		for child in (self.left, self.right):
+			if isinstance(child, SetOpSelector) and child.op is self.op:
+				yield from child._operands()
+			else:
+				yield child
+
+	def compile(self):
+		if self.op is operator.sub:
+			prepare_left = self.left.compile()
+			prepare_right = self.right.compile()
+
+			def prepare(entities, source):
+				left = prepare_left(entities, source)
+				right = prepare_right(entities, source)
+				return lambda e: left(e) and not right(e)
+			return prepare
+
+		if self.op is not operator.and_ and self.op is not operator.or_:
+			return super().compile()
+
+		operands = [selector.compile() for selector in self._operands()]
+
+		def intersection(predicates):
+			def test(e):
+				for predicate in predicates:
+					if not predicate(e):
+						return False
+				return True
+			return test
+
+		def union(predicates):
+			def test(e):
+				for predicate in predicates:
+					if predicate(e):
+						return True
+				return False
+			return test
+
+		combine = intersection if self.op is operator.and_ else union
+
+		def prepare(entities, source):
+			return combine([operand(entities, source) for operand in operands])
+		return prepare
 
 	def eval(self, entities, source):
-		left_children = self.left.eval(entities, source)
-		right_children = self.right.eval(entities, source)
-		result_entity_ids = self.op(
-			self._entity_id_set(left_children),
-			self._entity_id_set(right_children)
-		)
+		compiled = self._compiled
+		if compiled is None or compiled[0] != SetOpSelector.generation:
+			zones = self.zones
+			if zones == ANY_ZONE:
+				zones = None
+			compiled = self._compiled = (SetOpSelector.generation, self.compile(), zones)
+		_, prepare, zones = compiled
+		if zones is not None and entities is source.game:
+			entities = source.game.zone_entities(zones)
+		test = prepare(entities, source)
 		# Preserve input ordering and multiplicity
-		return [e for e in entities if e.entity_id in result_entity_ids]
+		return [e for e in entities if test(e)]
 
 	def __repr__(self):
 		name = self.op.__name__
@@ -241,20 +383,29 @@ class SetOpSelector(Selector):
 
 
 SELF = FuncSelector(lambda _, source: [source])
+SELF.volatile = False
+SELF.zones = ANY_ZONE
 OWNER = FuncSelector(
 	lambda entities, source: [source.owner] if hasattr(source, "owner") else []
 )
+OWNER.volatile = False
+OWNER.zones = ANY_ZONE
 
 
 def LazyValueSelector(value):
-	return FuncSelector(lambda entities, source: [value.evaluate(source)])
+	ret = FuncSelector(lambda entities, source: [value.evaluate(source)])
+	ret.zones = ANY_ZONE
+	return ret
 
 
 def ID(id):
-	return FilterSelector(lambda entity, source: getattr(entity, "id", None) == id)
+	ret = FilterSelector(lambda entity, source: getattr(entity, "id", None) == id)
+	ret.volatile = False
+	return ret
 
 
 TARGET = FuncSelector(lambda entities, source: [source.target])
+TARGET.zones = ANY_ZONE
 
 
 class BoardPositionSelector(Selector):
@@ -268,6 +419,10 @@ class BoardPositionSelector(Selector):
 		self.child = child
 		self.direction = direction
 
+	@property
+	def volatile(self):
+		return self.child.volatile
+
 	def eval(self, entities, source):
 		result = []
 		for e in self.child.eval(entities, source):
@@ -306,7 +461,7 @@ class RandomSelector(Selector):
 
 	def eval(self, entities, source):
 		child_entities = self.child.eval(entities, source)
-		return random.sample(child_entities, min(len(child_entities), self.times))
+		return source.game.random.sample(child_entities, min(len(child_entities), self.times))
 
 	def __mul__(self, other):
 		return RandomSelector(self.child, self.times * other)
@@ -1,10 +1,184 @@
 import uuid
+from copy import deepcopy
+from enum import Enum
+from weakref import WeakValueDictionary
 
 from hearthstone.enums import CardType
 
 from . import logging
 
 
+# Attributes which never change once an entity is created. Entities waiting
+# for their first use (see FirstUseEntity) have them before their first use.
+SHARED_ATTRIBUTES = ("data", "entity_id", "id", "type", "uuid")
+
+# Most of the state of an entity is made of tags, which do not need deepcopy()
+_IMMUTABLE_TYPES = {bool, int, float, str, type(None)}
+
+# Attributes which are reset rather than copied: caches, and the journal and
+# the branches of the game (see Game.checkpoint() and Game.branch())
+_RESET_ATTRIBUTES = {
+	"_attr_cache": dict, "_flag_cache": dict, "_views": dict, "journal": lambda: None,
+	"_branches": WeakValueDictionary,
+}
+
+
+def copy_state(state, memo):
+	"""
+	Returns a copy of \a state, the __dict__ of an entity, made with the
+	deepcopy() memo \a memo. Card data is shared with the copy.
+	"""
+	ret = {}
+	for key, value in state.items():
+		if key == "_journal":
+			# Entities waiting to be recorded by the journal (see JournaledEntity)
+			continue
+		if key in _RESET_ATTRIBUTES:
+			value = _RESET_ATTRIBUTES[key]()
+		elif type(value) not in _IMMUTABLE_TYPES and key not in ("data", "uuid"):
+			if isinstance(value, Enum):
+				_IMMUTABLE_TYPES.add(type(value))
+			else:
+				value = deepcopy(value, memo)
+		ret[key] = value
+	return ret
+
+
+class FirstUseEntity:
+	"""
+	Mixin of entity classes which call `_first_use()` the first time one
+	of their instances is used in any way, other than reading one of its
+	SHARED_ATTRIBUTES. `_first_use()` turns the instance back into an
+	instance of its `entity_class`.
+	"""
+	def __getattribute__(self, name):
+		if name in SHARED_ATTRIBUTES:
+			state = object.__getattribute__(self, "__dict__")
+			if name in state:
+				return state[name]
+		elif name == "__class__":
+			# Used by isinstance()
+			return type(self)
+		type(self)._first_use(self)
+		return getattr(self, name)
+
+	def __setattr__(self, name, value):
+		type(self)._first_use(self)
+		setattr(self, name, value)
+
+	def __delattr__(self, name):
+		type(self)._first_use(self)
+		delattr(self, name)
+
+
+_first_use_classes = {}
+
+
+def entity_class(entity):
+	"""
+	Returns the class of \a entity, ignoring any FirstUseEntity mixin
+	"""
+	cls = type(entity)
+	return cls.__dict__.get("entity_class", cls)
+
+
+def set_first_use(entity, mixin):
+	"""
+	Turns \a entity into an instance of the \a mixin subclass of its class
+	"""
+	cls = entity_class(entity)
+	ret = _first_use_classes.get((mixin, cls))
+	if ret is None:
+		ret = type(cls.__name__, (mixin, cls), {
+			"__module__": cls.__module__, "__qualname__": cls.__qualname__, "entity_class": cls
+		})
+		_first_use_classes[mixin, cls] = ret
+	object.__setattr__(entity, "__class__", ret)
+
+
+def _materialize(entity):
+	"""
+	Copy the state of a branched entity from its source.
+	"""
+	state = object.__getattribute__(entity, "__dict__")
+	source, memo = state.pop("_branch_source")
+	object.__setattr__(entity, "__class__", entity_class(entity))
+	source_state = object.__getattribute__(source, "__dict__")
+	if "_branch_source" in source_state:
+		_materialize(source)
+	state.update(copy_state(source_state, memo))
+
+
+class BranchedEntity(FirstUseEntity):
+	"""
+	A copy-on-first-use copy of an entity, which copies the state of the
+	entity the first time it is used (see Game.branch()).
+	"""
+	_first_use = _materialize
+
+
+def branch_entity(entity, memo):
+	"""
+	Returns a copy-on-first-use copy of \a entity (see BranchedEntity).
+	\a memo is the deepcopy() memo the state is copied with.
+	"""
+	ret = object.__new__(entity_class(entity))
+	set_first_use(ret, BranchedEntity)
+	state = object.__getattribute__(ret, "__dict__")
+	source_state = object.__getattribute__(entity, "__dict__")
+	for key in SHARED_ATTRIBUTES:
+		if key in source_state:
+			state[key] = source_state[key]
+	state["_branch_source"] = (entity, memo)
+	memo[id(entity)] = ret
+	return ret
+
+
+class TrackedEntity:
+	"""
+	Mixin of entity classes which record the names of the attributes set on
+	their instances with the manager of their game (see
+	GameManager.track_changes()).
+	"""
+	def __setattr__(self, name, value):
+		object.__setattr__(self, name, value)
+		record_change(self, name)
+
+	def __delattr__(self, name):
+		object.__delattr__(self, name)
+		record_change(self, name)
+
+
+def record_change(entity, name):
+	"""
+	Records that the attribute \a name of \a entity changed, or all of them
+	for "__dict__".
+	"""
+	entity.game.manager.record_change(entity, name)
+
+
+_tracked_classes = {}
+
+
+def track_entity(entity):
+	"""
+	Turns \a entity into an instance of the TrackedEntity subclass of its
+	class. The entity is recorded as entirely changed.
+	"""
+	if isinstance(entity, FirstUseEntity):
+		type(entity)._first_use(entity)
+	cls = type(entity)
+	if not issubclass(cls, TrackedEntity):
+		ret = _tracked_classes.get(cls)
+		if ret is None:
+			ret = type(cls.__name__, (TrackedEntity, cls), {
+				"__module__": cls.__module__, "__qualname__": cls.__qualname__
+			})
+			_tracked_classes[cls] = ret
+		object.__setattr__(entity, "__class__", ret)
+	record_change(entity, "__dict__")
+
+
 class BaseEntity(object):
 	base_events = []
 	logger = logging.log
@@ -25,6 +199,18 @@ class BaseEntity(object):
 	def __int__(self):
 		return self.entity_id
 
+	def __deepcopy__(self, memo):
+		journal = memo.get("journal")
+		if journal is not None:
+			# Recording the state of an entity (see Journal.record())
+			journal.track(self)
+			return self
+		# Card data and scripts are shared with the copy (see Game.clone())
+		ret = self.__class__.__new__(self.__class__)
+		memo[id(self)] = ret
+		ret.__dict__.update(copy_state(self.__dict__, memo))
+		return ret
+
 	@property
 	def is_card(self):
 		"""
@@ -36,13 +222,28 @@ class BaseEntity(object):
 	def events(self):
 		return self.base_events + self._events
 
+	@property
+	def potential_events(self):
+		"""
+		All the event listeners the entity may have, in any zone
+		"""
+		return self.base_events + self._events
+
 	@property
 	def update_scripts(self):
 		if self.data and not self.ignore_scripts:
 			yield from self.data.scripts.update
 
 	def log(self, message, *args):
-		self.logger.info(message, *args)
+		if not self.logger.disabled:
+			self.logger.info(message, *args)
+
+	def clear_attr_cache(self):
+		"""
+		Clear the cached values of the attributes of the entity and,
+		for buffs, of their owner.
+		"""
+		pass
 
 	def get_actions(self, name):
 		actions = getattr(self.data.scripts, name)
@@ -73,6 +274,7 @@ class BaseEntity(object):
 		ret = source.game.trigger(self, actions, args)
 		if event.once:
 			self._events.remove(event)
+			self.game.event_registry.update(self)
 
 		return ret
 
@@ -91,16 +293,40 @@ class BuffableEntity(BaseEntity):
 		super().__init__()
 		self.buffs = []
 		self.slots = []
+		self.clear_attr_cache()
 
 	def _getattr(self, attr, i):
 		i += getattr(self, "_" + attr, 0)
-		for buff in self.buffs:
-			i = buff._getattr(attr, i)
-		for slot in self.slots:
-			i = slot._getattr(attr, i)
+		modifier = self._attr_cache.get(attr)
+		if modifier is not None:
+			i += modifier
+		else:
+			ret = i
+			cacheable = True
+			for buff in self.buffs:
+				ret = buff._getattr(attr, ret)
+				if hasattr(buff.data.scripts, attr):
+					cacheable = False
+			for slot in self.slots:
+				ret = slot._getattr(attr, ret)
+				if callable(getattr(slot, attr, 0)):
+					cacheable = False
+			if cacheable:
+				# Buffs and slots without scripts simply add up
+				self._attr_cache[attr] = ret - i
+			i = ret
 		if self.ignore_scripts:
 			return i
-		return getattr(self.data.scripts, attr, lambda s, x: x)(self, i)
+		script = getattr(self.data.scripts, attr, None)
+		if script is None:
+			return i
+		return script(self, i)
+
+	def clear_attr_cache(self):
+		# Modifiers of int attributes by buffs and slots
+		self._attr_cache = {}
+		# Values of boolean attributes given by buffs and slots
+		self._flag_cache = {}
 
 	def clear_buffs(self):
 		if self.buffs:
@@ -113,27 +339,71 @@ class Entity(BuffableEntity):
 	pass
 
 
+def depends_on(*names, zones=None):
+	"""
+	Declares what the value of a property depends on, so that its changes
+	can be tracked (see GameManager.track_changes()). Each name is one of:
+	- "<attr>": the attribute <attr> of the entity
+	- "game.<attr>": the attribute <attr> of the game
+	- "buffs": the buffs and slots of the entity
+	- "script.<attr>": the <attr> card script of the entity, if it has one
+	Properties without declared dependencies may depend on anything.
+	If \a zones is given, the property only depends on the game while the
+	entity is in one of \a zones.
+	"""
+	def decorator(func):
+		func.depends_on = names
+		func.depends_on_zones = frozenset(zones) if zones is not None else None
+		return func
+	return decorator
+
+
 def slot_property(attr, f=any):
 	@property
 	def func(self):
-		return f(getattr(slot, attr, False) for slot in self.slots)
+		try:
+			return self._flag_cache[attr]
+		except KeyError:
+			ret = self._flag_cache[attr] = f(getattr(slot, attr, False) for slot in self.slots)
+			return ret
+	depends_on("_flag_cache")(func.fget)
 	return func
 
 
+def _buffed(entity, attr):
+	if not entity.buffs and not entity.slots:
+		return False
+	try:
+		return entity._flag_cache[attr]
+	except KeyError:
+		pass
+	ret = any(getattr(buff, attr, False) for buff in entity.buffs)
+	if not ret:
+		ret = any(getattr(slot, attr, False) for slot in entity.slots)
+	if not any(hasattr(buff.data.scripts, attr) for buff in entity.buffs):
+		entity._flag_cache[attr] = ret
+	return ret
+
+
 def boolean_property(attr):
+	private = "_" + attr
+
 	@property
 	def func(self):
-		return (
-			getattr(self, "_" + attr, False) or
-			any(getattr(buff, attr, False) for buff in self.buffs) or
-			any(getattr(slot, attr, False) for slot in self.slots) or
-			getattr(self.data.scripts, attr, lambda s, x: x)(self, False)
-		)
+		ret = getattr(self, private, False) or _buffed(self, attr)
+		if ret:
+			return ret
+		script = getattr(self.data.scripts, attr, None)
+		if script is None:
+			return ret
+		return script(self, False)
 
 	@func.setter
 	def func(self, value):
-		setattr(self, "_" + attr, value)
+		setattr(self, private, value)
+		self.clear_attr_cache()
 
+	depends_on(private, "buffs", "script." + attr)(func.fget)
 	return func
 
 
@@ -146,5 +416,7 @@ def int_property(attr):
 	@func.setter
 	def func(self, value):
 		setattr(self, "_" + attr, value)
+		self.clear_attr_cache()
 
+	depends_on("_" + attr, "buffs", "script." + attr)(func.fget)
 	return func
@@ -1,16 +1,55 @@
+import os
 import random
 import time
 from calendar import timegm
+from contextlib import contextmanager
+from copy import deepcopy
 from itertools import chain
+from weakref import WeakValueDictionary
 
 from hearthstone.enums import BlockType, CardType, PlayState, State, Step, Zone
 
-from .actions import Attack, BeginTurn, Death, EndTurn, EventListener, Play
+from .actions import Attack, BeginTurn, Death, EndTurn, EventListener, EventRegistry, Play
+from .aura import AuraTracker
 from .card import THE_COIN
-from .entity import Entity
+from .entity import BranchedEntity, Entity, branch_entity
 from .exceptions import GameOver
+from .journal import Journal
 from .managers import GameManager
-from .utils import CardList
+from .utils import CardList, IndexedCardList, cached_view
+
+
+def _index(cards, entity):
+	# Like CardList.index(), compares by identity, but returns None rather than
+	# raising and also works on plain lists (eg. buffs), which compare by card id
+	if isinstance(cards, IndexedCardList):
+		return cards.index(entity) if entity in cards else None
+	for i, card in enumerate(cards):
+		if card is entity:
+			return i
+	return None
+
+
+# The collections the game iterates over, in order, and the zones their entities
+# can be in. The game, the players and everything in play are in `entities`.
+ZONE_COLLECTIONS = (
+	(frozenset((Zone.INVALID, Zone.PLAY, Zone.SECRET, Zone.REMOVEDFROMGAME)), "entities"),
+	(frozenset((Zone.HAND, )), "hands"),
+	(frozenset((Zone.DECK, )), "decks"),
+	(frozenset((Zone.GRAVEYARD, )), "graveyard"),
+	(frozenset((Zone.SETASIDE, )), "setaside"),
+)
+
+
+class GameRandom(random.Random):
+	"""
+	The random number generator of a game (see BaseGame.random)
+	"""
+	def __deepcopy__(self, memo):
+		# Much faster than copying the state through __reduce__()
+		ret = self.__class__.__new__(self.__class__)
+		ret.setstate(self.getstate())
+		return ret
 
 
 class BaseGame(Entity):
@@ -18,10 +57,21 @@ class BaseGame(Entity):
 	MAX_MINIONS_ON_FIELD = 7
 	Manager = GameManager
 
-	def __init__(self, players):
+	def __init__(self, players, seed=None):
 		self.data = None
 		self.players = players
 		super().__init__()
+		if seed is None:
+			# Seeded from the random module, so that random.seed() still makes
+			# games reproducible
+			seed = random.getrandbits(64)
+		# All the randomness of the game comes from its own generator, so that
+		# the game can be replayed from its seed whatever else happens in the
+		# process
+		self.seed = seed
+		self.random = GameRandom(seed)
+		self.event_registry = EventRegistry(self)
+		self.event_registry.register(self, self.potential_events)
 		for player in players:
 			player.game = self
 		self.state = State.INVALID
@@ -30,9 +80,16 @@ class BaseGame(Entity):
 		self.turn = 0
 		self.current_player = None
 		self.tick = 0
-		self.active_aura_buffs = CardList()
-		self.setaside = CardList()
+		self.active_aura_buffs = IndexedCardList()
+		self.entities_version = 0
+		self._views = {}
+		self.aura_tracker = AuraTracker(self, debug=bool(os.environ.get("FIREPLACE_DEBUG_AURAS")))
+		self.setaside = IndexedCardList()
 		self._action_stack = 0
+		self._targets_cache = None
+		# The branches of the game, by id (see branch())
+		self._branches = WeakValueDictionary()
+		self.journal = None
 
 	def __repr__(self):
 		return "%s(players=%r)" % (self.__class__.__name__, self.players)
@@ -44,37 +101,202 @@ class BaseGame(Entity):
 	def game(self):
 		return self
 
-	@property
+	def clone(self):
+		"""
+		Returns a copy of the game, which can be played independently.
+		Only the state of the game is copied: card data, card scripts and
+		their actions are shared with the original. The observers of the
+		game (eg. Kettle) are not copied.
+		"""
+		memo = {id(self.manager.observers): []}
+		return deepcopy(self, memo)
+
+	def branch(self):
+		"""
+		Returns a copy-on-first-use copy of the game, which can be played
+		independently like a clone(). The entities of the branch copy their
+		state from the game the first time they are used, so that branching
+		only costs as much as what the branch actually uses.
+		The branches of a game are copied entirely before the game changes
+		through an action, a zone change or rollback() (see
+		materialize_branches()). Changes made otherwise, eg. setting a tag
+		directly, must wait until the branches are no longer used.
+		"""
+		memo = {id(self.manager.observers): []}
+		for entity in self:
+			branch_entity(entity, memo)
+		ret = memo[id(self)]
+		self._branches[id(ret)] = ret
+		return ret
+
+	def materialize_branches(self):
+		"""
+		Copies the state of the game into the entities of its branches which
+		have not copied it yet, so that the branches no longer depend on it.
+		"""
+		branches = list(self._branches.values())
+		self._branches.clear()
+		for branch in branches:
+			for entity in list(branch):
+				if isinstance(entity, BranchedEntity):
+					BranchedEntity._first_use(entity)
+
+	def checkpoint(self):
+		"""
+		Starts journaling the changes made to the game, so that they can be
+		undone with rollback() (see Journal). Checkpoints can be nested.
+		"""
+		if self.journal is None:
+			self.journal = Journal(self)
+		self.journal.checkpoint()
+
+	def rollback(self):
+		"""
+		Restores the game to the state it was in at the last checkpoint(),
+		and removes the checkpoint.
+		"""
+		if not self.journal:
+			raise ValueError("No checkpoint to roll back to")
+		if self._branches:
+			self.materialize_branches()
+		self.journal.rollback()
+
+	@contextmanager
+	def cache_targets(self):
+		"""
+		Memoizes the play targets of cards (see PlayableCard.play_targets)
+		while the block runs. The block must not change the game.
+		"""
+		if self._targets_cache is not None:
+			yield
+			return
+		self._targets_cache = {}
+		try:
+			yield
+		finally:
+			self._targets_cache = None
+
+	def zone_entities(self, zones):
+		"""
+		Returns the entities of the game which can be in one of \a zones,
+		in the order the game iterates over them. Used to narrow down the
+		entities selectors are evaluated against (see Selector.zones).
+		"""
+		collections = []
+		for collection_zones, name in ZONE_COLLECTIONS:
+			if not zones.isdisjoint(collection_zones):
+				collections.append(getattr(self, name))
+		if len(collections) == 1:
+			return collections[0]
+		return CardList(chain(*collections))
+
+	def entities_changed(self):
+		"""
+		Invalidate the cached entity views and auras. Called whenever an
+		entity changes zone or controller, or a zone is reordered.
+		"""
+		if self._branches:
+			self.materialize_branches()
+		self.entities_version += 1
+		self.aura_tracker.invalidate()
+
+	@cached_view
 	def board(self):
-		return CardList(chain(self.players[0].field, self.players[1].field))
+		return chain(self.players[0].field, self.players[1].field)
 
-	@property
+	@cached_view
 	def decks(self):
-		return CardList(chain(self.players[0].deck, self.players[1].deck))
+		return chain(self.players[0].deck, self.players[1].deck)
 
 	@property
 	def discarded(self):
 		return CardList(chain(self.players[0].discarded, self.players[1].discarded))
 
-	@property
+	@cached_view
 	def hands(self):
-		return CardList(chain(self.players[0].hand, self.players[1].hand))
+		return chain(self.players[0].hand, self.players[1].hand)
 
-	@property
+	@cached_view
 	def characters(self):
-		return CardList(chain(self.players[0].characters, self.players[1].characters))
+		return chain(self.players[0].characters, self.players[1].characters)
 
-	@property
+	@cached_view
 	def graveyard(self):
-		return CardList(chain(self.players[0].graveyard, self.players[1].graveyard))
+		return chain(self.players[0].graveyard, self.players[1].graveyard)
 
-	@property
+	@cached_view
 	def entities(self):
-		return CardList(chain([self], self.players[0].entities, self.players[1].entities))
+		return chain([self], self.players[0].entities, self.players[1].entities)
 
-	@property
+	def broadcast_position(self, entity):
+		"""
+		Returns a key sorting \a entity in the order actions are broadcast in
+		(the order of `entities`, followed by `hands`), or None if the entity
+		is in neither of them.
+		"""
+		if entity is self:
+			return (0, )
+		if entity.type == CardType.PLAYER:
+			return (1, self.players.index(entity), 4)
+		# Cards in the decks never listen. This is checked by identity, so that
+		# the state of the cards is not needed (see Journal).
+		player1, player2 = self.players
+		if entity in player1.deck or entity in player2.deck:
+			return None
+
+		controller = entity.controller
+		if controller not in self.players:
+			return None
+		player_index = self.players.index(controller)
+
+		if entity.zone == Zone.HAND:
+			index = _index(controller.hand, entity)
+			if index is not None:
+				return (2, player_index, index)
+			return None
+
+		if entity.type == CardType.ENCHANTMENT:
+			owner = entity.owner
+			if owner is None or owner.type == CardType.GAME:
+				return None
+			index = _index(owner.buffs, entity)
+			if index is None:
+				return None
+			if owner.type == CardType.PLAYER:
+				return (1, self.players.index(owner), 2, index)
+			owner_controller = owner.controller
+			if owner_controller not in self.players:
+				return None
+			owner_index = self.players.index(owner_controller)
+			if owner is owner_controller.hero:
+				return (1, owner_index, 3, 3 + index)
+			field_index = _index(owner_controller.field, owner)
+			if field_index is not None:
+				return (1, owner_index, 0, field_index, 1 + index)
+			return None
+
+		hero = controller.hero
+		if hero is None:
+			return None
+		if entity is hero:
+			return (1, player_index, 3, 0)
+		if entity is hero.power:
+			return (1, player_index, 3, 1)
+		if entity is controller.weapon:
+			return (1, player_index, 3, 2)
+		if entity.zone == Zone.SECRET:
+			index = _index(controller.secrets, entity)
+			if index is not None:
+				return (1, player_index, 1, index)
+		elif entity.zone == Zone.PLAY:
+			index = _index(controller.field, entity)
+			if index is not None:
+				return (1, player_index, 0, index, 0)
+		return None
+
+	@cached_view
 	def live_entities(self):
-		return CardList(chain(self.players[0].live_entities, self.players[1].live_entities))
+		return chain(self.players[0].live_entities, self.players[1].live_entities)
 
 	@property
 	def minions_killed_this_turn(self):
@@ -205,6 +427,8 @@ class BaseGame(Entity):
 		Performs a list of `actions` from `source`.
 		This should seldom be called directly - use `queue_actions` instead.
 		"""
+		if self._branches:
+			self.materialize_branches()
 		ret = []
 		for action in actions:
 			if isinstance(action, EventListener):
@@ -218,6 +442,7 @@ class BaseGame(Entity):
 				else:
 					listener = source
 				listener._events.append(action)
+				self.event_registry.add_listener(listener, action)
 			else:
 				ret.append(action.trigger(source))
 		return ret
@@ -231,28 +456,7 @@ class BaseGame(Entity):
 		return self.players[0], self.players[1]
 
 	def refresh_auras(self):
-		refresh_queue = []
-		for entity in self.entities:
-			for script in entity.update_scripts:
-				refresh_queue.append((entity, script))
-
-		for entity in self.hands:
-			for script in entity.data.scripts.Hand.update:
-				refresh_queue.append((entity, script))
-
-		# Sort the refresh queue by refresh priority (used by eg. Lightspawn)
-		refresh_queue.sort(key=lambda e: getattr(e[1], "priority", 50))
-		for entity, action in refresh_queue:
-			action.trigger(entity)
-
-		buffs_to_destroy = []
-		for buff in self.active_aura_buffs:
-			if buff.tick < self.tick:
-				buffs_to_destroy.append(buff)
-		for buff in buffs_to_destroy:
-			buff.remove()
-
-		self.tick += 1
+		self.aura_tracker.refresh()
 
 	def setup(self):
 		self.log("Setting up game %r", self)
@@ -340,7 +544,7 @@ class CoinRules:
 	The second player gets "The Coin" (GAME_005).
 	"""
 	def pick_first_player(self):
-		winner = random.choice(self.players)
+		winner = self.random.choice(self.players)
 		self.log("Tossing the coin... %s wins!", winner)
 		return winner, winner.opponent
 
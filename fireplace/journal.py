@@ -0,0 +1,121 @@
+"""
+Undo journal of a game (see BaseGame.checkpoint())
+"""
+from .entity import (
+	BranchedEntity, FirstUseEntity, TrackedEntity, copy_state, entity_class, record_change,
+	set_first_use
+)
+
+
+def _record(entity):
+	state = object.__getattribute__(entity, "__dict__")
+	journal = state.pop("_journal")
+	object.__setattr__(entity, "__class__", entity_class(entity))
+	journal.record(entity, state)
+
+
+class JournaledEntity(FirstUseEntity):
+	"""
+	An entity whose state is recorded by the journal of its game the
+	first time it is used after a checkpoint.
+	"""
+	_first_use = _record
+
+
+class Checkpoint:
+	def __init__(self, journal, game):
+		observers = game.manager.observers
+		# The memo the states of the entities are copied with. The journal
+		# restores entities in place, so they are not copied (see track()).
+		self.memo = {"journal": journal, id(observers): observers}
+		self.last_entity_id = game.manager.counter
+		# List of (entity, state) of the entities used since the checkpoint
+		self.states = []
+		self.recorded = set()
+
+
+class Journal:
+	"""
+	Undo journal of a game.
+	Rather than every change made to the game, the journal records the state
+	of each entity the first time the entity is used after a checkpoint (see
+	JournaledEntity), after which using the entity costs nothing more. Rolling
+	back restores the recorded entities in place, including the random number
+	generator of the game.
+	Entities created after a checkpoint are not recorded: rolling back makes
+	them unreachable.
+	"""
+	def __init__(self, game):
+		self.game = game
+		self.checkpoints = []
+		self._journaled = {}
+
+	def __bool__(self):
+		return bool(self.checkpoints)
+
+	def _journal(self, entity):
+		state = object.__getattribute__(entity, "__dict__")
+		state["_journal"] = self
+		set_first_use(entity, JournaledEntity)
+		self._journaled[id(entity)] = entity
+		self.checkpoints[-1].memo[id(entity)] = entity
+
+	def checkpoint(self):
+		entities = list(self.game)
+		self.checkpoints.append(Checkpoint(self, self.game))
+		for entity in entities:
+			if isinstance(entity, BranchedEntity):
+				# Branches are copied as a whole when they are journaled
+				BranchedEntity._first_use(entity)
+			if not isinstance(entity, JournaledEntity):
+				self._journal(entity)
+		self.checkpoints[-1].memo.update(self._journaled)
+
+	def track(self, entity):
+		"""
+		Called for each entity found in the state of a recorded entity.
+		Entities which are not part of the game as it is iterated over
+		(eg. the buffs of cards in hand) are journaled then.
+		"""
+		checkpoint = self.checkpoints[-1]
+		checkpoint.memo[id(entity)] = entity
+		if id(entity) in checkpoint.recorded:
+			return
+		entity_id = entity.__dict__.get("entity_id")
+		if entity_id is not None and entity_id <= checkpoint.last_entity_id:
+			self._journal(entity)
+
+	def record(self, entity, state):
+		checkpoint = self.checkpoints[-1]
+		checkpoint.recorded.add(id(entity))
+		del self._journaled[id(entity)]
+		checkpoint.states.append((entity, copy_state(state, checkpoint.memo)))
+
+	def rollback(self):
+		checkpoint = self.checkpoints.pop()
+		# An entity can be recorded more than once, the oldest state wins
+		for entity, recorded_state in reversed(checkpoint.states):
+			if isinstance(entity, JournaledEntity):
+				del self._journaled[id(entity)]
+				object.__setattr__(entity, "__class__", entity_class(entity))
+			state = object.__getattribute__(entity, "__dict__")
+			state.clear()
+			state.update(recorded_state)
+		# The journal is not part of the recorded state of the game
+		object.__getattribute__(self.game, "__dict__")["journal"] = self
+		# Only once the manager of the game is restored too
+		for entity, recorded_state in checkpoint.states:
+			if isinstance(entity, TrackedEntity):
+				record_change(entity, "__dict__")
+
+		if self.checkpoints:
+			# The restored entities are journaled again for the previous checkpoint
+			for entity, recorded_state in checkpoint.states:
+				if not isinstance(entity, JournaledEntity):
+					self._journal(entity)
+			self.checkpoints[-1].memo.update(self._journaled)
+		else:
+			for entity in self._journaled.values():
+				del object.__getattribute__(entity, "__dict__")["_journal"]
+				object.__setattr__(entity, "__class__", entity_class(entity))
+			self._journaled.clear()
@@ -1,4 +1,5 @@
 import logging
+import os
 
 
 def get_logger(name, level=logging.DEBUG):
@@ -20,4 +21,17 @@ def get_logger(name, level=logging.DEBUG):
 	return logger
 
 
+def set_headless(headless=True):
+	"""
+	Enable or disable the headless mode of the engine.
+	In headless mode, the logger is disabled and the hot paths of the engine
+	skip their logging calls altogether (they check `log.disabled`), rather
+	than having the logger filter them out.
+	Headless mode can also be enabled with the FIREPLACE_HEADLESS
+	environment variable.
+	"""
+	log.disabled = headless
+
+
 log = get_logger("fireplace")
+set_headless(bool(os.environ.get("FIREPLACE_HEADLESS")))
@@ -1,6 +1,9 @@
-from hearthstone.enums import GameTag
+from copy import deepcopy
+
+from hearthstone.enums import GameTag, Zone
 
 from . import enums
+from .entity import BuffableEntity, track_entity
 
 
 class Manager(object):
@@ -15,6 +18,7 @@ class Manager(object):
 
 	def __setitem__(self, tag, value):
 		setattr(self.obj, self.map[tag], value)
+		self.obj.clear_attr_cache()
 
 	def __iter__(self):
 		for k in self.map:
@@ -54,8 +58,23 @@ class GameManager(Manager):
 	def __init__(self, obj):
 		super().__init__(obj)
 		self.counter = 1
+		self.tracking = False
+		# id() of entity -> (entity, names of its changed attributes)
+		self.changed = {}
+		# id() of entity -> (entity, tags) of the tracked entities with tags
+		# which may change without any recorded change of their own
+		self.dynamic = {}
 		obj.entity_id = self.counter
 
+	def __deepcopy__(self, memo):
+		ret = self.__class__.__new__(self.__class__)
+		memo[id(self)] = ret
+		ret.__dict__.update(deepcopy(self.__dict__, memo))
+		# The entities are copied, and so are their id()
+		ret.changed = {id(entity): (entity, names) for entity, names in ret.changed.values()}
+		ret.dynamic = {id(entity): (entity, tags) for entity, tags in ret.dynamic.values()}
+		return ret
+
 	def action_start(self, type, source, index, target):
 		for observer in self.observers:
 			observer.action_start(type, source, index, target)
@@ -66,7 +85,10 @@ class GameManager(Manager):
 
 	def new_entity(self, entity):
 		self.counter += 1
+		if self.tracking:
+			track_entity(entity)
 		entity.entity_id = self.counter
+		self.obj.event_registry.update(entity)
 		for observer in self.observers:
 			observer.new_entity(entity)
 
@@ -85,6 +107,92 @@ class GameManager(Manager):
 		for observer in self.observers:
 			observer.turn(player)
 
+	def track_changes(self):
+		"""
+		Start tracking the changes made to the entities of the game, so that
+		observers can look at the tags which may have changed (see changes())
+		rather than at every tag of every entity.
+		"""
+		if self.tracking:
+			return
+		self.tracking = True
+		game = self.obj
+		track_entity(game)
+		for player in game.players:
+			track_entity(player)
+		for entity in game:
+			track_entity(entity)
+
+	def record_change(self, entity, name):
+		"""
+		Records that the attribute \a name of the tracked \a entity changed,
+		or all of them for "__dict__".
+		"""
+		changed = self.changed.get(id(entity))
+		if changed is None:
+			self.changed[id(entity)] = (entity, {name})
+		else:
+			changed[1].add(name)
+
+	def _game_dependents(self, game_names):
+		# The entities whose tags may depend on the changes of the game
+		zones = set()
+		for name in game_names:
+			if name in _game_dependencies:
+				if _game_dependencies[name] is None:
+					return self.obj
+				zones |= _game_dependencies[name]
+		if not zones:
+			return ()
+		return self.obj.zone_entities(zones)
+
+	def changes(self):
+		"""
+		Returns a list of (entity, tags) of the entities of the game whose
+		tags may have changed since the last call, along with those tags:
+		- the tags depending on the attributes which changed, of the entity
+		or of the game (see entity.depends_on())
+		- the tags computed by card scripts, by buffs with scripts and by
+		properties without declared dependencies, which may change whenever
+		anything in the game changes
+		Entities are only looked at if they changed or have such tags, or if
+		the game changed in a way some of their tags depend on.
+		Requires track_changes().
+		"""
+		changed = self.changed
+		if not changed:
+			return []
+		self.changed = {}
+
+		for key, (entity, names) in changed.items():
+			# Also registers the dependencies of new classes on the game
+			tracked_tags = _tracked_tags(entity)
+			if not names.isdisjoint(_DYNAMIC_NAMES):
+				tags = tracked_tags.dynamic(entity)
+				if tags:
+					self.dynamic[key] = (entity, tags)
+				else:
+					self.dynamic.pop(key, None)
+
+		game = self.obj
+		game_names = changed.get(id(game), (game, ()))[1]
+		entities = {}
+		for entity in self._game_dependents(game_names):
+			entities[id(entity)] = entity
+		for key, (entity, names) in changed.items():
+			entities.setdefault(key, entity)
+		for key, (entity, tags) in self.dynamic.items():
+			entities.setdefault(key, entity)
+
+		ret = []
+		for key, entity in entities.items():
+			names = changed.get(key, (entity, ()))[1]
+			dynamic = self.dynamic.get(key, (entity, ()))[1]
+			tags = _tracked_tags(entity).changed(names, game_names, dynamic)
+			if tags:
+				ret.append((entity, tags))
+		return ret
+
 
 class BaseObserver:
 	def action_start(self, type, source, index, target):
@@ -251,3 +359,154 @@ CARD_ATTRIBUTE_MAP = {
 
 class CardManager(Manager):
 	map = CARD_ATTRIBUTE_MAP
+
+
+# Changes after which the tags of an entity changing without any recorded
+# change are looked up again (see TrackedTags.dynamic())
+_DYNAMIC_NAMES = {"__dict__", "_attr_cache", "_flag_cache", "_zone"}
+
+# Attribute name of the game -> zones of the entities whose tags depend on
+# it, or None for any zone (see entity.depends_on())
+_game_dependencies = {"__dict__": None}
+
+
+class TrackedTags:
+	"""
+	How the tags of a class of entities change (see GameManager.changes()),
+	from the dependencies of their properties (see entity.depends_on()):
+	- by_name: attribute name -> tags which change when it is set
+	- by_game_name: attribute name of the game -> tags which change with it
+	- buffed: tag -> attributes of the buffs and slots it changes with
+	- scripted: (script name, tag) of the tags computed by card scripts
+	- derived: tags which may change whenever anything changes
+	"""
+	def __init__(self, cls):
+		self.all = [tag for tag, attr in cls.Manager.map.items() if attr]
+		self.by_name = {"__dict__": self.all}
+		self.by_game_name = {"__dict__": []}
+		self.buffed = {}
+		self.scripted = []
+		self.derived = []
+		self._scripted_by_id = {}
+		# Attributes which a custom _getattr() derives from other entities (eg.
+		# hero attack comes from the weapon), all of them unless declared
+		derived_attributes = ()
+		if issubclass(cls, BuffableEntity) and cls._getattr is not BuffableEntity._getattr:
+			derived_attributes = getattr(cls, "derived_attributes", None)
+
+		for tag in self.all:
+			attr = cls.Manager.map[tag]
+			descriptor = None
+			for klass in cls.__mro__:
+				if attr in klass.__dict__:
+					descriptor = klass.__dict__[attr]
+					break
+			if not isinstance(descriptor, property):
+				self._add(self.by_name, attr, tag)
+				continue
+			names = getattr(descriptor.fget, "depends_on", None)
+			zones = getattr(descriptor.fget, "depends_on_zones", None)
+			if names is None:
+				self.derived.append(tag)
+				continue
+			scripts = [name[len("script."):] for name in names if name.startswith("script.")]
+			if "buffs" in names and (
+				derived_attributes is None or not set(derived_attributes).isdisjoint(scripts)
+			):
+				self.derived.append(tag)
+				continue
+			for name in names:
+				if name == "buffs":
+					# Buffs and slots clear the attribute caches when they change
+					self._add(self.by_name, "_attr_cache", tag)
+					self._add(self.by_name, "_flag_cache", tag)
+					self.buffed[tag] = scripts
+				elif name.startswith("game."):
+					self._add(self.by_game_name, name[len("game."):], tag)
+					self.by_game_name["__dict__"].append(tag)
+					_add_game_dependency(name[len("game."):], zones)
+				elif name.startswith("script."):
+					self.scripted.append((name[len("script."):], tag))
+				else:
+					self._add(self.by_name, name, tag)
+
+	def _add(self, mapping, name, tag):
+		tags = mapping.setdefault(name, [])
+		if tag not in tags:
+			tags.append(tag)
+
+	def _scripted(self, entity):
+		# Tags computed by the card script of the entity
+		id = entity.data.id
+		ret = self._scripted_by_id.get(id)
+		if ret is None:
+			scripts = entity.data.scripts
+			ret = self._scripted_by_id[id] = [
+				tag for name, tag in self.scripted if getattr(scripts, name, None)
+			]
+		return ret
+
+	def _scripted_buffs(self, entity):
+		# Tags computed by the scripts of the buffs and slots of the entity
+		ret = []
+		for tag, attrs in self.buffed.items():
+			for attr in attrs:
+				if any(hasattr(buff.data.scripts, attr) for buff in entity.buffs):
+					ret.append(tag)
+					break
+				if any(callable(getattr(slot, attr, None)) for slot in entity.slots):
+					ret.append(tag)
+					break
+		return ret
+
+	def dynamic(self, entity):
+		"""
+		Returns the tags of \a entity which may change without any recorded
+		change of its own or of the game.
+		"""
+		if getattr(entity, "zone", None) == Zone.REMOVEDFROMGAME:
+			return []
+		ret = set(self.derived)
+		if self.scripted and entity.data:
+			ret.update(self._scripted(entity))
+		if self.buffed and (entity.buffs or entity.slots):
+			ret.update(self._scripted_buffs(entity))
+		return ret
+
+	def changed(self, names, game_names, dynamic):
+		"""
+		Returns the tags which may have changed, from the \a names of the
+		changed attributes of the entity and of the game, and the \a dynamic
+		tags of the entity.
+		"""
+		ret = set(dynamic)
+		for mapping, changes in ((self.by_name, names), (self.by_game_name, game_names)):
+			for name in changes:
+				tags = mapping.get(name)
+				if tags:
+					ret.update(tags)
+		if not ret:
+			return []
+		# In the order of the manager map, as the tags are refreshed in
+		return [tag for tag in self.all if tag in ret]
+
+
+def _add_game_dependency(name, zones):
+	if name in _game_dependencies:
+		previous = _game_dependencies[name]
+		if previous is None or zones is None:
+			zones = None
+		else:
+			zones = previous | zones
+	_game_dependencies[name] = zones
+
+
+_tracked_tags_classes = {}
+
+
+def _tracked_tags(entity):
+	cls = type(entity)
+	ret = _tracked_tags_classes.get(cls)
+	if ret is None:
+		ret = _tracked_tags_classes[cls] = TrackedTags(cls)
+	return ret
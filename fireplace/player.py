@@ -1,5 +1,5 @@
-import random
-from itertools import chain
+from enum import IntEnum
+from itertools import chain, combinations
 
 from hearthstone.enums import CardType, PlayState, Zone
 
@@ -7,9 +7,20 @@ from .actions import Concede, Draw, Fatigue, Give, Hit, Steal, Summon
 from .aura import TargetableByAuras
 from .card import Card
 from .deck import Deck
-from .entity import Entity, slot_property
+from .entity import Entity, depends_on, slot_property
 from .managers import PlayerManager
-from .utils import CardList
+from .utils import CardList, IndexedCardList, cached_view
+
+
+class ActionType(IntEnum):
+	"""
+	The kinds of actions returned by Player.legal_actions()
+	"""
+	END_TURN = 1
+	PLAY = 2
+	HERO_POWER = 3
+	ATTACK = 4
+	CHOOSE = 5
 
 
 class Player(Entity, TargetableByAuras):
@@ -34,11 +45,12 @@ class Player(Entity, TargetableByAuras):
 		self.hero = None
 		super().__init__()
 		self.deck = Deck()
-		self.hand = CardList()
+		self.hand = IndexedCardList()
 		self.discarded = CardList()
-		self.field = CardList()
-		self.graveyard = CardList()
-		self.secrets = CardList()
+		self.field = IndexedCardList()
+		self.graveyard = IndexedCardList()
+		self.secrets = IndexedCardList()
+		self._views = {}
 		self.choice = None
 		self.max_hand_size = 10
 		self.max_resources = 10
@@ -67,10 +79,12 @@ class Player(Entity, TargetableByAuras):
 		return "%s(name=%r, hero=%r)" % (self.__class__.__name__, self.name, self.hero)
 
 	@property
+	@depends_on("game.current_player")
 	def current_player(self):
 		return self.game.current_player is self
 
 	@property
+	@depends_on()
 	def controller(self):
 		return self
 
@@ -80,6 +94,7 @@ class Player(Entity, TargetableByAuras):
 		return mana
 
 	@property
+	@depends_on("_max_mana")
 	def max_mana(self):
 		return self._max_mana
 
@@ -99,17 +114,18 @@ class Player(Entity, TargetableByAuras):
 		return aura_power + minion_power
 
 	@property
+	@depends_on("_start_hand_size", "first_player")
 	def start_hand_size(self):
 		if not self.first_player:
 			# Give the second player an extra card
 			return self._start_hand_size + 1
 		return self._start_hand_size
 
-	@property
+	@cached_view
 	def characters(self):
-		return CardList(chain([self.hero] if self.hero else [], self.field))
+		return chain([self.hero] if self.hero else [], self.field)
 
-	@property
+	@cached_view
 	def entities(self):
 		for entity in self.field:
 			yield from entity.entities
@@ -119,7 +135,7 @@ class Player(Entity, TargetableByAuras):
 			yield from self.hero.entities
 		yield self
 
-	@property
+	@cached_view
 	def live_entities(self):
 		yield from self.field
 		if self.hero:
@@ -127,13 +143,103 @@ class Player(Entity, TargetableByAuras):
 		if self.weapon:
 			yield self.weapon
 
-	@property
+	@cached_view
 	def actionable_entities(self):
 		yield from self.characters
 		yield from self.hand
 		if self.hero.power:
 			yield self.hero.power
 
+	def legal_actions(self, positions=False):
+		"""
+		Returns the actions the player can currently take, as a list of
+		(kind, entity, target, choose, index) tuples, where kind is an ActionType:
+		- END_TURN: always available to the current player
+		- PLAY: play the card \a entity from the hand, on \a target, with the
+			"Choose One" card id \a choose, at the board position \a index
+		- HERO_POWER: use the hero power \a entity on \a target
+		- ATTACK: attack \a target with the character \a entity
+		- CHOOSE: pick the tuple of cards \a entity in the pending choice;
+			nothing else is available while a choice is pending
+		Unused fields are None. Minions are played to the right of the board
+		unless \a positions is True, in which case every position is listed.
+		The actions can be taken with perform().
+		"""
+		choice = self.choice
+		if choice is not None:
+			cards = list(choice.cards)
+			ret = []
+			for count in range(choice.min_count, min(choice.max_count, len(cards)) + 1):
+				for picked in combinations(cards, count):
+					ret.append((ActionType.CHOOSE, picked, None, None, None))
+			return ret
+
+		if not self.current_player:
+			return []
+
+		ret = [(ActionType.END_TURN, None, None, None, None)]
+		if positions:
+			indexes = range(len(self.field) + 1)
+		else:
+			indexes = (None, )
+
+		# Checking whether cards are playable looks their targets up again
+		with self.game.cache_targets():
+			for card in self.hand:
+				if not card.is_playable():
+					continue
+				if card.type == CardType.MINION:
+					card_indexes = indexes
+				else:
+					card_indexes = (None, )
+				if card.must_choose_one:
+					choices = [(choose.id, choose) for choose in card.choose_cards]
+				else:
+					choices = [(None, card)]
+				for choose, played in choices:
+					# Targets are checked against the chosen card, see PlayableCard.play()
+					targets = played.play_targets if played.requires_target() else (None, )
+					for target in targets:
+						for index in card_indexes:
+							ret.append((ActionType.PLAY, card, target, choose, index))
+
+			power = self.hero.power
+			if power and power.is_usable():
+				targets = power.play_targets if power.requires_target() else (None, )
+				for target in targets:
+					ret.append((ActionType.HERO_POWER, power, target, None, None))
+
+		# Attack targets only depend on whether the attacker can attack heroes
+		attack_targets = {}
+		for character in self.characters:
+			if not character._ready_to_attack():
+				continue
+			key = bool(character.cannot_attack_heroes)
+			targets = attack_targets.get(key)
+			if targets is None:
+				targets = attack_targets[key] = character.attack_targets
+			for target in targets:
+				ret.append((ActionType.ATTACK, character, target, None, None))
+
+		return ret
+
+	def perform(self, action):
+		"""
+		Take \a action, one of the tuples returned by legal_actions().
+		"""
+		kind, entity, target, choose, index = action
+		if kind == ActionType.END_TURN:
+			return self.game.end_turn()
+		elif kind == ActionType.PLAY:
+			return entity.play(target=target, index=index, choose=choose)
+		elif kind == ActionType.HERO_POWER:
+			return entity.use(target=target)
+		elif kind == ActionType.ATTACK:
+			return entity.attack(target)
+		elif kind == ActionType.CHOOSE:
+			return self.choice.choose(*entity)
+		raise ValueError("Unknown action type %r" % (kind))
+
 	@property
 	def minion_slots(self):
 		return max(0, self.game.MAX_MINIONS_ON_FIELD - len(self.field))
@@ -160,7 +266,7 @@ class Player(Entity, TargetableByAuras):
 
 		# Draw initial hand (but not any more than what we have in the deck)
 		hand_size = min(len(self.deck), self.start_hand_size)
-		starting_hand = random.sample(self.deck, hand_size)
+		starting_hand = self.game.random.sample(self.deck, hand_size)
 		# It's faster to move cards directly to the hand instead of drawing
 		for card in starting_hand:
 			card.zone = Zone.HAND
@@ -209,7 +315,8 @@ class Player(Entity, TargetableByAuras):
 
 	def shuffle_deck(self):
 		self.log("%r shuffles their deck", self)
-		random.shuffle(self.deck)
+		self.game.random.shuffle(self.deck)
+		self.game.entities_changed()
 
 	def draw(self, count=1):
 		if self.cant_draw:
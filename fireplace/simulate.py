@@ -0,0 +1,263 @@
+"""
+Batch game simulator
+
+Plays games between random agents across a pool of worker processes. Each
+worker initializes the card database once, then plays the games it is handed
+and sends back a compact result for each of them (see simulate_game()).
+
+	python -m fireplace.simulate -n 1000 --seed 1857
+
+Games are fully described by their spec (see make_specs()): replaying a spec
+replays the same game, whichever worker it runs in.
+"""
+import json
+import os
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from multiprocessing import Pool
+
+from hearthstone.enums import CardClass, PlayState
+
+from .exceptions import GameOver
+from .logging import set_headless
+from .player import ActionType
+
+
+# Games still running after this many turns are counted as draws
+MAX_TURNS = 200
+
+# Chance for the agents to pick an action other than ending their turn
+PLAY_CHANCE = 0.8
+
+
+def make_specs(count, seed=None, class1=None, class2=None, deck1=None, deck2=None):
+	"""
+	Return a list of \a count game specs, as dicts of:
+	- seed: the seed of the game
+	- classes: the card classes of both players
+	- decks: the card ids of both decks, or None for random drafts
+	Classes which are not given are picked at random for each game.
+	The specs are derived from \a seed, if given.
+	"""
+	rng = random.Random(seed)
+	ret = []
+	for i in range(count):
+		classes = [class1, class2]
+		for j, card_class in enumerate(classes):
+			if card_class is None:
+				classes[j] = CardClass(rng.randint(2, 10))
+		ret.append({
+			"seed": rng.getrandbits(64),
+			"classes": [int(card_class) for card_class in classes],
+			"decks": [deck1, deck2],
+		})
+	return ret
+
+
+def init_worker(headless=True):
+	"""
+	Initialize a simulator process: the engine runs in headless mode unless
+	\a headless is False (see fireplace.logging.set_headless()), the card
+	database is loaded unless it already was (eg. in the parent of a forked
+	worker).
+	"""
+	from . import cards
+
+	set_headless(headless)
+	if not cards.db.initialized:
+		cards.db.initialize()
+
+
+def setup_game(spec):
+	from .game import Game
+	from .player import Player
+	from .utils import random_draft
+
+	seed = spec["seed"]
+	rng = random.Random(seed)
+	players = []
+	for i, (card_class, deck) in enumerate(zip(spec["classes"], spec["decks"])):
+		card_class = CardClass(card_class)
+		if not deck:
+			deck = random_draft(card_class, rng=rng)
+		players.append(Player("Player%i" % (i + 1), deck, card_class.default_hero))
+
+	game = Game(players=players, seed=seed)
+	game.start()
+	return game
+
+
+def simulate_game(spec, max_turns=MAX_TURNS):
+	"""
+	Play the game described by \a spec between two random agents.
+	Returns a dict of:
+	- seed, classes: from the spec
+	- winner: 1 or 2, or 0 for a draw
+	- turns: the number of turns the game lasted
+	- duration: the time it took to play, in seconds
+	- cards: card id -> [times played, times played by the winner]
+	"""
+	game = setup_game(spec)
+	rng = game.random
+	played = defaultdict(lambda: [0, 0])
+	played_by = ([], [])
+	start = time.perf_counter()
+
+	try:
+		while game.turn <= max_turns:
+			# Pending choices (eg. mulligans) come first
+			player = game.current_player
+			for p in game.players:
+				if p.choice:
+					player = p
+					break
+			actions = player.legal_actions()
+			if actions[0][0] == ActionType.CHOOSE:
+				action = rng.choice(actions)
+			elif len(actions) > 1 and rng.random() < PLAY_CHANCE:
+				# Play whatever can be played most of the time, before ending the turn
+				action = rng.choice(actions[1:])
+			else:
+				action = actions[0]
+			if action[0] == ActionType.PLAY:
+				played_by[player is game.player2].append(action[1].id)
+			player.perform(action)
+	except GameOver:
+		pass
+
+	duration = time.perf_counter() - start
+	winner = 0
+	for i, player in enumerate(game.players):
+		if player.playstate == PlayState.WON:
+			winner = i + 1
+
+	for i, ids in enumerate(played_by):
+		for id in ids:
+			stats = played[id]
+			stats[0] += 1
+			if winner == i + 1:
+				stats[1] += 1
+
+	return {
+		"seed": spec["seed"],
+		"classes": spec["classes"],
+		"winner": winner,
+		"turns": game.turn,
+		"duration": duration,
+		"cards": dict(played),
+	}
+
+
+def simulate(specs, processes=None, chunksize=1):
+	"""
+	Play the games described by \a specs across \a processes worker
+	processes (defaults to the number of CPUs).
+	Yields the result of each game (see simulate_game()) as soon as it is
+	available, in no particular order.
+	"""
+	with Pool(processes, initializer=init_worker) as pool:
+		yield from pool.imap_unordered(simulate_game, specs, chunksize)
+
+
+class Summary:
+	"""
+	Aggregate of simulated game results.
+	"""
+	def __init__(self):
+		self.games = 0
+		self.wins = [0, 0, 0]
+		self.turns = 0
+		self.duration = 0.0
+		self.cards = defaultdict(lambda: [0, 0])
+
+	def add(self, result):
+		self.games += 1
+		self.wins[result["winner"]] += 1
+		self.turns += result["turns"]
+		self.duration += result["duration"]
+		for id, (count, won) in result["cards"].items():
+			stats = self.cards[id]
+			stats[0] += count
+			stats[1] += won
+
+	def report(self, top=10):
+		games = self.games or 1
+		lines = [
+			"Games: %i" % (self.games),
+			"Player1 wins: %i, Player2 wins: %i, draws: %i" % (
+				self.wins[1], self.wins[2], self.wins[0]
+			),
+			"Average turns: %.1f" % (self.turns / games),
+			"Average game duration: %.1fms" % (self.duration / games * 1000),
+		]
+		if self.cards and top:
+			lines.append("Most played cards (times played, win rate):")
+			cards = sorted(self.cards.items(), key=lambda item: (-item[1][0], item[0]))
+			for id, (count, won) in cards[:top]:
+				lines.append("  %-12s %6i  %5.1f%%" % (id, count, won / count * 100))
+		return "\n".join(lines)
+
+
+def _card_class(name):
+	try:
+		return CardClass[name.upper()]
+	except KeyError:
+		raise ValueError("Unknown card class %r" % (name))
+
+
+def _deck(ids):
+	return ids.split(",")
+
+
+def main():
+	arguments = ArgumentParser(prog="fireplace.simulate")
+	arguments.add_argument("-n", "--games", type=int, default=100, help="number of games")
+	arguments.add_argument(
+		"-p", "--processes", type=int, default=None,
+		help="number of worker processes, defaults to %i" % (os.cpu_count())
+	)
+	arguments.add_argument("--seed", type=int, default=None, help="seed of the game specs")
+	arguments.add_argument("--class1", type=_card_class, default=None)
+	arguments.add_argument("--class2", type=_card_class, default=None)
+	arguments.add_argument(
+		"--deck1", type=_deck, default=None, help="comma-separated card ids"
+	)
+	arguments.add_argument(
+		"--deck2", type=_deck, default=None, help="comma-separated card ids"
+	)
+	arguments.add_argument("--chunksize", type=int, default=1, help="games per task")
+	arguments.add_argument(
+		"-o", "--output", default=None,
+		help="write the result of each game to this file, as JSON lines"
+	)
+	args = arguments.parse_args(sys.argv[1:])
+
+	specs = make_specs(
+		args.games, args.seed, args.class1, args.class2, args.deck1, args.deck2
+	)
+	summary = Summary()
+	output = open(args.output, "w") if args.output else None
+	start = time.perf_counter()
+	try:
+		for result in simulate(specs, args.processes, args.chunksize):
+			summary.add(result)
+			if output:
+				output.write(json.dumps(result) + "\n")
+	finally:
+		if output:
+			output.close()
+
+	elapsed = time.perf_counter() - start
+	print(summary.report())
+	print("Played %i games in %.2fs (%.1f games/s)" % (
+		summary.games, elapsed, summary.games / elapsed
+	))
+
+	return 0
+
+
+if __name__ == "__main__":
+	exit(main())
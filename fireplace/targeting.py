@@ -14,8 +14,46 @@ TARGETING_PREREQUISITES = (
 )
 
 
-# Requirements-based targeting
-def is_valid_target(self, target, requirements=None):
+# Checks of the requirements a target has to meet, as (source, target) -> bool
+_TARGET_CHECKS = {
+	PlayReq.REQ_MINION_TARGET: lambda param: (
+		lambda source, target: target.type == CardType.MINION
+	),
+	PlayReq.REQ_FRIENDLY_TARGET: lambda param: (
+		lambda source, target: target.controller == source.controller
+	),
+	PlayReq.REQ_ENEMY_TARGET: lambda param: (
+		lambda source, target: target.controller != source.controller
+	),
+	PlayReq.REQ_DAMAGED_TARGET: lambda param: lambda source, target: target.damage,
+	PlayReq.REQ_FROZEN_TARGET: lambda param: lambda source, target: target.frozen,
+	PlayReq.REQ_TARGET_MAX_ATTACK: lambda param: (
+		lambda source, target: not target.atk > param
+	),
+	PlayReq.REQ_TARGET_WITH_RACE: lambda param: (
+		lambda source, target: target.type == CardType.MINION and target.race == param
+	),
+	PlayReq.REQ_HERO_TARGET: lambda param: (
+		lambda source, target: target.type == CardType.HERO
+	),
+	PlayReq.REQ_TARGET_MIN_ATTACK: lambda param: (
+		lambda source, target: not target.atk < param
+	),
+	PlayReq.REQ_MUST_TARGET_TAUNTER: lambda param: lambda source, target: target.taunt,
+	PlayReq.REQ_UNDAMAGED_TARGET: lambda param: lambda source, target: not target.damage,
+	PlayReq.REQ_LEGENDARY_TARGET: lambda param: (
+		lambda source, target: target.rarity == Rarity.LEGENDARY
+	),
+	PlayReq.REQ_TARGET_WITH_BATTLECRY: lambda param: (
+		lambda source, target: target.has_battlecry
+	),
+	PlayReq.REQ_TARGET_WITH_DEATHRATTLE: lambda param: (
+		lambda source, target: target.has_deathrattle
+	),
+}
+
+
+def _can_be_targeted(self, target):
 	if target is self:
 		# Battlecries can never target themselves
 		return False
@@ -35,58 +73,46 @@ def is_valid_target(self, target, requirements=None):
 	if target.cant_be_targeted_by_opponents and self.controller != target.controller:
 		return False
 
-	if requirements is None:
-		requirements = self.requirements
+	return True
 
-	# Check if the entity can ever target other entities
+
+def compile_requirements(requirements):
+	"""
+	Compile the play requirements \a requirements into a validator,
+	a function of (source, target) returning whether \a target is a
+	valid target for \a source.
+	Returns None if the requirements never allow targeting anything.
+	"""
+	# Check if the requirements ever allow targeting other entities
 	for req in TARGETING_PREREQUISITES:
 		if req in requirements:
 			break
 	else:
-		return False
+		return None
 
-	for req, param in requirements.items():
-		if req == PlayReq.REQ_MINION_TARGET:
-			if target.type != CardType.MINION:
-				return False
-		elif req == PlayReq.REQ_FRIENDLY_TARGET:
-			if target.controller != self.controller:
-				return False
-		elif req == PlayReq.REQ_ENEMY_TARGET:
-			if target.controller == self.controller:
-				return False
-		elif req == PlayReq.REQ_DAMAGED_TARGET:
-			if not target.damage:
-				return False
-		elif req == PlayReq.REQ_FROZEN_TARGET:
-			if not target.frozen:
-				return False
-		elif req == PlayReq.REQ_TARGET_MAX_ATTACK:
-			if target.atk > param or 0:
-				return False
-		elif req == PlayReq.REQ_TARGET_WITH_RACE:
-			if target.type != CardType.MINION or target.race != param:
-				return False
-		elif req == PlayReq.REQ_HERO_TARGET:
-			if target.type != CardType.HERO:
-				return False
-		elif req == PlayReq.REQ_TARGET_MIN_ATTACK:
-			if target.atk < param or 0:
-				return False
-		elif req == PlayReq.REQ_MUST_TARGET_TAUNTER:
-			if not target.taunt:
-				return False
-		elif req == PlayReq.REQ_UNDAMAGED_TARGET:
-			if target.damage:
-				return False
-		elif req == PlayReq.REQ_LEGENDARY_TARGET:
-			if target.rarity != Rarity.LEGENDARY:
-				return False
-		elif req == PlayReq.REQ_TARGET_WITH_BATTLECRY:
-			if not target.has_battlecry:
-				return False
-		elif req == PlayReq.REQ_TARGET_WITH_DEATHRATTLE:
-			if not target.has_deathrattle:
+	checks = tuple(
+		_TARGET_CHECKS[req](param) for req, param in requirements.items()
+		if req in _TARGET_CHECKS
+	)
+
+	if not checks:
+		return _can_be_targeted
+
+	def validate(source, target):
+		if not _can_be_targeted(source, target):
+			return False
+		for check in checks:
+			if not check(source, target):
 				return False
+		return True
 
-	return True
+	return validate
+
+
+# Requirements-based targeting
+def is_valid_target(self, target, requirements=None):
+	if requirements is None:
+		validate = self.data.target_validator
+	else:
+		validate = compile_requirements(requirements)
+	return validate is not None and validate(self, target)
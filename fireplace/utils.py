@@ -1,6 +1,8 @@
 import os.path
 import random
 from bisect import bisect
+from copy import deepcopy
+from functools import wraps
 from importlib import import_module
 from pkgutil import iter_modules
 from typing import List
@@ -31,6 +33,14 @@ class CardList(list):
 		# Used in Kettle to easily serialize CardList to json
 		return len(self)
 
+	def __deepcopy__(self, memo):
+		# Much faster than the generic deepcopy() of list subclasses
+		ret = self.__class__.__new__(self.__class__)
+		memo[id(self)] = ret
+		ret.__dict__.update(deepcopy(self.__dict__, memo))
+		list.extend(ret, [deepcopy(card, memo) for card in self])
+		return ret
+
 	def contains(self, x):
 		"""
 		True if list contains any instance of x
@@ -63,9 +73,131 @@ class CardList(list):
 		return self.__class__(e for k, v in kwargs.items() for e in self if getattr(e, k, 0) == v)
 
 
-def random_draft(card_class: CardClass, exclude=[]):
+class IndexedCardList(CardList):
+	"""
+	A CardList which keeps the position of its cards, by identity.
+	Membership tests and index() are constant time, and the index is
+	updated in place on append(); any other mutation drops it and it is
+	rebuilt on the next lookup.
+	Used for the zones of the game, which are looked up much more often
+	than they change.
+	"""
+	def __init__(self, cards=()):
+		super().__init__(cards)
+		self._positions = None
+
+	def __getstate__(self):
+		# The index is keyed by id() and would be stale in a copy
+		state = self.__dict__.copy()
+		state["_positions"] = None
+		return state
+
+	def __deepcopy__(self, memo):
+		ret = super().__deepcopy__(memo)
+		ret._positions = None
+		return ret
+
+	def _get_positions(self):
+		positions = self._positions
+		if positions is None:
+			positions = self._positions = {}
+			for i, item in enumerate(self):
+				positions.setdefault(id(item), i)
+		return positions
+
+	def __contains__(self, x):
+		positions = self._positions
+		if positions is None:
+			positions = self._get_positions()
+		return id(x) in positions
+
+	def index(self, x):
+		positions = self._positions
+		if positions is None:
+			positions = self._get_positions()
+		try:
+			return positions[id(x)]
+		except KeyError:
+			raise ValueError
+
+	def remove(self, x):
+		del self[self.index(x)]
+
+	def append(self, x):
+		positions = self._positions
+		if positions is not None:
+			positions.setdefault(id(x), len(self))
+		super().append(x)
+
+	def extend(self, cards):
+		super().extend(cards)
+		self._positions = None
+
+	def insert(self, i, x):
+		super().insert(i, x)
+		self._positions = None
+
+	def pop(self, i=-1):
+		ret = super().pop(i)
+		self._positions = None
+		return ret
+
+	def clear(self):
+		super().clear()
+		self._positions = None
+
+	def sort(self, *args, **kwargs):
+		super().sort(*args, **kwargs)
+		self._positions = None
+
+	def reverse(self):
+		super().reverse()
+		self._positions = None
+
+	def __setitem__(self, key, value):
+		super().__setitem__(key, value)
+		self._positions = None
+
+	def __delitem__(self, key):
+		super().__delitem__(key)
+		self._positions = None
+
+	def __iadd__(self, cards):
+		self.extend(cards)
+		return self
+
+	def __imul__(self, n):
+		ret = super().__imul__(n)
+		self._positions = None
+		return ret
+
+
+def cached_view(func):
 	"""
-	Return a deck of 30 random cards for the \a card_class
+	Turn \a func, listing entities of a game, into a property returning a
+	CardList of them which is cached until the entities of the game change
+	zone or controller (see BaseGame.entities_changed()).
+	The CardList must not be modified.
+	"""
+	name = func.__name__
+
+	@wraps(func)
+	def view(self):
+		version = self.game.entities_version
+		cached = self._views.get(name)
+		if cached is not None and cached[0] == version:
+			return cached[1]
+		ret = CardList(func(self))
+		self._views[name] = (version, ret)
+		return ret
+
+	return property(view)
+
+
+def random_draft(card_class: CardClass, exclude=[], rng=random):
+	"""
+	Return a deck of 30 random cards for the \a card_class,
+	drawn with the random number generator \a rng
 	"""
 	from . import cards
 	from .deck import Deck
@@ -89,25 +221,59 @@ def random_draft(card_class: CardClass, exclude=[]):
 		collection.append(cls)
 
 	while len(deck) < Deck.MAX_CARDS:
-		card = random.choice(collection)
+		card = rng.choice(collection)
 		if deck.count(card.id) < card.max_count_in_deck:
 			deck.append(card.id)
 
 	return deck
 
 
-def random_class():
-	return CardClass(random.randint(2, 10))
+def random_class(rng=random):
+	return CardClass(rng.randint(2, 10))
+
+
+_script_registry = None
+
+
+def _build_script_registry():
+	from .cards import utils as cardutils
+
+	# Every card set star-imports the card helpers, those are not card scripts
+	helpers = set(vars(cardutils))
+	ret = {}
+	origins = {}
+	for cardset in CARD_SETS:
+		module = import_module("fireplace.cards.%s" % (cardset))
+		for id, definition in vars(module).items():
+			if id in helpers or not isinstance(definition, type):
+				continue
+			if id in ret:
+				if ret[id] is not definition:
+					raise ValueError("%r is defined in both the %s and %s card sets" % (
+						id, origins[id], cardset
+					))
+				continue
+			ret[id] = definition
+			origins[id] = cardset
+	return ret
+
+
+def get_script_registry():
+	"""
+	Return a dict of card id -> script definition for every card set.
+	The registry is built in a single pass the first time it is needed.
+	"""
+	global _script_registry
+	if _script_registry is None:
+		_script_registry = _build_script_registry()
+	return _script_registry
 
 
 def get_script_definition(id):
 	"""
 	Find and return the script definition for card \a id
 	"""
-	for cardset in CARD_SETS:
-		module = import_module("fireplace.cards.%s" % (cardset))
-		if hasattr(module, id):
-			return getattr(module, id)
+	return get_script_registry().get(id)
 
 
 def entity_to_xml(entity):
@@ -142,8 +308,10 @@ def weighted_card_choice(source, weights: List[int], card_sets: List[str], count
 	Take a list of weights and a list of card pools and produce
 	a random weighted sample without replacement.
 	len(weights) == len(card_sets) (one weight per card set)
+	The card pools are not modified.
 	"""
 
+	rng = source.game.random
 	chosen_cards = []
 
 	# sum all the weights
@@ -153,15 +321,27 @@ def weighted_card_choice(source, weights: List[int], card_sets: List[str], count
 		totalweight += w * len(card_sets[i])
 		cum_weights.append(totalweight)
 
+	# Remaining size of each set, and the cards swapped out of the way of
+	# the chosen ones (a Fisher-Yates shuffle, without copying the sets)
+	remaining = [len(cards) for cards in card_sets]
+	swapped = [{} for cards in card_sets]
+
 	# for each card
 	for i in range(count):
 		# choose a set according to weighting
-		chosen_set = bisect(cum_weights, random.random() * totalweight)
+		chosen_set = bisect(cum_weights, rng.random() * totalweight)
 
 		# choose a random card from that set
-		chosen_card_index = random.randint(0, len(card_sets[chosen_set]) - 1)
+		size = remaining[chosen_set]
+		slot = rng.randint(0, size - 1)
+		swaps = swapped[chosen_set]
+		chosen_card_index = swaps.get(slot, slot)
+		chosen_cards.append(card_sets[chosen_set][chosen_card_index])
+
+		# Move the last remaining card of the set into the chosen slot
+		swaps[slot] = swaps.get(size - 1, size - 1)
+		remaining[chosen_set] = size - 1
 
-		chosen_cards.append(card_sets[chosen_set].pop(chosen_card_index))
 		totalweight -= weights[chosen_set]
 		cum_weights[chosen_set:] = [x - weights[chosen_set] for x in cum_weights[chosen_set:]]
 
@@ -185,29 +365,30 @@ def setup_game() -> ".game.Game":
 
 def play_turn(game: ".game.Game") -> ".game.Game":
 	player = game.current_player
+	rng = game.random
 
 	while True:
 		heropower = player.hero.power
-		if heropower.is_usable() and random.random() < 0.1:
+		if heropower.is_usable() and rng.random() < 0.1:
 			if heropower.requires_target():
-				heropower.use(target=random.choice(heropower.targets))
+				heropower.use(target=rng.choice(heropower.targets))
 			else:
 				heropower.use()
 			continue
 
 		# iterate over our hand and play whatever is playable
 		for card in player.hand:
-			if card.is_playable() and random.random() < 0.5:
+			if card.is_playable() and rng.random() < 0.5:
 				target = None
 				if card.must_choose_one:
-					card = random.choice(card.choose_cards)
+					card = rng.choice(card.choose_cards)
 				if card.requires_target():
-					target = random.choice(card.targets)
+					target = rng.choice(card.targets)
 				print("Playing %r on %r" % (card, target))
 				card.play(target=target)
 
 				if player.choice:
-					choice = random.choice(player.choice.cards)
+					choice = rng.choice(player.choice.cards)
 					print("Choosing card %r" % (choice))
 					player.choice.choose(choice)
 
@@ -216,7 +397,7 @@ def play_turn(game: ".game.Game") -> ".game.Game":
 		# Randomly attack with whatever can attack
 		for character in player.characters:
 			if character.can_attack():
-				character.attack(random.choice(character.targets))
+				character.attack(rng.choice(character.targets))
 
 		break
 
@@ -229,8 +410,8 @@ def play_full_game() -> ".game.Game":
 
 	for player in game.players:
 		print("Can mulligan %r" % (player.choice.cards))
-		mull_count = random.randint(0, len(player.choice.cards))
-		cards_to_mulligan = random.sample(player.choice.cards, mull_count)
+		mull_count = game.random.randint(0, len(player.choice.cards))
+		cards_to_mulligan = game.random.sample(player.choice.cards, mull_count)
 		player.choice.choose(*cards_to_mulligan)
 
 	while True:
@@ -0,0 +1,273 @@
+"""
+Binary encoding of Kettle packets
+
+A compact alternative to the JSON encoding of the packets sent by Kettle to
+its clients, which clients ask for with the Encodings of their CreateGame
+packet (see KettleGame). Packets sent by clients are always JSON.
+
+A packet starts with the VERSION byte, which no JSON text starts with, and
+is followed by its payloads. Each payload starts with its type (see TYPES),
+followed by its fields:
+- integers are varints (LEB128), zigzag-encoded where they can be negative
+- strings are the varint size of their UTF-8 encoding, then the encoding
+- tags are a varint count, then zigzag (tag, value) pairs
+- lists of entity IDs are a varint count, then the zigzag delta of each ID
+from the previous one, as the IDs of a list are usually close to each other
+
+decode() returns the payloads exactly as decoding the JSON encoding would.
+"""
+
+
+VERSION = 1
+
+TYPES = [
+	"GameEntity", "Player", "FullEntity", "ShowEntity", "TagChange",
+	"ActionStart", "ActionEnd", "Options", "EntityChoices",
+]
+_TYPE_IDS = {type: i for i, type in enumerate(TYPES)}
+
+
+class DecodeError(Exception):
+	pass
+
+
+def _write_varint(out, value):
+	while value > 0x7f:
+		out.append((value & 0x7f) | 0x80)
+		value >>= 7
+	out.append(value)
+
+
+def _write_int(out, value):
+	# zigzag: 0, -1, 1, -2... -> 0, 1, 2, 3...
+	value = int(value)
+	_write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+
+def _write_str(out, value):
+	data = value.encode("utf-8")
+	_write_varint(out, len(data))
+	out += data
+
+
+def _write_tags(out, tags):
+	_write_varint(out, len(tags))
+	for tag, value in tags.items():
+		_write_int(out, tag)
+		_write_int(out, value)
+
+
+def _write_ids(out, ids):
+	_write_varint(out, len(ids))
+	previous = 0
+	for id in ids:
+		id = int(id)
+		_write_int(out, id - previous)
+		previous = id
+
+
+def _write_entity(out, packet):
+	_write_varint(out, int(packet["EntityID"]))
+	_write_tags(out, packet["Tags"])
+
+
+def _write_full_entity(out, packet):
+	_write_str(out, packet["CardID"])
+	_write_entity(out, packet)
+
+
+def _write_tag_change(out, packet):
+	_write_varint(out, int(packet["EntityID"]))
+	_write_varint(out, int(packet["Tag"]))
+	_write_int(out, packet["Value"])
+
+
+def _write_action_start(out, packet):
+	_write_varint(out, int(packet["SubType"]))
+	_write_varint(out, int(packet["EntityID"]))
+	_write_int(out, packet["Index"])
+	_write_varint(out, int(packet["Target"]))
+
+
+def _write_options(out, options):
+	_write_varint(out, len(options))
+	for option in options:
+		_write_varint(out, int(option["Type"]))
+		main_option = option.get("MainOption")
+		if main_option is None:
+			out.append(0)
+		else:
+			out.append(1)
+			_write_varint(out, int(main_option["ID"]))
+			_write_ids(out, main_option["Targets"])
+
+
+def _write_choices(out, choices):
+	_write_varint(out, int(choices["ChoiceType"]))
+	_write_varint(out, int(choices["CountMin"]))
+	_write_varint(out, int(choices["CountMax"]))
+	_write_ids(out, choices["Entities"])
+	_write_varint(out, int(choices["Source"]))
+	_write_varint(out, int(choices["PlayerId"]))
+
+
+def encode(payloads):
+	"""
+	Returns the binary encoding of the packet made of \a payloads.
+	"""
+	out = bytearray([VERSION])
+	for payload in payloads:
+		type = payload["Type"]
+		out.append(_TYPE_IDS[type])
+		if type in ("GameEntity", "Player"):
+			_write_entity(out, payload[type])
+		elif type == "FullEntity":
+			_write_full_entity(out, payload[type])
+		elif type == "ShowEntity":
+			_write_full_entity(out, payload["FullEntity"])
+		elif type == "TagChange":
+			_write_tag_change(out, payload[type])
+		elif type == "ActionStart":
+			_write_action_start(out, payload[type])
+		elif type == "Options":
+			_write_options(out, payload[type])
+		elif type == "EntityChoices":
+			_write_choices(out, payload[type])
+	return bytes(out)
+
+
+class _Reader:
+	def __init__(self, data):
+		self.data = data
+		self.pos = 0
+
+	def byte(self):
+		try:
+			ret = self.data[self.pos]
+		except IndexError:
+			raise DecodeError("Truncated packet")
+		self.pos += 1
+		return ret
+
+	def varint(self):
+		data = self.data
+		pos = self.pos
+		try:
+			byte = data[pos]
+			pos += 1
+			# Most integers fit in a byte
+			if byte < 0x80:
+				self.pos = pos
+				return byte
+			ret = byte & 0x7f
+			shift = 7
+			while True:
+				byte = data[pos]
+				pos += 1
+				ret |= (byte & 0x7f) << shift
+				if byte < 0x80:
+					self.pos = pos
+					return ret
+				shift += 7
+		except IndexError:
+			raise DecodeError("Truncated packet")
+
+	def int(self):
+		value = self.varint()
+		return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+	def str(self):
+		size = self.varint()
+		if self.pos + size > len(self.data):
+			raise DecodeError("Truncated packet")
+		ret = self.data[self.pos:self.pos + size].decode("utf-8")
+		self.pos += size
+		return ret
+
+	def tags(self):
+		ret = {}
+		for i in range(self.varint()):
+			# JSON object keys are strings
+			tag = str(self.int())
+			ret[tag] = self.int()
+		return ret
+
+	def ids(self):
+		ret = []
+		id = 0
+		for i in range(self.varint()):
+			id += self.int()
+			ret.append(id)
+		return ret
+
+	def entity(self):
+		return {"EntityID": self.varint(), "Tags": self.tags()}
+
+	def full_entity(self):
+		card_id = self.str()
+		entity_id = self.varint()
+		return {"CardID": card_id, "EntityID": entity_id, "Tags": self.tags()}
+
+	def tag_change(self):
+		return {"EntityID": self.varint(), "Tag": self.varint(), "Value": self.int()}
+
+	def action_start(self):
+		return {
+			"SubType": self.varint(),
+			"EntityID": self.varint(),
+			"Index": self.int(),
+			"Target": self.varint(),
+		}
+
+	def options(self):
+		ret = []
+		for i in range(self.varint()):
+			option = {"Type": self.varint()}
+			if self.byte():
+				option["MainOption"] = {"ID": self.varint(), "Targets": self.ids()}
+			ret.append(option)
+		return ret
+
+	def choices(self):
+		return {
+			"ChoiceType": self.varint(),
+			"CountMin": self.varint(),
+			"CountMax": self.varint(),
+			"Entities": self.ids(),
+			"Source": self.varint(),
+			"PlayerId": self.varint(),
+		}
+
+
+def decode(data):
+	"""
+	Returns the payloads of the binary encoded packet \a data.
+	"""
+	reader = _Reader(data)
+	version = reader.byte()
+	if version != VERSION:
+		raise DecodeError("Unsupported version: %i" % (version))
+	ret = []
+	while reader.pos < len(data):
+		type_id = reader.byte()
+		if type_id >= len(TYPES):
+			raise DecodeError("Unknown payload type: %i" % (type_id))
+		type = TYPES[type_id]
+		if type in ("GameEntity", "Player"):
+			payload = {"Type": type, type: reader.entity()}
+		elif type == "FullEntity":
+			payload = {"Type": type, type: reader.full_entity()}
+		elif type == "ShowEntity":
+			payload = {"Type": type, "FullEntity": reader.full_entity()}
+		elif type == "TagChange":
+			payload = {"Type": type, type: reader.tag_change()}
+		elif type == "ActionStart":
+			payload = {"Type": type, type: reader.action_start()}
+		elif type == "ActionEnd":
+			payload = {"Type": type}
+		elif type == "Options":
+			payload = {"Type": type, type: reader.options()}
+		elif type == "EntityChoices":
+			payload = {"Type": type, type: reader.choices()}
+		ret.append(payload)
+	return ret
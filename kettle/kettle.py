@@ -1,28 +1,46 @@
 #!/usr/bin/env python
+import asyncio
 import json
 import logging
-import random
-import socketserver
 import struct
 import sys
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 
 from hearthstone.enums import CardType, ChoiceType, GameTag, OptionType, Step, Zone
 
 from fireplace import cards
-from fireplace.exceptions import GameOver
+from fireplace.exceptions import GameOver, InvalidAction
 from fireplace.game import BaseGame as Game
+from fireplace.managers import BaseObserver
 from fireplace.player import Player
 from fireplace.utils import CardList
 
+if __package__:
+	from . import binary
+else:
+	# Run as a script: this module shadows the kettle package, and its
+	# directory is the first in sys.path
+	import binary
+
 
-logging.basicConfig(level=logging.DEBUG)
 KettleLogger = logging.getLogger("kettle")
 KettleLogger.setLevel(logging.DEBUG)
 INFO = KettleLogger.info
-WARN = KettleLogger.warn
+WARN = KettleLogger.warning
 DEBUG = KettleLogger.debug
 
+# Games played at once by a server
+MAX_GAMES = 1000
+# Largest packet accepted from clients, in bytes
+MAX_PACKET_SIZE = 1 << 20
+# Seconds to wait for each packet before dropping a connection
+TIMEOUT = 600
+# Connections waiting to be accepted
+BACKLOG = 1024
+# Encodings of the packets sent to clients, see KettleGame
+ENCODINGS = ("json", "binary")
+
 
 class KettleSerializer(json.JSONEncoder):
 	def default(self, o):
@@ -31,11 +49,17 @@ class KettleSerializer(json.JSONEncoder):
 		return int(o)
 
 
-class KettleManager:
-	def __init__(self, game):
+class KettleManager(BaseObserver):
+	def __init__(self, game, coalesce_tag_changes=True):
 		self.game = game
 		self.game_state = {}
 		self.queued_data = []
+		# Collapse the changes of a tag within a block into its final value
+		self.coalesce_tag_changes = coalesce_tag_changes
+		# (entity ID, tag) -> [index of its first TagChange in queued_data,
+		# value before the first change], for the tags changed since the
+		# last block boundary
+		self.block_changes = {}
 
 	def action_start(self, type, source, index, target):
 		DEBUG("Beginning new action %r (%r, %r, %r)", type, source, index, target)
@@ -50,12 +74,23 @@ class KettleManager:
 		}
 		payload = {"Type": "ActionStart", "ActionStart": packet}
 		self.queued_data.append(payload)
+		self.block_changes = {}
 
 	def action_end(self, type, source):
 		DEBUG("Ending action %r", type)
 		self.refresh_full_state()
 		payload = {"Type": "ActionEnd"}
 		self.queued_data.append(payload)
+		self.block_changes = {}
+
+	def flush(self):
+		"""
+		Returns the queued payloads, and starts a new queue.
+		"""
+		ret = [payload for payload in self.queued_data if payload is not None]
+		self.queued_data = []
+		self.block_changes = {}
+		return ret
 
 	def game_step(self, step, next_step):
 		DEBUG("Game.STEP changes to %r (next step is %r)", step, next_step)
@@ -78,20 +113,24 @@ class KettleManager:
 		value = entity.tags.get(tag, 0)
 		if isinstance(value, str):
 			return
+		previous = state.get(tag, 0)
 		if not value:
-			if state.get(tag, 0):
-				self.tag_change(entity, tag, 0)
+			if previous:
+				self.tag_change(entity, tag, 0, previous)
 				del state[tag]
-		elif int(value) != state.get(tag, 0):
-			self.tag_change(entity, tag, int(value))
+		elif int(value) != previous:
+			self.tag_change(entity, tag, int(value), previous)
 			state[tag] = int(value)
 
 	def refresh_full_state(self):
 		if self.game.step < Step.BEGIN_MULLIGAN:
 			return
-		for entity in self.game:
+		# Only the tags which may have changed since the last refresh
+		# (see GameManager.track_changes())
+		for entity, tags in self.game.manager.changes():
 			if entity.entity_id in self.game_state:
-				self.refresh_state(entity.entity_id)
+				for tag in tags:
+					self.refresh_tag(entity, tag)
 
 	def refresh_state(self, entity_id):
 		assert entity_id in self.game_state
@@ -159,9 +198,10 @@ class KettleManager:
 			return self.refresh_choices()
 		self.options = [{"Type": OptionType.END_TURN}]
 
-		for entity in self.game.current_player.actionable_entities:
-			for option in self.get_options(entity):
-				self.options.append(option)
+		with self.game.cache_targets():
+			for entity in self.game.current_player.actionable_entities:
+				for option in self.get_options(entity):
+					self.options.append(option)
 
 		payload = {
 			"Type": "Options",
@@ -219,7 +259,7 @@ class KettleManager:
 			entities.append(self.get_entity(entity_id))
 		self.game.current_player.choice.choose(*entities)
 
-	def tag_change(self, entity, tag, value):
+	def tag_change(self, entity, tag, value, previous=None):
 		if tag < 0:
 			return
 		DEBUG("Queueing a tag change for entity %r: %r -> %r", entity, tag, value)
@@ -231,6 +271,19 @@ class KettleManager:
 				"Value": value,
 			}
 		}
+		if self.coalesce_tag_changes and previous is not None:
+			key = entity.entity_id, tag
+			change = self.block_changes.get(key)
+			if change is not None:
+				# The change replaces the first one of the block, in place so
+				# that it is not reordered against the other payloads. Those
+				# of the entity itself all come after its FullEntity.
+				if value == change[1]:
+					# Back to its value at the start of the block
+					payload = None
+				self.queued_data[change[0]] = payload
+				return
+			self.block_changes[key] = [len(self.queued_data), previous]
 		self.queued_data.append(payload)
 
 	def game_entity(self, game):
@@ -272,52 +325,81 @@ class KettleManager:
 		}
 
 
-class Kettle(socketserver.BaseRequestHandler):
-	def handle(self):
-		data = self.read_packet()
-		data = data[0]
+class ProtocolError(Exception):
+	pass
+
+
+class KettleGame:
+	"""
+	A game played through Kettle, independently of the network: takes the
+	bodies of the packets of its client, and returns the packets to send
+	back, size prefix included.
+	The packets sent back are in the first of the Encodings listed in the
+	CreateGame packet which is known (see ENCODINGS and kettle.binary), or
+	JSON. Packets sent by the client are JSON.
+	The changes of a tag within a block are sent as one TagChange, unless
+	\a coalesce_tag_changes is False.
+	"""
+	def __init__(self, data, coalesce_tag_changes=True):
+		data = json.loads(data.decode("utf-8"))[0]
 		query_type = data["Type"]
 		payload = data[query_type]
 		DEBUG("Got payload %r", payload)
-		assert query_type == "CreateGame"
-
-		self.serializer = KettleSerializer()
-		manager = self.create_game(payload)
-
-		while True:
-			manager.refresh_full_state()
-			manager.refresh_options()
-			self.send_payload(manager)
-			packet = self.read_packet()
-			if packet is None:
-				break
-			try:
-				self.process_packet(packet, manager)
-			except GameOver:
+		if query_type != "CreateGame":
+			raise ProtocolError("Expected CreateGame, got %r" % (query_type))
+
+		# The first encoding accepted by the client which is known here
+		self.encoding = "json"
+		for encoding in payload.get("Encodings", ()):
+			if encoding in ENCODINGS:
+				self.encoding = encoding
 				break
+		self.serializer = KettleSerializer()
+		self.manager = self.create_game(payload, coalesce_tag_changes)
+
+	def start(self):
+		"""
+		Returns the packets which start the game.
+		"""
+		return [self.refresh()]
+
+	def process(self, data):
+		"""
+		Processes the packet \a data. Returns the packets to send back, and
+		whether the game is over.
+		"""
+		packet = json.loads(data.decode("utf-8"))
+		ret = []
+		try:
+			self.process_packet(packet)
+			ret.append(self.flush())
+		except InvalidAction as e:
+			# Nothing happened, the options are sent again
+			WARN("Invalid option %r: %s", packet, e)
+		except GameOver:
+			# send final power history delta
+			self.manager.refresh_full_state()
+			ret.append(self.flush())
+			return ret, True
+		ret.append(self.refresh())
+		return ret, False
+
+	def refresh(self):
+		self.manager.refresh_full_state()
+		self.manager.refresh_options()
+		return self.flush()
+
+	def flush(self):
+		payloads = self.manager.flush()
+		if self.encoding == "binary":
+			serialized = binary.encode(payloads)
+		else:
+			serialized = self.serializer.encode(payloads).encode("utf-8")
+		DEBUG("Sending %i bytes", len(serialized))
+		return struct.pack("<i", len(serialized)) + serialized
 
-		# send final power history delta
-		manager.refresh_full_state()
-		self.send_payload(manager)
-		self.request.close()
-
-	def read_packet(self):
-		header = self.request.recv(4)
-		if not header:
-			return None
-		body_size, = struct.unpack("<i", header)
-		data = self.request.recv(body_size)
-		DEBUG("Got data %r", data)
-		return json.loads(data.decode("utf-8"))
-
-	def send_payload(self, manager):
-		serialized = self.serializer.encode(manager.queued_data).encode("utf-8")
-		manager.queued_data = []
-		response_payload = struct.pack("<i", len(serialized)) + serialized
-		DEBUG("Sending %r" % (response_payload))
-		self.request.sendall(response_payload)
-
-	def process_packet(self, packet, manager):
+	def process_packet(self, packet):
+		manager = self.manager
 		if packet["Type"] == "SendOption":
 			# throws GameOver when game ends
 			manager.process_send_option(packet["SendOption"])
@@ -329,23 +411,24 @@ class Kettle(socketserver.BaseRequestHandler):
 			manager.refresh_full_state()
 		else:
 			raise NotImplementedError
-		self.send_payload(manager)
 
-	def create_game(self, payload):
+	def create_game(self, payload, coalesce_tag_changes=True):
 		# self.game_id = payload["GameID"]
 		player_data = payload["Players"]
 		players = []
 		for player in player_data:
-			# Shuffle the cards to prevent information leaking
-			cards = player["Cards"]
-			random.shuffle(cards)
-			p = Player(player["Name"], cards, player["Hero"])
+			p = Player(player["Name"], player["Cards"], player["Hero"])
 			players.append(p)
 
-		INFO("Initializing a Kettle game with players=%r", players)
-		game = Game(players=players)
-		manager = KettleManager(game)
+		# An optional seed makes the game reproducible
+		game = Game(players=players, seed=payload.get("Seed"))
+		INFO("Initializing a Kettle game with players=%r, seed=%r", players, game.seed)
+		for player in players:
+			# Shuffle the cards to prevent information leaking
+			game.random.shuffle(player.starting_deck)
+		manager = KettleManager(game, coalesce_tag_changes)
 		game.manager.register(manager)
+		game.manager.track_changes()
 		game.current_player = game.players[0]  # Dumb.
 		game.start()
 
@@ -356,25 +439,274 @@ class Kettle(socketserver.BaseRequestHandler):
 		return manager
 
 
-class KettleServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-	daemon_threads = True
-	allow_reuse_address = True
+class LocalGames:
+	"""
+	Plays Kettle games on the event loop of the server.
+	"""
+	def __init__(self):
+		self.games = {}
+
+	async def start(self):
+		pass
+
+	async def create(self, game_id, data):
+		game = self.games[game_id] = KettleGame(data)
+		return game.start()
+
+	async def process(self, game_id, data):
+		return self.games[game_id].process(data)
+
+	async def end(self, game_id):
+		self.games.pop(game_id, None)
+
+	def close(self):
+		self.games.clear()
+
+
+# The games of a worker process, by game ID
+_worker_games = {}
+
+
+def _worker_init():
+	if not cards.db.initialized:
+		cards.db.initialize()
+
+
+def _worker_create(game_id, data):
+	game = _worker_games[game_id] = KettleGame(data)
+	return game.start()
+
+
+def _worker_process(game_id, data):
+	return _worker_games[game_id].process(data)
+
+
+def _worker_end(game_id):
+	_worker_games.pop(game_id, None)
+
+
+class WorkerGames:
+	"""
+	Plays Kettle games in \a workers worker processes, leaving only the
+	framing and routing of packets to the event loop of the server.
+	Each game lives in a single worker, the least busy one when it starts.
+	"""
+	def __init__(self, workers):
+		self.workers = [ProcessPoolExecutor(max_workers=1) for i in range(workers)]
+		self.load = [0] * workers
+		# game ID -> index of its worker
+		self.games = {}
+
+	async def start(self):
+		# Start the workers before any connection is accepted, so that they
+		# do not inherit the sockets of the server
+		loop = asyncio.get_event_loop()
+		await asyncio.gather(*[
+			loop.run_in_executor(worker, _worker_init) for worker in self.workers
+		])
+
+	def _run(self, game_id, func, *args):
+		worker = self.workers[self.games[game_id]]
+		return asyncio.get_event_loop().run_in_executor(worker, func, game_id, *args)
+
+	async def create(self, game_id, data):
+		index = self.load.index(min(self.load))
+		self.games[game_id] = index
+		self.load[index] += 1
+		return await self._run(game_id, _worker_create, data)
+
+	async def process(self, game_id, data):
+		return await self._run(game_id, _worker_process, data)
+
+	async def end(self, game_id):
+		if game_id not in self.games:
+			return
+		try:
+			await self._run(game_id, _worker_end)
+		finally:
+			self.load[self.games.pop(game_id)] -= 1
+
+	def close(self):
+		for worker in self.workers:
+			worker.shutdown()
+
+
+class Kettle:
+	"""
+	A Kettle session: plays the game created by the first packet received on
+	its connection in \a games (see LocalGames and WorkerGames), sending the
+	power history and the options of the game back after each packet.
+	Packets are JSON, prefixed with their size as a little-endian int32.
+	"""
+	def __init__(
+		self, reader, writer, games, game_id, max_packet_size=MAX_PACKET_SIZE, timeout=TIMEOUT
+	):
+		self.reader = reader
+		self.writer = writer
+		self.games = games
+		self.game_id = game_id
+		self.max_packet_size = max_packet_size
+		self.timeout = timeout
+
+	async def handle(self):
+		data = await self.read_packet()
+		if data is None:
+			return
+
+		try:
+			await self.send(await self.games.create(self.game_id, data))
+			while True:
+				data = await self.read_packet()
+				if data is None:
+					break
+				packets, game_over = await self.games.process(self.game_id, data)
+				await self.send(packets)
+				if game_over:
+					break
+		finally:
+			await self.games.end(self.game_id)
+
+	async def read_packet(self):
+		"""
+		Returns the body of the next packet, or None if the connection was
+		closed.
+		"""
+		try:
+			header = await asyncio.wait_for(self.reader.readexactly(4), self.timeout)
+		except asyncio.IncompleteReadError as e:
+			if e.partial:
+				raise ProtocolError("Connection closed in a packet header")
+			return None
+		body_size, = struct.unpack("<i", header)
+		if not 0 < body_size <= self.max_packet_size:
+			raise ProtocolError("Invalid packet size: %i" % (body_size))
+		# The body may arrive in any number of segments
+		data = await asyncio.wait_for(self.reader.readexactly(body_size), self.timeout)
+		DEBUG("Got %i bytes", len(data))
+		return data
+
+	async def send(self, packets):
+		for packet in packets:
+			self.writer.write(packet)
+		# Wait for slow clients to catch up before going on with the game
+		await self.writer.drain()
+
+
+class KettleServer:
+	"""
+	Serves Kettle sessions, one per connection, as tasks of an event loop.
+	At most \a max_games games are played at once: the games of further
+	connections start as soon as others end.
+	With \a workers, the games are played in that many worker processes
+	rather than on the event loop (see WorkerGames).
+	"""
+	def __init__(
+		self, max_games=MAX_GAMES, max_packet_size=MAX_PACKET_SIZE, timeout=TIMEOUT, workers=0
+	):
+		self.max_games = max_games
+		self.max_packet_size = max_packet_size
+		self.timeout = timeout
+		self.workers = workers
+		self.server = None
+		# The task of each connection
+		self.sessions = set()
+		self.games = 0
+		self.last_game_id = 0
+
+	async def start(self, host, port, backlog=BACKLOG):
+		self.slots = asyncio.Semaphore(self.max_games)
+		if self.workers:
+			self.backend = WorkerGames(self.workers)
+		else:
+			self.backend = LocalGames()
+		await self.backend.start()
+		self.server = await asyncio.start_server(
+			self.new_connection, host, port, backlog=backlog
+		)
+		return self.server
+
+	async def close(self):
+		"""
+		Stop accepting connections and end the current sessions.
+		"""
+		self.server.close()
+		for task in self.sessions:
+			task.cancel()
+		await asyncio.gather(*self.sessions, return_exceptions=True)
+		await self.server.wait_closed()
+		self.backend.close()
+
+	@property
+	def sockets(self):
+		return self.server.sockets
+
+	def new_connection(self, reader, writer):
+		task = asyncio.ensure_future(self.handle_connection(reader, writer))
+		self.sessions.add(task)
+		task.add_done_callback(self.sessions.discard)
+
+	async def handle_connection(self, reader, writer):
+		peer = writer.get_extra_info("peername")
+		self.last_game_id += 1
+		session = Kettle(
+			reader, writer, self.backend, self.last_game_id, self.max_packet_size, self.timeout
+		)
+		try:
+			async with self.slots:
+				self.games += 1
+				try:
+					await session.handle()
+				finally:
+					self.games -= 1
+		except (ConnectionError, ProtocolError, asyncio.IncompleteReadError) as e:
+			WARN("Dropping connection from %r: %s", peer, e)
+		except asyncio.TimeoutError:
+			WARN("Dropping connection from %r: timed out", peer)
+		except asyncio.CancelledError:
+			raise
+		except Exception:
+			KettleLogger.exception("Error in the game of %r", peer)
+		finally:
+			writer.close()
 
 
 def main():
 	arguments = ArgumentParser(prog="kettle")
 	arguments.add_argument("hostname", default="127.0.0.1", nargs="?")
 	arguments.add_argument("port", type=int, default=9111, nargs="?")
+	arguments.add_argument(
+		"--max-games", type=int, default=MAX_GAMES, help="games played at once"
+	)
+	arguments.add_argument(
+		"--max-packet-size", type=int, default=MAX_PACKET_SIZE, help="in bytes"
+	)
+	arguments.add_argument(
+		"--timeout", type=float, default=TIMEOUT, help="seconds to wait for each packet"
+	)
+	arguments.add_argument(
+		"--backlog", type=int, default=BACKLOG, help="pending connections to queue"
+	)
+	arguments.add_argument(
+		"--workers", type=int, default=0,
+		help="worker processes to play the games in, rather than in the server process"
+	)
 	args = arguments.parse_args(sys.argv[1:])
 
+	logging.basicConfig(level=logging.DEBUG)
 	cards.db.initialize()
 
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	kettle = KettleServer(args.max_games, args.max_packet_size, args.timeout, args.workers)
+	loop.run_until_complete(kettle.start(args.hostname, args.port, args.backlog))
 	INFO("Listening on %s:%i..." % (args.hostname, args.port))
-	kettle = KettleServer((args.hostname, args.port), Kettle)
 	try:
-		kettle.serve_forever()
+		loop.run_forever()
 	except KeyboardInterrupt:
-		sys.exit(0)
+		pass
+	finally:
+		loop.run_until_complete(kettle.close())
+		loop.close()
 
 	return 0
 
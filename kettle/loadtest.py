@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+Kettle load test
+
+Plays games between random clients against a Kettle server, with a number of
+concurrent sessions at once, and reports the games and packets played per second
+and the latency percentiles of the responses of the server:
+
+	python -m kettle.loadtest --sessions 10 100 1000
+
+A server is started in this process unless one is given with --connect.
+"""
+import asyncio
+import json
+import logging
+import random
+import struct
+import sys
+import time
+from argparse import ArgumentParser
+
+from hearthstone.enums import CardClass
+
+from fireplace import cards
+from fireplace.logging import set_headless
+from fireplace.simulate import PLAY_CHANCE, make_specs
+from fireplace.utils import random_draft
+
+from . import binary
+from .kettle import ENCODINGS, KettleLogger, KettleServer
+
+
+# Actions after which the clients concede, to bound the length of games
+MAX_ACTIONS = 100
+
+
+async def read_packet(reader):
+	try:
+		header = await reader.readexactly(4)
+	except asyncio.IncompleteReadError as e:
+		if e.partial:
+			raise
+		return None
+	body_size, = struct.unpack("<i", header)
+	data = await reader.readexactly(body_size)
+	if data[0] == binary.VERSION:
+		return binary.decode(data)
+	return json.loads(data.decode("utf-8"))
+
+
+def send_packet(writer, packet):
+	data = json.dumps(packet).encode("utf-8")
+	writer.write(struct.pack("<i", len(data)) + data)
+
+
+def create_game(spec, encoding="json"):
+	rng = random.Random(spec["seed"])
+	players = []
+	for i, card_class in enumerate(spec["classes"]):
+		card_class = CardClass(card_class)
+		players.append({
+			"Name": "Player%i" % (i + 1),
+			"Cards": random_draft(card_class, rng=rng),
+			"Hero": card_class.default_hero,
+		})
+	return [{"Type": "CreateGame", "CreateGame": {
+		"Players": players,
+		"Seed": spec["seed"],
+		"Encodings": [encoding],
+	}}]
+
+
+def respond(packet, rng):
+	"""
+	Returns the response of a random client to \a packet, or None if the
+	packet does not expect one.
+	"""
+	for payload in reversed(packet):
+		if payload["Type"] == "Options":
+			options = payload["Options"]
+			index = 0
+			if len(options) > 1 and rng.random() < PLAY_CHANCE:
+				index = rng.randrange(1, len(options))
+			targets = options[index].get("MainOption", {}).get("Targets")
+			return {"Type": "SendOption", "SendOption": {
+				"Index": index,
+				"Target": rng.choice(targets) if targets else 0,
+				"Position": 0,
+			}}
+		elif payload["Type"] == "EntityChoices":
+			choices = payload["EntityChoices"]
+			count = rng.randint(choices["CountMin"], choices["CountMax"])
+			return {
+				"Type": "ChooseEntities",
+				"ChooseEntities": rng.sample(choices["Entities"], count),
+			}
+	return None
+
+
+async def play_game(host, port, spec, latencies, max_actions=MAX_ACTIONS, encoding="json"):
+	"""
+	Play the game described by \a spec (see fireplace.simulate.make_specs())
+	on the server at \a host:\a port, conceding after \a max_actions.
+	The latency of each response of the server is appended to \a latencies.
+	"""
+	rng = random.Random(spec["seed"])
+	reader, writer = await asyncio.open_connection(host, port)
+	try:
+		send_packet(writer, create_game(spec, encoding))
+		sent = time.perf_counter()
+		actions = 0
+		while True:
+			packet = await read_packet(reader)
+			if packet is None:
+				# The server closes the connection when the game is over
+				break
+			response = respond(packet, rng)
+			if response is None:
+				continue
+			latencies.append(time.perf_counter() - sent)
+			if actions >= max_actions:
+				response = {"Type": "Concede", "Concede": 1}
+			send_packet(writer, response)
+			await writer.drain()
+			sent = time.perf_counter()
+			actions += 1
+	finally:
+		writer.close()
+
+
+async def run_sessions(
+	host, port, sessions, games, seed=None, max_actions=MAX_ACTIONS, encoding="json"
+):
+	"""
+	Play \a games games across \a sessions concurrent sessions.
+	Returns a Report of the run.
+	"""
+	report = Report(sessions)
+	specs = make_specs(games, seed)
+
+	async def session():
+		while specs:
+			spec = specs.pop()
+			try:
+				await play_game(host, port, spec, report.latencies, max_actions, encoding)
+				report.games += 1
+			except (ConnectionError, asyncio.IncompleteReadError) as e:
+				KettleLogger.warning("Game %r failed: %s", spec["seed"], e)
+				report.errors += 1
+
+	start = time.perf_counter()
+	await asyncio.gather(*[session() for i in range(sessions)])
+	report.elapsed = time.perf_counter() - start
+	return report
+
+
+def percentile(values, p):
+	"""
+	Returns the \a p-th percentile of the sorted \a values (nearest rank).
+	"""
+	if not values:
+		return 0.0
+	index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+	return values[index]
+
+
+class Report:
+	def __init__(self, sessions):
+		self.sessions = sessions
+		self.games = 0
+		self.errors = 0
+		self.elapsed = 0.0
+		self.latencies = []
+
+	def __str__(self):
+		latencies = sorted(self.latencies)
+		elapsed = self.elapsed or float("inf")
+		return (
+			"%5i sessions: %5i games (%i errors) in %7.2fs, %7.2f games/s, %8.1f packets/s, "
+			"latency (ms) p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" % (
+				self.sessions, self.games, self.errors, self.elapsed,
+				self.games / elapsed, len(latencies) / elapsed,
+				percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+				percentile(latencies, 99) * 1000, percentile(latencies, 100) * 1000,
+			)
+		)
+
+
+async def load_test(args):
+	server = None
+	if args.connect:
+		host, port = args.connect.rsplit(":", 1)
+		port = int(port)
+	else:
+		host = "127.0.0.1"
+		server = KettleServer(max_games=args.max_games, workers=args.workers)
+		await server.start(host, 0, backlog=max(args.sessions))
+		port = server.sockets[0].getsockname()[1]
+
+	try:
+		for sessions in args.sessions:
+			games = args.games or sessions
+			report = await run_sessions(
+				host, port, sessions, games, args.seed, args.max_actions, args.encoding
+			)
+			print(report)
+	finally:
+		if server:
+			await server.close()
+
+
+def main():
+	arguments = ArgumentParser(prog="kettle.loadtest")
+	arguments.add_argument(
+		"--sessions", type=int, nargs="+", default=[10, 100, 1000],
+		help="concurrent sessions of each run"
+	)
+	arguments.add_argument(
+		"--games", type=int, default=None,
+		help="games played in each run, defaults to the number of sessions"
+	)
+	arguments.add_argument(
+		"--max-actions", type=int, default=MAX_ACTIONS,
+		help="actions after which the clients concede"
+	)
+	arguments.add_argument("--seed", type=int, default=None, help="seed of the games")
+	arguments.add_argument(
+		"--connect", default=None, metavar="HOST:PORT",
+		help="server to test, instead of one in this process"
+	)
+	arguments.add_argument(
+		"--max-games", type=int, default=None,
+		help="games played at once by the server in this process"
+	)
+	arguments.add_argument(
+		"--workers", type=int, default=0,
+		help="worker processes of the server in this process (see KettleServer)"
+	)
+	arguments.add_argument(
+		"--encoding", choices=ENCODINGS, default="json",
+		help="encoding of the packets sent by the server"
+	)
+	args = arguments.parse_args(sys.argv[1:])
+	if args.max_games is None:
+		args.max_games = max(args.sessions)
+
+	logging.basicConfig(level=logging.WARNING)
+	KettleLogger.setLevel(logging.WARNING)
+	set_headless()
+	cards.db.initialize()
+
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	try:
+		loop.run_until_complete(load_test(args))
+	finally:
+		loop.close()
+
+	return 0
+
+
+if __name__ == "__main__":
+	exit(main())
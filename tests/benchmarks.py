@@ -8,11 +8,22 @@ Note that py.test will skip these by default. To run (with pytest-benchmark inst
 To increase the number of iterations, set --benchmark-min-rounds.
 """
 
+import asyncio
+import json
+import os
+import random
+
 import pytest
 from full_game import test_full_game
 from utils import *
+from kettle import binary
+from kettle.kettle import KettleGame, KettleServer
+from kettle.loadtest import create_game, respond, run_sessions
 
+import fireplace.cards
+import fireplace.simulate
 import fireplace.utils
+from fireplace.logging import set_headless
 
 
 ARBITRARY_SEED = 1857
@@ -39,6 +50,137 @@ def test_selectors(benchmark):
 	benchmark(run_selector, game, alex)
 
 
+def read_attributes(minion):
+	minion.atk
+	minion.max_health
+	minion.taunt
+	minion.stealthed
+	minion.charge
+	minion.cant_attack
+
+
+@pytest.mark.benchmark(
+	group="attributes"
+)
+def test_buffed_attributes(benchmark):
+	game = prepare_empty_game()
+	game.player1.give("CS2_122").play()
+	game.player1.give("EX1_565").play()
+	wisp = game.player1.give(WISP)
+	wisp.play()
+	for i in range(3):
+		game.player1.give("CS2_087").play(target=wisp)
+
+	benchmark(read_attributes, wisp)
+
+
+def prepare_midgame_board():
+	game = prepare_empty_game(CardClass.MAGE, CardClass.WARRIOR)
+	for id in ("CS2_182", "EX1_565", "CS2_122", "EX1_011", WISP):
+		game.player1.summon(id)
+		game.player2.summon(id)
+	game.player2.summon("EX1_405")
+	for id in (MOONFIRE, "CS2_108", "EX1_154", "NEW1_008", "CS2_029", "CS2_182", "EX1_011"):
+		game.player1.give(id)
+	game.end_turn()
+	game.end_turn()
+	return game
+
+
+def enumerate_options(player):
+	# The way play_turn() and Kettle discover options
+	ret = []
+	for card in player.hand:
+		if card.is_playable():
+			for choose in card.choose_cards or (card, ):
+				if choose.requires_target():
+					ret += [(card, target) for target in card.targets]
+				else:
+					ret.append((card, None))
+	power = player.hero.power
+	if power.is_usable():
+		if power.requires_target():
+			ret += [(power, target) for target in power.targets]
+		else:
+			ret.append((power, None))
+	for character in player.characters:
+		if character.can_attack():
+			ret += [(character, target) for target in character.targets]
+	return ret
+
+
+@pytest.mark.benchmark(
+	group="options"
+)
+def test_legal_actions(benchmark):
+	game = prepare_midgame_board()
+	player = game.player1
+	# END_TURN is not in the naive enumeration
+	assert len(player.legal_actions()) == len(enumerate_options(player)) + 1
+
+	benchmark(player.legal_actions)
+
+
+@pytest.mark.benchmark(
+	group="options"
+)
+def test_enumerate_options(benchmark):
+	game = prepare_midgame_board()
+
+	benchmark(enumerate_options, game.player1)
+
+
+def prepare_midgame():
+	random.seed(ARBITRARY_SEED)
+	game = prepare_game()
+	for i in range(30):
+		player = game.current_player
+		actions = player.legal_actions()
+		# Play whatever can be played most of the time, before ending the turn
+		if len(actions) > 1 and random.random() < 0.8:
+			player.perform(random.choice(actions[1:]))
+		else:
+			player.perform(actions[0])
+	return game
+
+
+def search_with_rollback(game):
+	player = game.current_player
+	for action in player.legal_actions():
+		game.checkpoint()
+		player.perform(action)
+		game.rollback()
+
+
+def search_with_copies(game, copy):
+	for i in range(len(game.current_player.legal_actions())):
+		player = copy().current_player
+		player.perform(player.legal_actions()[i])
+
+
+@pytest.mark.benchmark(
+	group="search"
+)
+def test_search_rollback(benchmark):
+	benchmark(search_with_rollback, prepare_midgame())
+
+
+@pytest.mark.benchmark(
+	group="search"
+)
+def test_search_clone(benchmark):
+	game = prepare_midgame()
+	benchmark(search_with_copies, game, game.clone)
+
+
+@pytest.mark.benchmark(
+	group="search"
+)
+def test_search_branch(benchmark):
+	game = prepare_midgame()
+	benchmark(search_with_copies, game, game.branch)
+
+
 def seeded_fullgame():
 	random.seed(ARBITRARY_SEED)
 	test_full_game()
@@ -58,3 +200,174 @@ def test_fullgame(benchmark):
 def test_singleturn(benchmark):
 	benchmark.weave(fireplace.utils.play_turn, lazy=True)
 	seeded_fullgame()
+
+
+def initialize_carddb(lazy):
+	db = fireplace.cards.CardDB()
+	db.initialize(cache=False, lazy=lazy)
+	# Look up about as many cards as a typical game does
+	for id in db.filter(collectible=True)[:60]:
+		db[id]
+
+
+@pytest.mark.benchmark(
+	group="carddb"
+)
+def test_carddb_initialize_eager(benchmark):
+	benchmark.pedantic(initialize_carddb, args=(False, ), rounds=5)
+
+
+@pytest.mark.benchmark(
+	group="carddb"
+)
+def test_carddb_initialize_lazy(benchmark):
+	benchmark.pedantic(initialize_carddb, args=(True, ), rounds=5)
+
+
+@pytest.mark.benchmark(
+	group="logging"
+)
+@pytest.mark.parametrize("headless", [False, True])
+def test_fullgame_logging(benchmark, headless):
+	specs = fireplace.simulate.make_specs(10, ARBITRARY_SEED)
+
+	def run():
+		for spec in specs:
+			fireplace.simulate.simulate_game(spec)
+
+	set_headless(headless)
+	try:
+		benchmark.pedantic(run, rounds=3)
+	finally:
+		set_headless(False)
+
+
+SIMULATED_GAMES = 32
+
+
+def simulation_processes():
+	# 1, 2, 4... up to all of the cores
+	count = os.cpu_count()
+	ret = {count}
+	processes = 1
+	while processes < count:
+		ret.add(processes)
+		processes *= 2
+	return sorted(ret)
+
+
+@pytest.mark.benchmark(
+	group="simulate"
+)
+@pytest.mark.parametrize("processes", simulation_processes())
+def test_simulate_scaling(benchmark, processes):
+	specs = fireplace.simulate.make_specs(SIMULATED_GAMES, ARBITRARY_SEED)
+
+	def run():
+		results = list(fireplace.simulate.simulate(specs, processes))
+		assert len(results) == SIMULATED_GAMES
+
+	benchmark.pedantic(run, rounds=3)
+
+
+KETTLE_SESSIONS = 32
+KETTLE_ACTIONS = 20
+
+
+@pytest.mark.benchmark(
+	group="kettle"
+)
+@pytest.mark.parametrize("workers", [0] + simulation_processes())
+def test_kettle_workers(benchmark, workers):
+	# Packets played per second by a Kettle server, by number of worker processes
+	async def load_test():
+		server = KettleServer(max_games=KETTLE_SESSIONS, workers=workers)
+		await server.start("127.0.0.1", 0)
+		port = server.sockets[0].getsockname()[1]
+		try:
+			return await run_sessions(
+				"127.0.0.1", port, KETTLE_SESSIONS, KETTLE_SESSIONS, ARBITRARY_SEED, KETTLE_ACTIONS
+			)
+		finally:
+			await server.close()
+
+	def run():
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		try:
+			report = loop.run_until_complete(load_test())
+		finally:
+			loop.close()
+			asyncio.set_event_loop(None)
+		assert not report.errors
+		benchmark.extra_info["packets/s"] = len(report.latencies) / report.elapsed
+
+	set_headless()
+	try:
+		benchmark.pedantic(run, rounds=3)
+	finally:
+		set_headless(False)
+
+
+def record_kettle_game():
+	# The payloads of the packets of a typical Kettle game, and its number of turns
+	spec = fireplace.simulate.make_specs(1, ARBITRARY_SEED)[0]
+	rng = random.Random(ARBITRARY_SEED)
+	game = KettleGame(json.dumps(create_game(spec)).encode("utf-8"))
+	packets = game.start()
+	ret = []
+	game_over = False
+	while not game_over:
+		for packet in packets:
+			ret.append(json.loads(packet[4:].decode("utf-8")))
+		response = respond(ret[-1], rng)
+		if game.manager.game.turn > 30:
+			response = {"Type": "Concede", "Concede": 1}
+		packets, game_over = game.process(json.dumps(response).encode("utf-8"))
+	for packet in packets:
+		ret.append(json.loads(packet[4:].decode("utf-8")))
+	return ret, game.manager.game.turn
+
+
+KETTLE_ENCODINGS = {
+	"json": (lambda payloads: json.dumps(payloads).encode("utf-8"), json.loads),
+	"binary": (binary.encode, binary.decode),
+}
+
+
+@pytest.mark.benchmark(
+	group="kettle-encode"
+)
+@pytest.mark.parametrize("encoding", KETTLE_ENCODINGS)
+def test_kettle_encode(benchmark, encoding):
+	set_headless()
+	try:
+		packets, turns = record_kettle_game()
+	finally:
+		set_headless(False)
+	encode, decode = KETTLE_ENCODINGS[encoding]
+
+	def run():
+		return [encode(payloads) for payloads in packets]
+
+	data = benchmark(run)
+	benchmark.extra_info["bytes/turn"] = sum(len(body) for body in data) / turns
+
+
+@pytest.mark.benchmark(
+	group="kettle-decode"
+)
+@pytest.mark.parametrize("encoding", KETTLE_ENCODINGS)
+def test_kettle_decode(benchmark, encoding):
+	set_headless()
+	try:
+		packets, turns = record_kettle_game()
+	finally:
+		set_headless(False)
+	encode, decode = KETTLE_ENCODINGS[encoding]
+	data = [encode(payloads) for payloads in packets]
+
+	def run():
+		return [decode(body) for body in data]
+
+	assert benchmark(run) == packets
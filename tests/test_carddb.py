@@ -45,3 +45,106 @@ def test_card_docstrings():
 			if name.endswith(")"):
 				continue
 			assert name == card.name
+
+
+def test_carddb_cache(tmpdir):
+	from fireplace.cards import CardDB, cache
+
+	cache_dir = str(tmpdir)
+	assert cache.load(cache_dir) is None
+	path = cache.save(CARDS, cache_dir)
+	assert path == cache.get_cache_path(cache_dir)
+
+	db = CardDB()
+	db.initialize(cache=True, cache_dir=cache_dir)
+	assert db.keys() == CARDS.keys()
+	for id, card in CARDS.items():
+		cached = db[id]
+		assert cached.tags == card.tags
+		assert cached.requirements == card.requirements
+		assert cached.choose_cards == card.choose_cards
+		assert cached.scripts.__bases__ == card.scripts.__bases__
+		assert (cached.target_validator is None) == (card.target_validator is None)
+
+
+def test_carddb_cache_invalidation(tmpdir):
+	from fireplace.cards import cache
+
+	cache_dir = str(tmpdir)
+	stale = tmpdir.join(cache.CACHE_PREFIX + "0" * 40 + cache.CACHE_SUFFIX)
+	stale.write("")
+	assert cache.load(cache_dir) is None
+	cache.save(CARDS, cache_dir)
+	assert not stale.check()
+	assert cache.load(cache_dir) is not None
+
+
+def test_carddb_lazy():
+	from fireplace.cards import CardDB
+
+	db = CardDB()
+	db.initialize(lazy=True)
+	# Custom cards are only registered in the global database
+	assert db.keys() <= CARDS.keys()
+	assert db._unmerged
+
+	# Filtering does not merge anything
+	assert db.filter(collectible=True, type=CardType.MINION, cost=3)
+	assert not hasattr(dict.__getitem__(db, "EX1_561"), "scripts")
+
+	alexstrasza = db["EX1_561"]
+	assert "EX1_561" not in db._unmerged
+	assert alexstrasza.scripts.play
+	assert db.get("EX1_561") is alexstrasza
+
+	for card in db.values():
+		assert card.scripts
+	assert not db._unmerged
+
+
+def test_script_registry():
+	from importlib import import_module
+	from fireplace.utils import CARD_SETS, get_script_definition
+
+	modules = [import_module("fireplace.cards.%s" % (cardset)) for cardset in CARD_SETS]
+	for id in CARDS.keys():
+		for module in modules:
+			if hasattr(module, id):
+				assert get_script_definition(id) is getattr(module, id)
+				break
+		else:
+			assert get_script_definition(id) is None
+
+
+def test_filter_indexes():
+	from hearthstone.enums import CardClass, Race
+
+	def scan(**kwargs):
+		cards = list(dict.values(CARDS))
+		for attr, value in kwargs.items():
+			if value is not None:
+				cards = [
+					card for card in cards if (
+						isinstance(value, list) and getattr(card, attr) in value
+					) or getattr(card, attr) == value
+				]
+		return [card.id for card in cards]
+
+	default_types = [CardType.SPELL, CardType.WEAPON, CardType.MINION]
+	queries = [
+		{},
+		{"collectible": True},
+		{"collectible": True, "type": CardType.MINION, "cost": 3},
+		{"collectible": True, "card_class": CardClass.NEUTRAL, "rarity": Rarity.LEGENDARY},
+		{"race": Race.TOTEM, "type": None},
+		{"spare_part": True},
+		{"card_class": CardClass.MAGE, "type": [CardType.SPELL, CardType.MINION]},
+		{"collectible": True, "elite": True},
+		{"cost": 42},
+	]
+	for query in queries:
+		expected = scan(**{"type": default_types, **query})
+		assert CARDS.filter(**query) == expected
+		# Memoized results are copies
+		CARDS.filter(**query).clear()
+		assert CARDS.filter(**query) == expected
@@ -3,6 +3,7 @@ import pytest
 from utils import *
 
 from fireplace.card import Card
+from fireplace.cards.utils import custom_card
 from fireplace.dsl import *
 from fireplace.exceptions import *
 
@@ -40,6 +41,54 @@ def test_random_card_picker():
 		assert card.type is not CardType.HERO_POWER
 
 
+def test_random_card_picker_pools():
+	game = prepare_game()
+	picker = RandomMinion(cost=3)
+	pools = picker.get_pools(game.player1)
+	assert picker.get_pools(game.player1) is pools
+	assert (picker * 2).get_pools(game.player1) is pools
+	pool = pools[0]
+	size = len(pool)
+
+	cards = (picker * 10).evaluate(game.player1)
+	assert len(cards) == 10
+	assert len(set(card.id for card in cards)) == 10
+	for card in cards:
+		assert card.id in pool
+		assert card.cost == 3
+	assert len(pool) == size
+
+	# Lazy filters are evaluated every time
+	lazy_picker = RandomMinion(cost=Attr(SELF, GameTag.COST))
+	lazy_picker.get_pools(game.player1.hero)
+	assert lazy_picker._pools is None
+
+	# Cached pools are found again when cards are added to the database
+	@custom_card
+	class FIREPLACE_TEST_RANDOM_MINION:
+		tags = {
+			GameTag.CARDNAME: "Random Minion",
+			GameTag.CARDTYPE: CardType.MINION,
+			GameTag.COLLECTIBLE: True,
+			GameTag.COST: 3,
+		}
+	try:
+		assert "FIREPLACE_TEST_RANDOM_MINION" in picker.get_pools(game.player1)[0]
+	finally:
+		del fireplace.cards.db["FIREPLACE_TEST_RANDOM_MINION"]
+	assert picker.get_pools(game.player1)[0] == pool
+
+
+def test_weighted_card_choice():
+	from fireplace.utils import weighted_card_choice
+
+	game = prepare_game()
+	card_sets = ((WISP, ), (MOONFIRE, INNERVATE, PYROBLAST))
+	cards = weighted_card_choice(game.player1, [100, 1], card_sets, 4)
+	assert sorted(card.id for card in cards) == sorted(card_sets[0] + card_sets[1])
+	assert card_sets == ((WISP, ), (MOONFIRE, INNERVATE, PYROBLAST))
+
+
 def test_controller():
 	game = prepare_game()
 	game.player1.discard_hand()
@@ -200,3 +249,71 @@ def test_hijack():
 	with hijacked(RANDOM_ENEMY_MINION, FRIENDLY_HERO):
 		with pytest.raises(GameOver):
 			vial.play()
+
+
+def test_selector_volatile():
+	assert not FRIENDLY_MINIONS.volatile
+	assert not (FRIENDLY_MINIONS + BEAST - SELF).volatile
+	assert not SELF_ADJACENT.volatile
+	assert not (ALL_HERO_POWERS + ID("BRMA03_2")).volatile
+	assert not OWNER_OPPONENT.volatile
+	assert (FRIENDLY_MINIONS + CHARGE).volatile
+	assert (ALL_CHARACTERS + DAMAGED).volatile
+	assert RANDOM_MINION.volatile
+	assert CURRENT_PLAYER.volatile
+
+	assert not Refresh(SELF, {GameTag.ATK: +2}).volatile
+	assert not Refresh(FRIENDLY_HERO, {GameTag.ATK: lambda self, i: i}).volatile
+	assert not Refresh(FRIENDLY_MINIONS - SELF, buff="CS2_122e").volatile
+	assert Refresh(SELF, {GameTag.ATK: Count(FRIENDLY_HAND)}).volatile
+	assert not Refresh(ALL_MINIONS + MURLOC - SELF, {GameTag.ATK: +1}).volatile
+
+
+def test_selector_compile():
+	game = prepare_game()
+	wisp1 = game.player1.give(WISP)
+	wisp1.play()
+	wisp2 = game.player1.give(WISP)
+	wisp2.play()
+	wisp3 = game.player2.summon(WISP)
+	hero = game.player1.hero
+	ids = lambda entities: [e.entity_id for e in entities]
+
+	selector = (IN_PLAY + FRIENDLY) + MINION
+	assert list(selector._operands()) == [IN_PLAY, FRIENDLY, MINION]
+	entities = [wisp2, hero, wisp1, wisp3, wisp2]
+	assert ids(selector.eval(entities, hero)) == ids([wisp2, wisp1, wisp2])
+	assert ids((ENEMY_MINIONS | FRIENDLY_HERO).eval(entities, hero)) == ids([hero, wisp3])
+	assert ids((FRIENDLY_MINIONS - SELF).eval(entities, wisp1)) == ids([wisp2, wisp2])
+	assert ids((ALL_MINIONS - FRIENDLY - MORTALLY_WOUNDED).eval(game, hero)) == ids([wisp3])
+
+	# Compiled selectors follow hijacked operands
+	selector = ALL_MINIONS + FRIENDLY
+	assert ids(selector.eval(game, hero)) == ids([wisp1, wisp2])
+	with hijacked(FRIENDLY, ENEMY_MINIONS):
+		assert ids(selector.eval(game, hero)) == ids([wisp3])
+	assert ids(selector.eval(game, hero)) == ids([wisp1, wisp2])
+
+
+def test_selector_zones():
+	assert FRIENDLY_MINIONS.zones == {Zone.PLAY}
+	assert ENEMY_HAND.zones == {Zone.HAND}
+	assert (IN_HAND | IN_DECK).zones == {Zone.HAND, Zone.DECK}
+	assert (ALL_CHARACTERS - SELF).zones == {Zone.PLAY}
+	assert (IN_HAND + IN_DECK).zones == set()
+	assert CHARACTER.zones == set(Zone)
+	assert (IN_PLAY + RANDOM_MINION).zones is None
+	assert (IN_PLAY | SELF).zones == set(Zone)
+
+	# Wisps in the decks would be equal to the wisp
+	game = prepare_game(exclude=(WISP, ))
+	wisp = game.player1.give(WISP)
+	assert game.zone_entities({Zone.HAND}) is game.hands
+	entities = game.zone_entities({Zone.DECK, Zone.HAND})
+	assert list(entities) == list(game.hands) + list(game.decks)
+	assert wisp in FRIENDLY_HAND.eval(game, game.player1)
+	assert wisp not in (IN_HAND - FRIENDLY).eval(game, game.player1)
+	with hijacked(IN_HAND, IN_DECK):
+		assert ENEMY_HAND.zones == {Zone.DECK}
+		assert wisp not in FRIENDLY_HAND.eval(game, game.player1)
+	assert wisp in FRIENDLY_HAND.eval(game, game.player1)
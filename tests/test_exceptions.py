@@ -60,6 +60,19 @@ def test_play_choose_without_choice():
 		powerofwild.play()
 
 
+def test_play_choose_with_invalid_target():
+	game = prepare_game()
+	keeper = game.player1.give("EX1_166")
+	wisp = game.player2.summon(WISP)
+	# The hero is a valid target for the damage, but not for the silence
+	assert game.player2.hero in keeper.choose_cards[0].targets
+	assert game.player2.hero not in keeper.choose_cards[1].targets
+	with pytest.raises(InvalidAction):
+		keeper.play(target=game.player2.hero, choose="EX1_166b")
+	keeper.play(target=wisp, choose="EX1_166b")
+	assert wisp.silenced
+
+
 def test_play_game_over():
 	game = prepare_game()
 	moonfire = game.player1.give(MOONFIRE)
@@ -0,0 +1,250 @@
+import asyncio
+import json
+import random
+import struct
+
+import pytest
+from utils import *
+from kettle import binary
+from kettle.kettle import KettleGame, KettleServer
+from kettle.loadtest import create_game, read_packet, respond, send_packet
+from fireplace.simulate import make_specs
+
+
+def run(coro):
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	try:
+		return loop.run_until_complete(coro)
+	finally:
+		loop.close()
+		asyncio.set_event_loop(None)
+
+
+async def connect(workers=0):
+	server = KettleServer(max_games=10, timeout=60, workers=workers)
+	await server.start("127.0.0.1", 0)
+	port = server.sockets[0].getsockname()[1]
+	reader, writer = await asyncio.open_connection("127.0.0.1", port)
+	return server, reader, writer
+
+
+def test_kettle_split_packets():
+	async def test():
+		server, reader, writer = await connect()
+		try:
+			spec = make_specs(1, seed=1)[0]
+			data = json.dumps(create_game(spec)).encode("utf-8")
+			packet = struct.pack("<i", len(data)) + data
+			# The header and the body arrive in pieces
+			for i in range(0, len(packet), 7):
+				writer.write(packet[i:i + 7])
+				await writer.drain()
+				await asyncio.sleep(0)
+			response = await read_packet(reader)
+			types = [payload["Type"] for payload in response]
+			assert "GameEntity" in types
+			assert types[-1] == "Options"
+
+			send_packet(writer, {"Type": "Concede", "Concede": 1})
+			while await read_packet(reader) is not None:
+				pass
+		finally:
+			writer.close()
+			await server.close()
+
+	run(test())
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+@pytest.mark.parametrize("encoding", ["json", "binary"])
+def test_kettle_game(workers, encoding):
+	async def test():
+		server, reader, writer = await connect(workers)
+		rng = random.Random(1)
+		try:
+			spec = make_specs(1, seed=2)[0]
+			send_packet(writer, create_game(spec, encoding))
+			tag_changes = 0
+			for i in range(50):
+				packet = await read_packet(reader)
+				assert packet is not None
+				tag_changes += sum(payload["Type"] == "TagChange" for payload in packet)
+				response = respond(packet, rng)
+				if response:
+					send_packet(writer, response)
+			assert tag_changes
+
+			send_packet(writer, {"Type": "Concede", "Concede": 2})
+			payloads = []
+			while True:
+				packet = await read_packet(reader)
+				if packet is None:
+					break
+				payloads += packet
+			assert {
+				"Type": "TagChange",
+				"TagChange": {"EntityID": 2, "Tag": GameTag.PLAYSTATE, "Value": PlayState.WON},
+			} in payloads
+		finally:
+			writer.close()
+			await server.close()
+
+	run(test())
+
+
+def test_kettle_invalid_packet_size():
+	async def test():
+		server, reader, writer = await connect()
+		try:
+			writer.write(struct.pack("<i", -1))
+			await writer.drain()
+			assert await read_packet(reader) is None
+		finally:
+			writer.close()
+			await server.close()
+
+	run(test())
+
+
+def without_turn_start(payloads):
+	ret = []
+	for payload in payloads:
+		if payload["Type"] == "TagChange":
+			if payload["TagChange"]["Tag"] == GameTag.TURN_START:
+				continue
+		else:
+			for value in payload.values():
+				if isinstance(value, dict) and "Tags" in value:
+					value["Tags"].pop(str(int(GameTag.TURN_START)), None)
+		ret.append(payload)
+	return ret
+
+
+def test_kettle_binary_encoding():
+	spec = make_specs(1, seed=3)[0]
+	games = {}
+	for encoding in ("json", "binary"):
+		data = json.dumps(create_game(spec, encoding)).encode("utf-8")
+		games[encoding] = KettleGame(data)
+	assert games["binary"].encoding == "binary"
+
+	rng = random.Random(3)
+	packets = {encoding: game.start() for encoding, game in games.items()}
+	for i in range(30):
+		for json_packet, binary_packet in zip(packets["json"], packets["binary"]):
+			payloads = json.loads(json_packet[4:].decode("utf-8"))
+			assert binary_packet[4] == binary.VERSION
+			# The games started at different times
+			assert without_turn_start(binary.decode(binary_packet[4:])) == (
+				without_turn_start(payloads)
+			)
+			assert len(binary_packet) < len(json_packet)
+		response = json.dumps(respond(payloads, rng)).encode("utf-8")
+		packets = {}
+		for encoding, game in games.items():
+			packets[encoding], game_over = game.process(response)
+		assert not game_over
+
+
+def test_kettle_unknown_encoding():
+	spec = make_specs(1, seed=3)[0]
+	packet = create_game(spec, "xml")
+	packet[0]["CreateGame"]["Encodings"].append("json")
+	game = KettleGame(json.dumps(packet).encode("utf-8"))
+	assert game.encoding == "json"
+	assert json.loads(game.start()[0][4:].decode("utf-8"))
+
+
+def client_states(state, packets):
+	# The tags a client knows of at each block boundary, from its \a state
+	ret = []
+	turn_start = str(int(GameTag.TURN_START))
+	for packet in packets:
+		for payload in json.loads(packet[4:].decode("utf-8")):
+			type = payload["Type"]
+			if type in ("ActionStart", "ActionEnd"):
+				ret.append(state_snapshot(state, turn_start))
+			elif type == "TagChange":
+				change = payload["TagChange"]
+				state[change["EntityID"]][str(change["Tag"])] = change["Value"]
+			elif type in ("GameEntity", "Player", "FullEntity", "ShowEntity"):
+				entity = payload["FullEntity" if type == "ShowEntity" else type]
+				state[entity["EntityID"]] = dict(entity["Tags"])
+		ret.append(state_snapshot(state, turn_start))
+	return ret
+
+
+def state_snapshot(state, turn_start):
+	return {
+		id: {tag: value for tag, value in tags.items() if value and tag != turn_start}
+		for id, tags in state.items()
+	}
+
+
+def payload_order(packet):
+	# The payloads of \a packet, with the first TagChange of each tag in a block
+	# TURN_START is the wall clock time, which may differ between games
+	ret = []
+	changed = set()
+	for payload in json.loads(packet[4:].decode("utf-8")):
+		type = payload["Type"]
+		if type in ("ActionStart", "ActionEnd"):
+			changed.clear()
+		elif type == "TagChange":
+			change = payload["TagChange"]
+			key = change["EntityID"], change["Tag"]
+			if key in changed or change["Tag"] == GameTag.TURN_START:
+				continue
+			changed.add(key)
+			type = type, key
+		ret.append(type)
+	return ret
+
+
+def is_subsequence(values, sequence):
+	sequence = iter(sequence)
+	return all(value in sequence for value in values)
+
+
+def test_kettle_coalesce_tag_changes():
+	spec = make_specs(1, seed=4)[0]
+	data = json.dumps(create_game(spec)).encode("utf-8")
+	full = KettleGame(data, coalesce_tag_changes=False)
+	coalesced = KettleGame(data)
+
+	rng = random.Random(4)
+	full_packets = full.start()
+	coalesced_packets = coalesced.start()
+	full_state = {}
+	coalesced_state = {}
+	full_changes = coalesced_changes = 0
+	for i in range(60):
+		states = client_states(coalesced_state, coalesced_packets)
+		assert states == client_states(full_state, full_packets)
+		for packet in full_packets:
+			full_changes += packet.count(b'"TagChange"')
+		for full_packet, coalesced_packet in zip(full_packets, coalesced_packets):
+			# Coalesced changes stay in the place of the first change of the tag
+			order = payload_order(coalesced_packet)
+			assert is_subsequence(order, payload_order(full_packet))
+		for packet in coalesced_packets:
+			coalesced_changes += packet.count(b'"TagChange"')
+			payloads = json.loads(packet[4:].decode("utf-8"))
+			# No tag changes twice within a block
+			changed = set()
+			for payload in payloads:
+				if payload["Type"] in ("ActionStart", "ActionEnd"):
+					changed.clear()
+				elif payload["Type"] == "TagChange":
+					change = payload["TagChange"]
+					key = change["EntityID"], change["Tag"]
+					assert key not in changed
+					changed.add(key)
+
+		response = json.dumps(respond(payloads, rng)).encode("utf-8")
+		full_packets, game_over = full.process(response)
+		coalesced_packets, game_over = coalesced.process(response)
+		if game_over:
+			break
+	assert coalesced_changes < full_changes
@@ -491,6 +491,21 @@ def test_sir_finley_mrrgglton():
 	assert game.player1.hero.power is new_power
 
 
+def test_sir_finley_mrrgglton_concurrent_games():
+	game1 = prepare_game(CardClass.PRIEST, CardClass.PRIEST)
+	game2 = prepare_game(CardClass.PRIEST, CardClass.PRIEST)
+	game1.player1.give("LOE_076").play()
+	game2.player1.give("LOE_076").play()
+	choice = game2.player1.choice
+	assert game1.player1.choice is not choice
+	game1.player1.choice.choose(game1.player1.choice.cards[0])
+	assert game2.player1.choice is choice
+	assert choice.player is game2.player1
+	new_power = choice.cards[0]
+	choice.choose(new_power)
+	assert game2.player1.hero.power is new_power
+
+
 def test_summoning_stone():
 	game = prepare_game()
 	stone = game.player1.give("LOE_086")
@@ -1,4 +1,14 @@
+import logging
+from itertools import zip_longest
+
+import pytest
 from utils import *
+from fireplace.exceptions import GameOver
+from fireplace.logging import set_headless
+from fireplace.entity import BranchedEntity
+from fireplace.player import ActionType
+from fireplace.simulate import make_specs, simulate, simulate_game
+from fireplace.utils import IndexedCardList
 
 
 def test_event_queue_heal():
@@ -42,3 +52,476 @@ def test_event_queue_summon():
 	assert reaver in game.player2.hand
 	assert buzzard.health == 1
 	assert len(game.player2.field) == 1
+
+
+def test_event_registry():
+	game = prepare_empty_game()
+	juggler1 = game.player1.give("NEW1_019")
+	juggler2 = game.player1.give("NEW1_019")
+	wisp = game.player1.give(WISP)
+	summon = Summon(CONTROLLER, MINION)
+	juggler2.play()
+	juggler1.play()
+	wisp.play()
+	listeners = game.event_registry.get_listeners(summon, EventListener.AFTER)
+	assert [entity for position, entity in listeners] == [juggler2, juggler1]
+	assert listeners[0][1] is juggler2
+	assert listeners[1][1] is juggler1
+	juggler2.destroy()
+	listeners = game.event_registry.get_listeners(summon, EventListener.AFTER)
+	assert len(listeners) == 1
+	assert listeners[0][1] is juggler1
+
+
+def test_event_registry_shrinks():
+	game = prepare_empty_game()
+	registry = game.event_registry
+
+	def size():
+		return sum(len(entities) for entities in registry.listeners.values())
+
+	initial_size = size()
+	juggler = game.player1.give("NEW1_019")
+	juggler.play()
+	assert juggler.entity_id in registry.keys
+	wisp = game.player1.give(WISP)
+	wisp.play()
+	game.player1.give("EX1_363").play(target=wisp)
+	buff = wisp.buffs[0]
+	assert buff.entity_id in registry.keys
+	ooze = game.player1.give("FP1_003")
+	ooze.play()
+	end_turn = registry.listeners[EndTurn, EventListener.ON]
+	assert ooze.entity_id in end_turn
+	assert size() > initial_size
+
+	# Leaving play
+	juggler.destroy()
+	assert juggler.entity_id not in registry.keys
+	# Buff removal
+	game.player1.give(SILENCE).play(target=wisp)
+	assert not wisp.buffs
+	assert buff.entity_id not in registry.keys
+	# One-time listeners
+	game.end_turn()
+	assert ooze.entity_id not in end_turn
+	assert ooze.entity_id in registry.keys
+	wisp.destroy()
+	ooze.destroy()
+	for minion in game.player1.field:
+		minion.destroy()
+	assert size() == initial_size
+
+
+def test_aura_tracker():
+	game = prepare_empty_game()
+	game.aura_tracker.debug = True
+	raid_leader = game.player1.give("CS2_122")
+	raid_leader.play()
+	wisp1 = game.player1.give(WISP)
+	wisp1.play()
+	assert wisp1.atk == 2
+	wisp2 = game.player1.give(WISP)
+	wisp2.play()
+	assert wisp1.atk == wisp2.atk == 2
+	game.end_turn()
+
+	game.player2.give(MOONFIRE).play(target=wisp1)
+	assert wisp2.atk == 2
+	game.player2.give(MOONFIRE).play(target=raid_leader)
+	assert wisp2.atk == 2
+	game.player2.give(MOONFIRE).play(target=raid_leader)
+	assert wisp2.atk == 1
+	assert not game.active_aura_buffs
+
+
+def test_attr_cache():
+	game = prepare_empty_game()
+	wisp = game.player1.give(WISP)
+	wisp.play()
+	assert wisp.atk == 1
+	assert not wisp.taunt
+	game.player1.give("CS2_087").play(target=wisp)
+	buff = wisp.buffs[0]
+	assert wisp.atk == 4
+	buff.atk = 5
+	assert wisp.atk == 6
+	raid_leader = game.player1.give("CS2_122")
+	raid_leader.play()
+	assert wisp.atk == 7
+	game.player1.hero.buff(wisp, "CS2_122e", atk=3)
+	assert wisp.atk == 10
+	game.player1.give("EX1_360").play(target=wisp)
+	assert wisp.atk == 1
+	wisp.atk = 2
+	assert wisp.atk == 1
+	game.player1.give(SILENCE).play(target=wisp)
+	assert wisp.atk == 2 + 1
+	raid_leader.destroy()
+	assert wisp.atk == 2
+	wisp.taunt = True
+	assert wisp.taunt
+
+
+def test_cached_views():
+	game = prepare_game()
+	wisp = game.player1.give(WISP)
+	board = game.board
+	assert game.board is board
+	assert wisp in game.player1.hand
+	wisp.play()
+	assert game.board is not board
+	assert wisp in game.board
+	assert wisp in game.player1.entities
+	assert wisp in game.player1.characters
+	wisp.destroy()
+	assert wisp not in game.board
+	assert wisp in game.graveyard
+	assert wisp not in game.player1.live_entities
+
+
+def test_indexed_cardlist():
+	game = prepare_game()
+	wisp1 = game.player1.give(WISP)
+	wisp2 = game.player1.give(WISP)
+	hand = game.player1.hand
+	assert isinstance(hand, IndexedCardList)
+	assert wisp1 == wisp2
+	assert hand.index(wisp2) == hand.index(wisp1) + 1
+	hand.remove(wisp1)
+	assert wisp1 not in hand
+	assert wisp2 in hand
+	assert hand.contains(wisp1)
+	assert hand.index(wisp2) == len(hand) - 1
+	hand.insert(0, wisp1)
+	assert hand.index(wisp1) == 0
+	assert hand.index(wisp2) == len(hand) - 1
+	assert isinstance(hand[1:], IndexedCardList)
+	assert wisp2 in hand[1:]
+	assert wisp1 not in hand[1:]
+	assert int(hand) == len(hand)
+	hand.reverse()
+	assert hand.index(wisp1) == len(hand) - 1
+	del hand[-1]
+	assert wisp1 not in hand
+
+
+def test_play_targets():
+	game = prepare_game()
+	wisp = game.player1.give(WISP)
+	moonfire = game.player1.give(MOONFIRE)
+	execute = game.player1.give("CS2_108")
+	assert wisp.data.target_validator is None
+	assert moonfire.data.target_validator is not None
+	assert not wisp.play_targets
+	assert wisp not in moonfire.play_targets
+	wisp.play()
+	assert wisp in moonfire.play_targets
+	yeti = game.player2.summon("CS2_182")
+	assert not execute.play_targets
+	game.player1.give(MOONFIRE).play(target=yeti)
+	assert execute.play_targets == [yeti]
+	# Changes which do not tick the game
+	yeti.damage = 0
+	assert not execute.play_targets
+	yeti.stealthed = True
+	assert yeti not in moonfire.play_targets
+
+	with game.cache_targets():
+		targets = moonfire.play_targets
+		assert moonfire.play_targets is targets
+	assert moonfire.play_targets is not targets
+
+
+def test_legal_actions():
+	game = prepare_empty_game(CardClass.MAGE, CardClass.MAGE)
+	player = game.player1
+	assert game.player2.legal_actions() == []
+	actions = player.legal_actions()
+	assert actions[0] == (ActionType.END_TURN, None, None, None, None)
+	power = player.hero.power
+	hero_powers = [a for a in actions if a[0] == ActionType.HERO_POWER]
+	assert hero_powers == [
+		(ActionType.HERO_POWER, power, target, None, None) for target in power.targets
+	]
+
+	wisp = player.give(WISP)
+	wrath = player.give("EX1_154")
+	player.give(MOONFIRE).play(target=game.player2.hero)
+	actions = player.legal_actions(positions=True)
+	assert (ActionType.PLAY, wisp, None, None, 0) in actions
+	assert not [a for a in actions if a[1] is wrath]
+
+	yeti = game.player2.summon("CS2_182")
+	actions = player.legal_actions()
+	assert (ActionType.PLAY, wisp, None, None, None) in actions
+	assert (ActionType.PLAY, wrath, yeti, "EX1_154a", None) in actions
+	assert (ActionType.PLAY, wrath, yeti, "EX1_154b", None) in actions
+	player.perform((ActionType.PLAY, wrath, yeti, "EX1_154a", None))
+	assert yeti.damage == 3
+	player.perform((ActionType.PLAY, wisp, None, None, None))
+
+	game.end_turn()
+	game.end_turn()
+	attacks = [a for a in player.legal_actions() if a[0] == ActionType.ATTACK]
+	assert attacks == [
+		(ActionType.ATTACK, wisp, game.player2.hero, None, None),
+		(ActionType.ATTACK, wisp, yeti, None, None),
+	]
+	player.perform(attacks[1])
+	assert wisp.dead
+
+	game.player2.give("CS2_029")
+	game.end_turn()
+	assert game.player2.legal_actions()[0][0] == ActionType.END_TURN
+
+
+def test_legal_actions_choose_one_targets():
+	game = prepare_game()
+	player = game.player1
+	keeper = player.give("EX1_166")
+	yeti = game.player2.summon("CS2_182")
+	actions = [a for a in player.legal_actions() if a[1] is keeper]
+	# Each choice is played on the targets of the chosen card
+	assert (ActionType.PLAY, keeper, game.player2.hero, "EX1_166a", None) in actions
+	assert (ActionType.PLAY, keeper, yeti, "EX1_166b", None) in actions
+	assert not [a for a in actions if a[3] == "EX1_166b" and a[2] is not yeti]
+	with pytest.raises(InvalidAction):
+		keeper.play(target=game.player2.hero, choose="EX1_166b")
+	player.perform((ActionType.PLAY, keeper, yeti, "EX1_166b", None))
+	assert yeti.silenced
+
+
+def _play_out(game, seed):
+	random.seed(seed)
+	try:
+		while True:
+			player = game.current_player
+			player.perform(random.choice(player.legal_actions()))
+	except GameOver:
+		pass
+	return _game_state(game)
+
+
+def _game_state(game):
+	# Entity references (eg. CONTROLLER) are compared by entity id,
+	# TURN_START is a timestamp
+	return [(entity.entity_id, repr(entity), sorted(
+		(tag, getattr(value, "entity_id", value)) for tag, value in entity.tags.items()
+		if tag != GameTag.TURN_START
+	)) for entity in game]
+
+
+def test_clone():
+	game = prepare_game()
+	game.player1.give(WISP).play()
+	game.end_turn()
+	clone = game.clone()
+	assert clone is not game
+	assert clone.manager.observers == []
+	assert clone.player1.hero.data is game.player1.hero.data
+	assert clone.player1.field[0] is not game.player1.field[0]
+	assert clone.player1.field[0].controller is clone.player1
+
+	clone.player1.field[0].destroy()
+	clone.process_deaths()
+	assert not clone.player1.field
+	assert len(game.player1.field) == 1
+
+	clone = game.clone()
+	assert _play_out(game, 1) == _play_out(clone, 1)
+
+
+def test_branch():
+	game = prepare_game()
+	game.player1.give(WISP).play()
+	game.end_turn()
+	branch = game.branch()
+	card = branch.player1.deck[0]
+	assert isinstance(card, BranchedEntity)
+	assert card.id == game.player1.deck[0].id
+	assert isinstance(card, BranchedEntity)
+	assert card.zone == Zone.DECK
+	assert not isinstance(card, BranchedEntity)
+	assert branch.player1.hero.data is game.player1.hero.data
+	assert branch.player1.field[0].controller is branch.player1
+
+	branch.player1.field[0].destroy()
+	branch.process_deaths()
+	assert not branch.player1.field
+	assert len(game.player1.field) == 1
+
+	branch = game.branch()
+	assert _play_out(branch.branch(), 1) == _play_out(game.clone(), 1)
+	assert _play_out(branch.clone(), 1) == _play_out(game, 1)
+
+
+def test_branch_before_changes():
+	game = prepare_game()
+	wisp = game.player1.give(WISP)
+	wisp.play()
+	game.end_turn()
+	branch = game.branch()
+	branch_of_branch = branch.branch()
+	clone = game.clone()
+
+	# The branches are copied before the game changes
+	game.player2.give(MOONFIRE).play(target=wisp)
+	assert wisp.dead
+	assert not isinstance(branch.player1.field[0], BranchedEntity)
+	assert not branch.player1.field[0].dead
+	assert _play_out(branch_of_branch, 1) == _play_out(clone, 1)
+
+	hero = game.player1.hero
+	game.checkpoint()
+	game.player2.give(MOONFIRE).play(target=hero)
+	branch = game.branch()
+	game.rollback()
+	assert branch.player1.hero.damage == hero.damage + 1
+
+
+def test_checkpoint():
+	game = prepare_game()
+	wisp = game.player1.give(WISP)
+	wisp.play()
+	game.end_turn()
+	clone = game.clone()
+	state = _game_state(game)
+	hand = list(game.player2.hand)
+
+	game.checkpoint()
+	game.random.random()
+	game.player2.give(MOONFIRE).play(target=wisp)
+	assert wisp.dead
+	game.checkpoint()
+	game.end_turn()
+	assert game.current_player is game.player1
+	game.rollback()
+	assert game.current_player is game.player2
+	assert wisp.dead
+	game.rollback()
+	assert game.random.getstate() == clone.random.getstate()
+	assert not wisp.dead
+	assert game.player1.field[0] is wisp
+	assert len(game.player2.hand) == len(hand)
+	assert all(a is b for a, b in zip(game.player2.hand, hand))
+	assert _game_state(game) == state
+	with pytest.raises(ValueError):
+		game.rollback()
+
+	assert _play_out(game, 1) == _play_out(clone, 1)
+
+
+def _random_playout(game):
+	try:
+		while True:
+			player = game.current_player
+			player.perform(game.random.choice(player.legal_actions()))
+			yield
+	except GameOver:
+		pass
+
+
+def test_seed():
+	game1 = prepare_game(CardClass.MAGE, CardClass.WARRIOR, seed=1857)
+	game2 = prepare_game(CardClass.MAGE, CardClass.WARRIOR, seed=1857)
+	assert game1.seed == game2.seed == 1857
+	assert [card.id for card in game1.player1.deck] == [card.id for card in game2.player1.deck]
+
+	# The games only depend on their seed, whatever else uses random
+	for steps in zip_longest(_random_playout(game1), _random_playout(game2)):
+		random.random()
+	assert game1.ended and game2.ended
+	assert _game_state(game1) == _game_state(game2)
+
+
+def test_simulate():
+	specs = make_specs(2, seed=1857, class1=CardClass.MAGE)
+	assert specs == make_specs(2, seed=1857, class1=CardClass.MAGE)
+	assert all(spec["classes"][0] == CardClass.MAGE for spec in specs)
+
+	expected = [simulate_game(spec) for spec in specs]
+	seeds = [spec["seed"] for spec in specs]
+	results = sorted(
+		simulate(specs, processes=2), key=lambda result: seeds.index(result["seed"])
+	)
+	for result in expected + results:
+		assert result["winner"] in (0, 1, 2)
+		del result["duration"]
+	# The games only depend on their spec, whichever process plays them
+	assert results == expected
+
+
+def test_headless():
+	records = []
+	handler = logging.Handler()
+	handler.emit = records.append
+	log.addHandler(handler)
+	set_headless()
+	try:
+		game = prepare_game()
+		game.player1.give(WISP).play()
+		game.end_turn()
+		assert not records
+		set_headless(False)
+		game.player2.give(WISP).play()
+		assert records
+	finally:
+		set_headless(False)
+		log.removeHandler(handler)
+
+
+def _changes(game):
+	# Cards compare by card ID, entity IDs tell them apart
+	return {entity.entity_id: tags for entity, tags in game.manager.changes()}
+
+
+def test_track_changes():
+	game = prepare_game()
+	wisp = game.player1.give(WISP)
+	wisp.play()
+	# The random decks may hold cards with scripted tags, eg. Sea Giant
+	deck_wisp = game.player1.card(WISP, zone=Zone.DECK)
+	game.manager.track_changes()
+	changes = _changes(game)
+	assert GameTag.DAMAGE in changes[wisp.entity_id]
+	assert not game.manager.changes()
+
+	game.player1.give(MOONFIRE).play(target=game.player2.hero)
+	changes = _changes(game)
+	assert GameTag.DAMAGE in changes[game.player2.hero.entity_id]
+	assert GameTag.DAMAGE not in changes.get(wisp.entity_id, [])
+	assert GameTag.DAMAGE not in changes.get(game.player1.hero.entity_id, [])
+	# Only the entities which changed, or whose tags depend on what changed
+	assert deck_wisp.entity_id not in changes
+
+	# Entities created later are tracked too
+	wisp2 = game.player1.give(WISP)
+	changes = _changes(game)
+	assert GameTag.ZONE in changes[wisp2.entity_id]
+	wisp2.play()
+	changes = _changes(game)
+	assert GameTag.ZONE_POSITION in changes[wisp.entity_id]
+
+	# Rolling back changes the restored entities as a whole
+	game.checkpoint()
+	game.player1.give(MOONFIRE).play(target=wisp)
+	game.rollback()
+	changes = _changes(game)
+	assert wisp.zone == Zone.PLAY
+	assert GameTag.ZONE in changes[wisp.entity_id]
+
+
+def test_track_changes_debug_auras(monkeypatch):
+	monkeypatch.setenv("FIREPLACE_DEBUG_AURAS", "1")
+	game = prepare_game()
+	assert game.aura_tracker.debug
+	game.manager.track_changes()
+	berserker = game.player1.give("OG_150")
+	berserker.play()
+	game.player1.give(MOONFIRE).play(target=berserker)
+	assert GameTag.ATK in _changes(game)[berserker.entity_id]
+	# The debug checks of the auras do not see the changes being tracked
+	game.refresh_auras()
+	game.refresh_auras()
+	assert berserker.atk == 3 + 2
@@ -77,7 +77,7 @@ def _empty_mulligan(game):
 			player.choice.choose()
 
 
-def init_game(class1=None, class2=None, exclude=(), game_class=BaseTestGame):
+def init_game(class1=None, class2=None, exclude=(), game_class=BaseTestGame, seed=None):
 	log.info("Initializing a new game")
 	if class1 is None:
 		class1 = _random_class()
@@ -85,7 +85,7 @@ def init_game(class1=None, class2=None, exclude=(), game_class=BaseTestGame):
 		class2 = _random_class()
 	player1 = Player("Player1", *_draft(class1, exclude))
 	player2 = Player("Player2", *_draft(class2, exclude))
-	game = game_class(players=(player1, player2))
+	game = game_class(players=(player1, player2), seed=seed)
 	return game
 
 